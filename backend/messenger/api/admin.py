@@ -5,6 +5,7 @@ from django.contrib.auth.models import User, Group
 from django.utils.html import format_html
 from django.utils.translation import gettext_lazy as _
 from .models import UserProfile, Conversation, ConversationMember, Message, MessageAttachment
+from .exports import conversation_csv_response, conversations_zip_response
 
 # === ОТМЕНЯЕМ РЕГИСТРАЦИЮ СТАНДАРТНЫХ МОДЕЛЕЙ ===
 admin.site.unregister(User)
@@ -146,6 +147,7 @@ class ConversationAdmin(RoleBasedModelAdmin):
     list_select_related = ['created_by']
     list_per_page = 50
     inlines = [ConversationMemberInline, MessageInline]
+    actions = ['export_history', 'export_history_with_attachments']
 
     fieldsets = (
         (_('Основная информация'), {
@@ -154,6 +156,9 @@ class ConversationAdmin(RoleBasedModelAdmin):
         (_('Даты'), {
             'fields': ('created_at', 'last_message_at')
         }),
+        (_('Хранение'), {
+            'fields': ('retention_days',)
+        }),
         (_('Статистика'), {
             'fields': ('members_count_display', 'messages_count_display')
         }),
@@ -179,6 +184,19 @@ class ConversationAdmin(RoleBasedModelAdmin):
 
     messages_count_display.short_description = _('Количество сообщений')
 
+    def export_history(self, request, queryset):
+        # Одна беседа - CSV, несколько - ZIP с CSV по каждой беседе
+        if queryset.count() == 1:
+            return conversation_csv_response(queryset.get())
+        return conversations_zip_response(queryset.order_by('id').iterator())
+
+    export_history.short_description = _('Выгрузить историю (CSV)')
+
+    def export_history_with_attachments(self, request, queryset):
+        return conversations_zip_response(queryset.order_by('id').iterator(), include_attachments=True)
+
+    export_history_with_attachments.short_description = _('Выгрузить историю с вложениями (ZIP)')
+
 
 # === МОДЕЛЬ CONVERSATIONMEMBER ===
 @admin.register(ConversationMember)
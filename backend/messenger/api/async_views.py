@@ -0,0 +1,273 @@
+"""
+Асинхронные версии самых нагруженных GET эндпоинтов: список бесед,
+история сообщений беседы, список/поиск пользователей и me/.
+
+Данные загружаются через async ORM целиком (включая связанные объекты),
+после чего сериализаторы DRF работают без обращений к БД. Подписанные
+URL вложений и аватаров формируются локально, без запросов к MinIO.
+ETag и ?fields= / ?expand= работают так же, как в синхронных ViewSet'ах,
+а аутентификацию, права и условия ETag берут у заменяемого ViewSet.
+
+Остальные методы (включая OPTIONS) и запросы browsable API (Accept: text/html)
+передаются соответствующему ViewSet из views.py.
+"""
+from abc import ABCMeta, abstractmethod
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth import aauthenticate
+from django.db.models import Prefetch
+from django.http import HttpResponseNotModified, JsonResponse
+from django.utils.decorators import classonlymethod
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework import exceptions
+from rest_framework.authentication import BaseAuthentication, RemoteUserAuthentication
+from rest_framework.request import Request
+
+from . import views
+from .etags import achanges_version, make_etag, etag_matches
+from .fieldsets import SparseFieldsetViewMixin
+from .membership_cache import aget_conversation_ids
+from .models import Conversation, ConversationMember, Message
+from .serializers import ConversationSerializer, MessageSerializer, UserSerializer
+
+# Тот же тип, что выбирает DRF для JSON ответа: ETag совпадают с синхронными view
+JSON_MEDIA_TYPE = 'application/json'
+
+
+async def aremote_user_authenticate(authenticator, request):
+    """RemoteUserAuthentication.authenticate через асинхронный бэкенд"""
+    user = await aauthenticate(request=request, remote_user=request.META.get(authenticator.header))
+    if user and user.is_active:
+        return user, None
+    return None
+
+
+# Асинхронные варианты классов аутентификации DRF; остальные выполняются в потоке
+ASYNC_AUTHENTICATORS = {
+    RemoteUserAuthentication: aremote_user_authenticate,
+}
+
+
+class ResolvedAuthentication(BaseAuthentication):
+    """Уже выполненная аутентификация: DRF Request получает ее результат без повторных запросов"""
+
+    def __init__(self, result):
+        self.result = result
+
+    def authenticate(self, request):
+        return self.result
+
+
+async def aauthenticate_request(request, authenticators):
+    """
+    Проходит authenticators как APIView: первый вернувший пользователя побеждает,
+    AuthenticationFailed прерывает проверку. Возвращает (user, auth) или None
+    """
+    # Вложенные запросы batch/ уже аутентифицированы
+    user = getattr(request, '_force_auth_user', None)
+    if user is not None:
+        return user, None
+
+    for authenticator in authenticators:
+        handler = ASYNC_AUTHENTICATORS.get(type(authenticator))
+        if handler is not None:
+            result = await handler(authenticator, request)
+        else:
+            result = await sync_to_async(authenticator.authenticate)(Request(request))
+        if result is not None:
+            return result
+    return None
+
+
+def json_response(data, status=200):
+    return JsonResponse(
+        data, status=status, safe=False,
+        json_dumps_params={'ensure_ascii': False, 'separators': (',', ':')}
+    )
+
+
+class AsyncReadView(SparseFieldsetViewMixin, View, metaclass=ABCMeta):
+    """
+    Абстрактный базовый класс: аутентификация и права заменяемого ViewSet, ETag и выбор полей
+    для async GET. Наследник задает fallback_viewset/fallback_actions и реализует get_data().
+    """
+    basename = None
+    action = 'list'
+    format_kwarg = None
+    fallback_viewset = None
+    fallback_actions = {'get': 'list'}
+
+    _fallback_views = {}
+
+    @classonlymethod
+    def as_view(cls, **initkwargs):
+        return csrf_exempt(super().as_view(**initkwargs))
+
+    @classmethod
+    def get_fallback_view(cls):
+        if cls not in cls._fallback_views:
+            cls._fallback_views[cls] = cls.fallback_viewset.as_view(cls.fallback_actions)
+        return cls._fallback_views[cls]
+
+    async def delegate(self, request, *args, **kwargs):
+        return await sync_to_async(self.get_fallback_view())(request, *args, **kwargs)
+
+    post = put = patch = delete = options = delegate
+
+    async def initial(self, request, *args, **kwargs):
+        """
+        Аутентификация и права доступа заменяемого ViewSet: его authentication_classes
+        и permission_classes, как в APIView.initial (в том числе отказ неактивным
+        пользователям). Проверки прав не должны обращаться к БД - они выполняются в event loop
+        """
+        viewset = self.fallback_viewset(
+            request=request, args=args, kwargs=kwargs, action=self.action, format_kwarg=None
+        )
+        self.viewset = viewset
+        authenticators = viewset.get_authenticators()
+        result = await aauthenticate_request(request, authenticators)
+
+        # Без результата DRF Request сам подставит анонимного пользователя
+        resolved = [ResolvedAuthentication(result)] if authenticators or result is not None else []
+        drf_request = Request(request, authenticators=resolved)
+        viewset.request = drf_request
+
+        viewset.check_permissions(drf_request)
+        request.user = drf_request.user
+
+    def exception_response(self, exc):
+        """Ответ на исключение DRF с теми же статусами, что у APIView.handle_exception"""
+        headers = {}
+        if isinstance(exc, (exceptions.NotAuthenticated, exceptions.AuthenticationFailed)):
+            auth_header = self.viewset.get_authenticate_header(self.viewset.request)
+            if auth_header:
+                headers['WWW-Authenticate'] = auth_header
+            else:
+                exc.status_code = 403
+
+        detail = exc.detail if isinstance(exc.detail, (list, dict)) else {'detail': exc.detail}
+        response = json_response(detail, status=exc.status_code)
+        for name, value in headers.items():
+            response[name] = value
+        return response
+
+    async def get(self, request, *args, **kwargs):
+        if 'text/html' in request.headers.get('Accept', ''):
+            return await self.delegate(request, *args, **kwargs)
+
+        request.accepted_media_type = JSON_MEDIA_TYPE
+
+        try:
+            await self.initial(request, *args, **kwargs)
+
+            etag = None
+            condition = await self.get_etag_condition()
+            if condition is not None:
+                etag = make_etag(request, self.basename, await achanges_version(condition))
+                if etag_matches(request, etag):
+                    response = HttpResponseNotModified()
+                    response['ETag'] = etag
+                    return response
+
+            data = await self.get_data(*args, **kwargs)
+        except exceptions.APIException as e:
+            return self.exception_response(e)
+
+        response = json_response(data)
+        if etag:
+            response['ETag'] = etag
+        return response
+
+    async def get_etag_condition(self):
+        """Условие ETag заменяемого ViewSet, если для действия он предусмотрен"""
+        if self.action not in getattr(self.viewset, 'etag_actions', ()):
+            return None
+        return await sync_to_async(self.viewset.get_etag_condition)()
+
+    @abstractmethod
+    async def get_data(self, *args, **kwargs):
+        """Данные ответа на GET после проверки прав и ETag"""
+
+
+class ConversationListView(AsyncReadView):
+    basename = 'conversations'
+    fallback_viewset = views.ConversationViewSet
+    fallback_actions = {'get': 'list', 'post': 'create'}
+
+    def get_queryset(self, conversation_ids):
+        queryset = self.only_requested(Conversation.objects.filter(id__in=conversation_ids))
+
+        if self.expands_field('members'):
+            queryset = queryset.prefetch_related('members__user__profile')
+        elif self.wants_field('members'):
+            queryset = queryset.prefetch_related(
+                Prefetch('members', queryset=ConversationMember.objects.only('id', 'conversation_id', 'user_id'))
+            )
+
+        if self.wants_field('last_message'):
+            queryset = views.with_last_message(queryset)
+        return queryset
+
+    async def get_data(self):
+        queryset = self.get_queryset(await aget_conversation_ids(self.request.user.id))
+        with_last_message = self.wants_field('last_message')
+
+        conversations = [conversation async for conversation in queryset]
+
+        if with_last_message and self.expands_field('last_message'):
+            # Последние сообщения всех бесед одним запросом вместо запроса на беседу
+            last_ids = [c.last_message_pk for c in conversations if c.last_message_pk]
+            messages = Message.objects.filter(id__in=last_ids).select_related(
+                'sender__profile'
+            ).prefetch_related('attachments')
+            by_id = {message.id: message async for message in messages}
+            for conversation in conversations:
+                conversation.prefetched_last_message = by_id.get(conversation.last_message_pk)
+
+        return ConversationSerializer(conversations, many=True, context=self.get_serializer_context()).data
+
+
+class ConversationMessagesView(AsyncReadView):
+    """История сообщений беседы (conversations/{id}/messages/)"""
+    basename = 'conversations'
+    # Поля ?fields= относятся к сообщениям, как в ConversationViewSet.messages
+    action = 'messages'
+    sparse_actions = ('messages',)
+    fallback_viewset = views.ConversationViewSet
+    fallback_actions = {'get': 'messages'}
+
+    async def get_data(self, pk):
+        if not str(pk).isdigit() or int(pk) not in await aget_conversation_ids(self.request.user.id):
+            raise exceptions.NotFound()
+
+        queryset = views.conversation_messages(self, int(pk), self.request.GET)
+        messages = [message async for message in queryset]
+        return MessageSerializer(messages, many=True, context=self.get_serializer_context()).data
+
+
+class UserListView(AsyncReadView):
+    """Список и поиск пользователей (users/?search=)"""
+    basename = 'users'
+    fallback_viewset = views.UserViewSet
+
+    async def get_data(self):
+        queryset = self.only_requested(views.User.objects.all())
+        if self.expands_field('profile'):
+            queryset = queryset.select_related('profile')
+        queryset = views.search_users(queryset, self.request.GET.get('search'))
+
+        users = [user async for user in queryset]
+        return UserSerializer(users, many=True, context=self.get_serializer_context()).data
+
+
+class CurrentUserView(AsyncReadView):
+    basename = 'current-user'
+    fallback_viewset = views.CurrentUserViewSet
+
+    async def get_data(self):
+        user = self.request.user
+        # Пользователь из кэша аутентификации обычно уже загружен вместе с профилем
+        if self.expands_field('profile') and not views.User.profile.is_cached(user):
+            user = await views.User.objects.select_related('profile').aget(pk=user.pk)
+        return UserSerializer(user, context=self.get_serializer_context()).data
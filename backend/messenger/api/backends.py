@@ -1,6 +1,8 @@
 from django.contrib.auth.backends import ModelBackend
 from django.contrib.auth.models import User
 
+from .user_cache import get_user_by_username, aget_user_by_username
+
 
 class RemoteUserBackend(ModelBackend):
     def authenticate(self, request, remote_user=None):
@@ -8,13 +10,26 @@ class RemoteUserBackend(ModelBackend):
             remote_user = request.META.get('HTTP_X_REMOTE_USER')
         if remote_user:
             try:
-                user = User.objects.get(username=remote_user)
+                user = get_user_by_username(remote_user)
             except User.DoesNotExist:
                 return None
             return user
         return User.objects.get(pk=1)
         # return None
 
+    async def aauthenticate(self, request, remote_user=None):
+        """Асинхронный вариант authenticate для async views"""
+        if remote_user is None:
+            remote_user = request.META.get('HTTP_X_REMOTE_USER')
+        if remote_user:
+            try:
+                user = await aget_user_by_username(remote_user)
+            except User.DoesNotExist:
+                return None
+            return user
+        return await User.objects.select_related('profile').aget(pk=1)
+        # return None
+
     def get_user(self, user_id):
         try:
             return User.objects.get(pk=user_id)
@@ -0,0 +1,84 @@
+"""
+Ограниченная очередь исходящих событий WebSocket соединения.
+
+Обработчики событий consumer только кладут кадр в очередь, а отправкой
+занимается отдельная задача. Медленный клиент переполняет только свою
+очередь, и к нему применяется политика переполнения:
+
+- drop_oldest: выбрасывается самое старое событие;
+- coalesce: событие с тем же ключом (например, правка того же сообщения)
+  заменяет ожидающее или сливается с ним, при переполнении выбрасывается самое старое;
+- disconnect: соединение закрывается с подсказкой выполнить синхронизацию.
+"""
+import asyncio
+from collections import OrderedDict
+from itertools import count
+
+from .metrics import metrics
+
+DROP_OLDEST = 'drop_oldest'
+COALESCE = 'coalesce'
+DISCONNECT = 'disconnect'
+
+POLICIES = (DROP_OLDEST, COALESCE, DISCONNECT)
+
+# Результаты OutboundQueue.put
+QUEUED = 'queued'
+COALESCED = 'coalesced'
+DROPPED = 'dropped'
+OVERFLOW = 'overflow'
+
+
+class OutboundQueue:
+    def __init__(self, maxsize, policy=DROP_OLDEST):
+        if policy not in POLICIES:
+            raise ValueError(f'Неизвестная политика очереди: {policy}')
+        self.maxsize = maxsize
+        self.policy = policy
+        self._items = OrderedDict()  # ключ -> кадр, в порядке постановки
+        self._sequence = count()
+        self._ready = asyncio.Event()
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, payload, key=None, merge=None):
+        """
+        merge(ожидающий, новый) объединяет кадры с одним ключом; без него
+        новый кадр просто заменяет ожидающий
+        """
+        if key is not None and self.policy == COALESCE and key in self._items:
+            # Заменяем содержимое, сохраняя позицию в очереди
+            self._items[key] = merge(self._items[key], payload) if merge else payload
+            metrics.inc('ws_send_queue_coalesced')
+            return COALESCED
+
+        result = QUEUED
+        if len(self._items) >= self.maxsize:
+            if self.policy == DISCONNECT:
+                metrics.inc('ws_send_queue_overflows')
+                return OVERFLOW
+            self._items.popitem(last=False)
+            metrics.gauge_add('ws_send_queue_depth', -1)
+            metrics.inc('ws_send_queue_dropped')
+            result = DROPPED
+
+        if key is None or self.policy != COALESCE:
+            key = ('seq', next(self._sequence))
+        self._items[key] = payload
+        metrics.gauge_add('ws_send_queue_depth', 1)
+        metrics.gauge_max('ws_send_queue_depth_max', len(self._items))
+        self._ready.set()
+        return result
+
+    async def get(self):
+        while not self._items:
+            self._ready.clear()
+            await self._ready.wait()
+        _, payload = self._items.popitem(last=False)
+        metrics.gauge_add('ws_send_queue_depth', -1)
+        return payload
+
+    def clear(self):
+        metrics.gauge_add('ws_send_queue_depth', -len(self._items))
+        self._items.clear()
@@ -0,0 +1,157 @@
+import contextvars
+import json
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from urllib.parse import unquote_to_bytes, urlsplit
+
+from asgiref.sync import async_to_sync, iscoroutinefunction
+from django.conf import settings
+from django.core.handlers.wsgi import WSGIRequest
+from django.db import connections
+from django.urls import resolve, Resolver404
+from rest_framework import status
+
+# Заголовки родительского запроса, которые наследуют вложенные запросы
+INHERITED_META = (
+    'HTTP_HOST', 'SERVER_NAME', 'SERVER_PORT', 'REMOTE_ADDR',
+    'HTTP_X_FORWARDED_HOST', 'HTTP_X_FORWARDED_PROTO', 'HTTP_X_FORWARDED_FOR',
+    'HTTP_ACCEPT_LANGUAGE',
+)
+
+# Заголовки ответа, которые возвращаются клиенту
+RETURNED_HEADERS = ('ETag', 'Location')
+
+ALLOWED_METHODS = ('GET', 'POST', 'PUT', 'PATCH', 'DELETE')
+
+
+class BatchError(Exception):
+    def __init__(self, status_code, message):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+
+
+def error_entry(status_code, message):
+    return {'status': status_code, 'headers': {}, 'body': {'error': message}}
+
+
+class BatchExecutor:
+    """
+    Выполняет пачку запросов к API от имени уже аутентифицированного пользователя.
+    Вложенные запросы вызывают view напрямую, минуя middleware и повторную
+    аутентификацию. Последовательное выполнение идет в потоке родительского
+    запроса и использует его соединение с БД.
+    """
+
+    def __init__(self, request, api_prefix, batch_view):
+        self.request = request
+        self.api_prefix = api_prefix
+        self.batch_view = batch_view
+        self.environ = {key: request.META[key] for key in INHERITED_META if key in request.META}
+        self.environ.update({
+            'SERVER_PROTOCOL': request.META.get('SERVER_PROTOCOL', 'HTTP/1.1'),
+            'wsgi.url_scheme': request.scheme,
+        })
+
+    def build_request(self, method, path, body, headers):
+        """WSGI запрос из окружения родительского: хост, схема и адрес клиента те же"""
+        url = urlsplit(path)
+        payload = json.dumps(body).encode() if body is not None else b''
+        environ = {
+            **self.environ,
+            **headers,
+            'REQUEST_METHOD': method,
+            # PATH_INFO и QUERY_STRING по WSGI - байты в latin-1, как их передает сервер
+            'PATH_INFO': unquote_to_bytes(url.path).decode('iso-8859-1'),
+            'QUERY_STRING': url.query.encode().decode('iso-8859-1'),
+            'CONTENT_TYPE': 'application/json',
+            'CONTENT_LENGTH': str(len(payload)),
+            'wsgi.input': BytesIO(payload),
+        }
+        return WSGIRequest(environ)
+
+    def run(self, specs, concurrent=False):
+        read_only = all(str(spec.get('method', 'GET')).upper() == 'GET' for spec in specs)
+
+        if concurrent and read_only and len(specs) > 1:
+            max_workers = min(len(specs), getattr(settings, 'BATCH_MAX_WORKERS', 4))
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                # Пул не переносит contextvars в рабочие потоки, а без них вложенные запросы
+                # не видят маршрутизацию родительского (основная БД, read-your-writes)
+                futures = [
+                    executor.submit(contextvars.copy_context().run, self.execute_in_thread, spec)
+                    for spec in specs
+                ]
+                return [future.result() for future in futures]
+
+        return [self.execute(spec) for spec in specs]
+
+    def execute_in_thread(self, spec):
+        try:
+            return self.execute(spec)
+        finally:
+            # Соединения рабочего потока не переживают пачку
+            connections.close_all()
+
+    def execute(self, spec):
+        try:
+            return self._execute(spec)
+        except BatchError as e:
+            return error_entry(e.status_code, e.message)
+
+    def _execute(self, spec):
+        if not isinstance(spec, dict) or not spec.get('path'):
+            raise BatchError(status.HTTP_400_BAD_REQUEST, 'Не указан path')
+
+        method = str(spec.get('method', 'GET')).upper()
+        if method not in ALLOWED_METHODS:
+            raise BatchError(status.HTTP_405_METHOD_NOT_ALLOWED, f'Метод {method} не поддерживается')
+
+        path = spec['path']
+        if not path.startswith('/'):
+            path = self.api_prefix + path
+        path_only = path.split('?', 1)[0]
+
+        if not path_only.startswith(self.api_prefix):
+            raise BatchError(status.HTTP_400_BAD_REQUEST, 'Допускаются только запросы к API')
+
+        try:
+            match = resolve(path_only)
+        except Resolver404:
+            raise BatchError(status.HTTP_404_NOT_FOUND, 'Не найдено')
+
+        if getattr(match.func, 'cls', None) is self.batch_view:
+            raise BatchError(status.HTTP_400_BAD_REQUEST, 'Вложенные batch запросы не поддерживаются')
+
+        extra = {}
+        for name, value in (spec.get('headers') or {}).items():
+            extra['HTTP_' + name.upper().replace('-', '_')] = str(value)
+
+        sub_request = self.build_request(method, path, spec.get('body'), extra)
+        # DRF подставит этого пользователя без повторной аутентификации
+        sub_request._force_auth_user = self.request.user
+        sub_request.user = self.request.user
+
+        view = match.func
+        if iscoroutinefunction(view):
+            # Асинхронные view (async_views) из синхронного batch
+            view = async_to_sync(view)
+        response = view(sub_request, *match.args, **match.kwargs)
+
+        if getattr(response, 'streaming', False):
+            raise BatchError(status.HTTP_400_BAD_REQUEST, 'Потоковые ответы не поддерживаются в batch')
+
+        if hasattr(response, 'data'):
+            body = response.data
+        elif response.content and response.get('Content-Type', '').startswith('application/json'):
+            body = json.loads(response.content)
+        elif response.content:
+            body = response.content.decode(response.charset or 'utf-8', errors='replace')
+        else:
+            body = None
+
+        return {
+            'status': response.status_code,
+            'headers': {name: response[name] for name in RETURNED_HEADERS if response.has_header(name)},
+            'body': body,
+        }
@@ -1,15 +1,406 @@
+import asyncio
+import logging
+import time
+
+from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from django.conf import settings
+from django.urls import reverse
+
+from . import ws_actions
+from .backpressure import OutboundQueue, OVERFLOW
+from .db_routers import routing_scope
+from .draining import drain_controller
+from .membership_cache import ais_member, aget_conversation_ids
+from .metrics import metrics, ensure_metrics_publisher
+from .presence import presence, user_group, broadcast_presence
+from .sync import latest_token, settled_tokens
+from .typing import typing_coalescer, conversation_group, TokenBucket
+from .wire import MSGPACK_SUBPROTOCOL, msgpack_available, pack, unpack
+
+logger = logging.getLogger(__name__)
+
+
+def merge_message_deltas(pending, latest):
+    """Сливает две ожидающие отправки дельты одного сообщения: более новая версия важнее"""
+    older, newer = pending, latest
+    if pending["entity"].get("version", 0) > latest["entity"].get("version", 0):
+        older, newer = latest, pending
+    return {**newer, "entity": {**older["entity"], **newer["entity"]}}
 
 
 class MessagesConsumer(AsyncJsonWebsocketConsumer):
+    # Команды клиента: action -> функция из ws_actions
+    actions = {
+        'create': ws_actions.create_message,
+        'edit': ws_actions.edit_message,
+        'delete': ws_actions.delete_message,
+        'read': ws_actions.mark_read,
+    }
+
+    # Код закрытия соединения, не успевающего читать события
+    SLOW_CONSUMER_CLOSE_CODE = 4008
+    # Код закрытия соединения, не ответившего на ping
+    HEARTBEAT_TIMEOUT_CLOSE_CODE = 4009
+    # Стандартный код закрытия "Service Restart" при выкатке
+    DRAIN_CLOSE_CODE = 1012
+    # Сколько ждать отправки очереди перед закрытием при выкатке, секунды
+    DRAIN_FLUSH_TIMEOUT = 2
+
     async def connect(self):
-        await self.accept()
+        self.user = self.scope.get("user")
+        self.left = True
+
+        drain_controller.install()
+        if drain_controller.draining:
+            # Процесс выкатывается: новые соединения пусть идут на другие реплики
+            await self.close()
+            return
+
+        self.outbox = OutboundQueue(
+            maxsize=getattr(settings, 'WS_SEND_QUEUE_SIZE', 200),
+            policy=getattr(settings, 'WS_SEND_QUEUE_POLICY', 'coalesce'),
+        )
+        self.overflowed = False
+        self.sending = False
+        self.left = False
+        self.stale = False
+        self.last_activity = time.monotonic()
+        self.sender_task = asyncio.ensure_future(self.run_sender())
+        self.heartbeat_task = asyncio.ensure_future(self.run_heartbeat())
+        metrics.gauge_add('ws_connections', 1)
+        metrics.gauge_add('ws_live_connections', 1)
+        ensure_metrics_publisher()
+
+        # Бинарный MessagePack с короткими ключами, если клиент его запросил
+        self.use_msgpack = (
+            MSGPACK_SUBPROTOCOL in self.scope.get("subprotocols", []) and msgpack_available()
+        )
+        await self.accept(subprotocol=MSGPACK_SUBPROTOCOL if self.use_msgpack else None)
         await self.channel_layer.group_add("messages", self.channel_name)
+        drain_controller.register(self)
+
+        # Токен синхронизации на момент подключения: все, что изменилось позже,
+        # клиент получил по сокету или догонит через sync/ после переподключения.
+        # Пока соединение живо, токен продвигается (refresh_resume_token)
+        self.resume_token = await database_sync_to_async(latest_token)()
+
+        self.conversation_ids = set()
+        self.typing_bucket = TokenBucket(
+            rate=getattr(settings, 'TYPING_RATE', 2),
+            capacity=getattr(settings, 'TYPING_BURST', 5),
+        )
+
+        if self.is_authenticated():
+            await self.channel_layer.group_add(user_group(self.user.id), self.channel_name)
+            await self.sync_conversation_groups()
+            presence.ensure_flusher()
+            if await presence.aconnect(self.user.id):
+                await self.notify_presence(online=True)
 
     async def disconnect(self, close_code):
+        await self.leave()
+
+    async def leave(self):
+        """
+        Освобождает ресурсы соединения: группы, присутствие, очередь.
+        Вызывается при отключении и при отсечении зависшего соединения,
+        поэтому повторный вызов ничего не делает
+        """
+        if self.left:
+            return
+        self.left = True
+        drain_controller.unregister(self)
+
+        self.sender_task.cancel()
+        if self.heartbeat_task is not asyncio.current_task():
+            self.heartbeat_task.cancel()
+        self.outbox.clear()
+        metrics.gauge_add('ws_connections', -1)
+        metrics.gauge_add('ws_stale_connections' if self.stale else 'ws_live_connections', -1)
+
         await self.channel_layer.group_discard("messages", self.channel_name)
 
+        if self.is_authenticated():
+            await self.channel_layer.group_discard(user_group(self.user.id), self.channel_name)
+            for conversation_id in self.conversation_ids:
+                await self.channel_layer.group_discard(conversation_group(conversation_id), self.channel_name)
+            if await presence.adisconnect(self.user.id):
+                await self.notify_presence(online=False)
+
+    async def send_json(self, content, close=False, coalesce_key=None, merge=None):
+        """
+        Ставит кадр в очередь соединения вместо прямой отправки, чтобы
+        медленный клиент не задерживал обработку событий channel layer
+        """
+        if close:
+            await self.send_frame(content)
+            await self.close()
+            return
+
+        if self.overflowed or self.left:
+            return
+
+        if self.outbox.put(content, coalesce_key, merge) == OVERFLOW:
+            await self.close_slow_consumer()
+
+    async def receive(self, text_data=None, bytes_data=None, **kwargs):
+        self.mark_activity()
+
+        if bytes_data is not None and self.use_msgpack:
+            try:
+                content = unpack(bytes_data)
+            except Exception:
+                logger.warning("Malformed msgpack frame from user %s", getattr(self.user, "id", None))
+                return
+            await self.receive_json(content, **kwargs)
+            return
+
+        await super().receive(text_data=text_data, bytes_data=bytes_data, **kwargs)
+
+    async def send_frame(self, payload):
+        """Кодирует и отправляет кадр в согласованном формате"""
+        if self.use_msgpack:
+            data = pack(payload)
+            await self.send(bytes_data=data)
+        else:
+            data = await self.encode_json(payload)
+            await self.send(text_data=data)
+        metrics.inc('ws_frames_sent')
+        metrics.inc('ws_bytes_sent', len(data))
+
+    async def run_sender(self):
+        """Отправляет кадры из очереди по мере того, как клиент их принимает"""
+        while True:
+            payload = await self.outbox.get()
+            self.sending = True
+            try:
+                await self.send_frame(payload)
+            except Exception:
+                logger.exception("Error sending websocket frame")
+                return
+            finally:
+                self.sending = False
+
+    async def run_heartbeat(self):
+        """
+        Ping каждые WS_HEARTBEAT_INTERVAL секунд. Любой входящий кадр считается
+        признаком жизни; соединение без кадров дольше WS_HEARTBEAT_TIMEOUT
+        считается полуоткрытым и отсекается
+        """
+        interval = getattr(settings, 'WS_HEARTBEAT_INTERVAL', 25)
+        timeout = getattr(settings, 'WS_HEARTBEAT_TIMEOUT', 60)
+
+        while True:
+            await asyncio.sleep(interval)
+            idle = time.monotonic() - self.last_activity
+
+            if idle >= timeout:
+                await self.reap()
+                return
+
+            if idle >= interval:
+                self.set_stale(True)
+
+            if not len(self.outbox) and not self.sending:
+                # Очередь пуста - все события до устоявшегося токена клиент уже получил
+                await self.refresh_resume_token()
+
+            await self.send_json({"type": "ping"}, coalesce_key=("ping",))
+
+    async def refresh_resume_token(self):
+        """
+        Продвигает токен для подсказок reconnect и resync, чтобы после долгого
+        соединения клиент догонял через sync/ минуты, а не всю сессию
+        """
+        try:
+            self.resume_token = max(self.resume_token, await settled_tokens.aget())
+        except Exception:
+            logger.exception("Error refreshing sync token for user %s", getattr(self.user, "id", None))
+
+    def mark_activity(self):
+        self.last_activity = time.monotonic()
+        if self.stale:
+            self.set_stale(False)
+
+    def set_stale(self, stale):
+        """Переводит соединение между измерителями живых и подозрительных соединений"""
+        if self.stale == stale or self.left:
+            return
+        self.stale = stale
+        metrics.gauge_add('ws_stale_connections', 1 if stale else -1)
+        metrics.gauge_add('ws_live_connections', -1 if stale else 1)
+
+    async def reap(self):
+        """
+        Отсекает соединение, не ответившее на ping. Группы освобождаются сразу,
+        не дожидаясь, пока сервер заметит разрыв TCP
+        """
+        metrics.inc('ws_reaped_connections')
+        logger.info("Reaping unresponsive websocket of user %s", getattr(self.user, "id", None))
+        await self.leave()
+        await self.close(code=self.HEARTBEAT_TIMEOUT_CLOSE_CODE)
+
+    async def drain(self):
+        """
+        Закрытие при выкатке: подсказка переподключиться ставится в конец
+        очереди, чтобы клиент сначала получил уже ожидающие события
+        """
+        if self.left:
+            return
+
+        # Подсказка встает за уже ожидающими событиями, поэтому токен можно взять текущий
+        await self.refresh_resume_token()
+        await self.send_json(drain_controller.reconnect_hint(self.resume_token))
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.DRAIN_FLUSH_TIMEOUT
+        while (len(self.outbox) or self.sending) and loop.time() < deadline:
+            await asyncio.sleep(0.05)
+
+        await self.leave()
+        await self.close(code=self.DRAIN_CLOSE_CODE)
+
+    async def close_slow_consumer(self):
+        """
+        Политика disconnect: очередь переполнена, недоставленные события
+        отбрасываются, клиенту сообщается, что нужно догнать состояние через sync/
+        """
+        self.overflowed = True
+        self.outbox.clear()
+        self.sender_task.cancel()
+        metrics.inc('ws_slow_consumer_disconnects')
+
+        await self.send_frame({
+            "type": "resync",
+            "reason": "slow_consumer",
+            "sync_url": reverse('sync-list'),
+            # Токен продвигался, только пока очередь была пуста: сброшенные события новее него
+            "sync_token": self.resume_token,
+        })
+        await self.close(code=self.SLOW_CONSUMER_CLOSE_CODE)
+
+    async def sync_conversation_groups(self):
+        """Приводит группы бесед соединения к текущему составу бесед пользователя"""
+        conversation_ids = set(await aget_conversation_ids(self.user.id))
+
+        for conversation_id in conversation_ids - self.conversation_ids:
+            await self.channel_layer.group_add(conversation_group(conversation_id), self.channel_name)
+        for conversation_id in self.conversation_ids - conversation_ids:
+            await self.channel_layer.group_discard(conversation_group(conversation_id), self.channel_name)
+
+        self.conversation_ids = conversation_ids
+
+    def is_authenticated(self):
+        return self.user is not None and self.user.is_authenticated
+
+    async def notify_presence(self, online):
+        try:
+            await broadcast_presence(self.channel_layer, self.user.id, online)
+        except Exception:
+            logger.exception("Error broadcasting presence for user %s", self.user.id)
+
+    async def receive_json(self, content, **kwargs):
+        """
+        Входящие команды:
+        {"action": "create|edit|delete|read|typing|heartbeat|pong", "request_id": "...", "data": {...}}
+        На каждую команду, кроме typing, heartbeat и pong, отправляется подтверждение с тем же request_id.
+        """
+        if not isinstance(content, dict):
+            return
+
+        action = content.get("action")
+        request_id = content.get("request_id")
+        data = content.get("data") or {}
+
+        if not self.is_authenticated():
+            await self.send_ack(request_id, errors={"detail": "Требуется аутентификация"})
+            return
+
+        if action in ("heartbeat", "pong"):
+            await presence.atouch(self.user.id)
+            return
+
+        if action == "typing":
+            await self.handle_typing(data)
+            return
+
+        handler = self.actions.get(action)
+        if handler is None or not isinstance(data, dict):
+            await self.send_ack(request_id, errors={"action": f"Неизвестная команда: {action}"})
+            return
+
+        try:
+            entity = await database_sync_to_async(self.run_action)(handler, data)
+        except ws_actions.CommandError as e:
+            await self.send_ack(request_id, errors=e.errors)
+        except Exception:
+            logger.exception("Error handling websocket action %s", action)
+            await self.send_ack(request_id, errors={"detail": "Внутренняя ошибка сервера"})
+        else:
+            await self.send_ack(request_id, entity=entity)
+
+    def run_action(self, handler, data):
+        # Команды изменяют данные: читаем из основной БД, а после записи
+        # REST запросы пользователя тоже какое-то время идут в основную БД
+        with routing_scope(self.user.username, use_primary=True):
+            return handler(self.user, data)
+
+    async def send_ack(self, request_id, entity=None, errors=None):
+        ack = {
+            "type": "ack",
+            "request_id": request_id,
+            "ok": errors is None,
+        }
+        if errors is not None:
+            ack["errors"] = errors
+        else:
+            ack["id"] = entity.get("id")
+            ack["entity"] = entity
+        await self.send_json(ack)
+
+    async def handle_typing(self, data):
+        """
+        Набор текста: ограничивается по частоте для соединения, схлопывается
+        для пары (пользователь, беседа) и рассылается только в группу беседы
+        """
+        if not self.typing_bucket.allow():
+            return
+
+        try:
+            conversation_id = int(data.get("conversation"))
+        except (TypeError, ValueError):
+            return
+
+        if conversation_id not in self.conversation_ids:
+            return
+        if not typing_coalescer.should_broadcast(self.user.id, conversation_id):
+            return
+
+        await self.channel_layer.group_send(
+            conversation_group(conversation_id),
+            {
+                "type": "user.typing",
+                "data": {
+                    "entity": {
+                        "conversation": conversation_id,
+                        "user": self.user.id,
+                        "expires_in": typing_coalescer.get_ttl(),
+                    },
+                }
+            }
+        )
+
+    async def can_receive(self, event):
+        """Событие доставляется только участникам беседы сообщения"""
+        if not self.is_authenticated():
+            return False
+        conversation_id = event["data"]["entity"].get("conversation")
+        return await ais_member(self.user.id, conversation_id)
+
     async def message_created(self, event):
+        if not await self.can_receive(event):
+            return
 
         await self.send_json({
             "type": "message_created",
@@ -18,17 +409,41 @@ class MessagesConsumer(AsyncJsonWebsocketConsumer):
         })
 
     async def message_updated(self, event):
+        if not await self.can_receive(event):
+            return
 
         await self.send_json({
             "type": "message_updated",
             "entity": event["data"]["entity"],
             "message": event["data"]["message"]
-        })
+        }, coalesce_key=("message_updated", event["data"]["entity"].get("id")), merge=merge_message_deltas)
 
     async def message_deleted(self, event):
+        if not await self.can_receive(event):
+            return
 
         await self.send_json({
             "type": "message_deleted",
             "entity": event["data"]["entity"],
             "message": event["data"]["message"]
-        })
\ No newline at end of file
+        })
+
+    async def user_typing(self, event):
+        # Группа беседы уже ограничивает получателей; свой набор автору не возвращаем
+        if event["data"]["entity"]["user"] == self.user.id:
+            return
+
+        entity = event["data"]["entity"]
+        await self.send_json({
+            "type": "typing",
+            "entity": entity,
+        }, coalesce_key=("typing", entity["conversation"], entity["user"]))
+
+    async def membership_changed(self, event):
+        await self.sync_conversation_groups()
+
+    async def presence_changed(self, event):
+        await self.send_json({
+            "type": "presence",
+            "entity": event["data"]["entity"],
+        }, coalesce_key=("presence", event["data"]["entity"]["user"]))
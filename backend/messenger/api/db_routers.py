@@ -0,0 +1,231 @@
+"""
+Маршрутизация запросов между основной БД и репликами только для чтения.
+
+Запись всегда идет в основную БД. Чтение уходит на случайную реплику из
+settings.DATABASE_REPLICAS, кроме случаев:
+- запрос изменяет данные (POST/PUT/PATCH/DELETE) или идет внутри транзакции;
+- пользователь недавно что-то записал (read-your-writes): после записи его
+  чтения DB_READ_YOUR_WRITES_WINDOW секунд (не меньше суммы DB_REPLICA_MAX_LAG
+  и DB_REPLICA_LAG_CHECK_INTERVAL) идут в основную БД;
+- реплика отстает больше DB_REPLICA_MAX_LAG секунд или недоступна.
+
+Состояние текущего запроса хранится в contextvars и работает одинаково
+для синхронных view (потоки sync_to_async копируют контекст) и async кода.
+"""
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DatabaseError, connections
+
+logger = logging.getLogger(__name__)
+
+PRIMARY_DB = 'default'
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+# Отставание реплики PostgreSQL в секундах. Если все полученные изменения
+# уже применены, отставания нет, даже если на основной БД давно не было записей
+PG_REPLICA_LAG_SQL = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+"""
+
+
+class RoutingState:
+    """Маршрутизация в рамках одного запроса или команды WebSocket"""
+
+    def __init__(self, username=None, use_primary=False):
+        self.username = username
+        self.use_primary = use_primary
+        self.wrote = False
+
+
+_routing_state = ContextVar('db_routing_state', default=None)
+
+
+def _pin_cache():
+    return caches[getattr(settings, 'DB_PIN_CACHE', 'default')]
+
+
+def _pin_key(username):
+    return f'db:pin:{username}'
+
+
+def _pin_window():
+    return getattr(settings, 'DB_READ_YOUR_WRITES_WINDOW', 15)
+
+
+def is_pinned(username):
+    return bool(username) and bool(_pin_cache().get(_pin_key(username)))
+
+
+async def ais_pinned(username):
+    return bool(username) and bool(await _pin_cache().aget(_pin_key(username)))
+
+
+def pin_to_primary(username):
+    """Направляет чтения пользователя в основную БД на время окна read-your-writes"""
+    if username:
+        _pin_cache().set(_pin_key(username), 1, _pin_window())
+
+
+async def apin_to_primary(username):
+    if username:
+        await _pin_cache().aset(_pin_key(username), 1, _pin_window())
+
+
+@contextmanager
+def routing_scope(username=None, use_primary=False):
+    """
+    Контекст маршрутизации для кода вне HTTP запросов (команды WebSocket).
+    Если внутри была запись, чтения пользователя закрепляются за основной БД.
+    """
+    state = RoutingState(username, use_primary or is_pinned(username))
+    token = _routing_state.set(state)
+    try:
+        yield state
+    finally:
+        _routing_state.reset(token)
+        if state.wrote:
+            pin_to_primary(username)
+
+
+class ReplicaLagMonitor:
+    """
+    Периодически проверяет отставание реплик. Проверка делается не чаще
+    DB_REPLICA_LAG_CHECK_INTERVAL секунд на реплику в процессе.
+    """
+
+    def __init__(self):
+        self._checked = {}  # alias -> (checked_at, healthy)
+        self._lock = threading.Lock()
+
+    def is_healthy(self, alias):
+        interval = getattr(settings, 'DB_REPLICA_LAG_CHECK_INTERVAL', 5)
+        now = time.monotonic()
+
+        with self._lock:
+            checked_at, healthy = self._checked.get(alias, (None, True))
+            if checked_at is not None and now - checked_at < interval:
+                return healthy
+            # Остальные потоки до конца проверки используют прежний результат
+            self._checked[alias] = (now, healthy)
+
+        healthy = self._check(alias)
+        with self._lock:
+            self._checked[alias] = (time.monotonic(), healthy)
+        return healthy
+
+    def _check(self, alias):
+        max_lag = getattr(settings, 'DB_REPLICA_MAX_LAG', 10)
+        connection = connections[alias]
+        if connection.vendor != 'postgresql':
+            return True
+
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(PG_REPLICA_LAG_SQL)
+                lag = float(cursor.fetchone()[0])
+        except DatabaseError:
+            logger.warning("Replica %s is unavailable, reading from primary", alias, exc_info=True)
+            return False
+
+        if lag > max_lag:
+            logger.warning("Replica %s lags %.1fs behind primary, reading from primary", alias, lag)
+            return False
+        return True
+
+    def reset(self):
+        with self._lock:
+            self._checked.clear()
+
+
+lag_monitor = ReplicaLagMonitor()
+
+
+class PrimaryReplicaRouter:
+    """Роутер для DATABASE_ROUTERS"""
+
+    def db_for_read(self, model, **hints):
+        replicas = getattr(settings, 'DATABASE_REPLICAS', [])
+        if not replicas:
+            return PRIMARY_DB
+
+        state = _routing_state.get()
+        if state is not None and (state.use_primary or state.wrote):
+            return PRIMARY_DB
+
+        # Чтения внутри транзакции должны видеть ее изменения
+        if connections[PRIMARY_DB].in_atomic_block:
+            return PRIMARY_DB
+
+        candidates = list(replicas)
+        random.shuffle(candidates)
+        for alias in candidates:
+            if lag_monitor.is_healthy(alias):
+                return alias
+        return PRIMARY_DB
+
+    def db_for_write(self, model, **hints):
+        state = _routing_state.get()
+        if state is not None:
+            state.wrote = True
+        return PRIMARY_DB
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Реплики содержат те же данные, что и основная БД
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == PRIMARY_DB
+
+
+class ReadYourWritesMiddleware:
+    """
+    Открывает контекст маршрутизации на время запроса. Изменяющие запросы
+    и запросы пользователя, недавно изменявшего данные, читают из основной БД.
+    Пользователь определяется по заголовку remote user.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        username = request.META.get('HTTP_X_REMOTE_USER')
+        use_primary = request.method not in SAFE_METHODS or is_pinned(username)
+        state = RoutingState(username, use_primary)
+        token = _routing_state.set(state)
+        try:
+            return self.get_response(request)
+        finally:
+            _routing_state.reset(token)
+            if state.wrote:
+                pin_to_primary(username)
+
+    async def __acall__(self, request):
+        username = request.META.get('HTTP_X_REMOTE_USER')
+        use_primary = request.method not in SAFE_METHODS or await ais_pinned(username)
+        state = RoutingState(username, use_primary)
+        token = _routing_state.set(state)
+        try:
+            return await self.get_response(request)
+        finally:
+            _routing_state.reset(token)
+            if state.wrote:
+                await apin_to_primary(username)
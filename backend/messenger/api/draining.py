@@ -0,0 +1,129 @@
+"""
+Плавное отключение WebSocket соединений при выкатке.
+
+По SIGTERM процесс перестает принимать новые соединения, а открытые
+закрывает не все сразу, а равномерно в течение WS_DRAIN_WINDOW секунд
+(окно сокращается, чтобы закрытие уложилось в ASGI_GRACEFUL_TIMEOUT).
+Перед закрытием клиент получает подсказку переподключиться через
+случайную задержку и токен синхронизации, с которого нужно догнать
+состояние. После закрытия последнего соединения управление передается
+обычному обработчику SIGTERM сервера.
+"""
+import asyncio
+import logging
+import os
+import random
+import signal
+import weakref
+
+from django.conf import settings
+
+from .metrics import metrics
+from .presence import presence
+
+logger = logging.getLogger(__name__)
+
+# Секунды из ASGI_GRACEFUL_TIMEOUT, оставляемые на сброс last_seen и остановку сервера
+FINISH_RESERVE = 5
+
+
+class DrainController:
+    def __init__(self):
+        self.draining = False
+        self._consumers = weakref.WeakSet()
+        self._install_attempted = False
+        self._installed = False
+        self._previous_handler = None
+        self._task = None
+
+    def register(self, consumer):
+        self._consumers.add(consumer)
+
+    def unregister(self, consumer):
+        self._consumers.discard(consumer)
+
+    def install(self):
+        """
+        Перехватывает SIGTERM в текущем event loop. Вызывается при первом
+        соединении, когда сервер уже установил свои обработчики сигналов
+        """
+        if self._install_attempted:
+            return
+        self._install_attempted = True
+
+        loop = asyncio.get_running_loop()
+        self._previous_handler = signal.getsignal(signal.SIGTERM)
+        try:
+            loop.add_signal_handler(signal.SIGTERM, self.start)
+        except (NotImplementedError, RuntimeError, ValueError):
+            # Не главный поток или платформа без поддержки сигналов в loop
+            logger.warning("Cannot install SIGTERM drain handler")
+            return
+        self._installed = True
+
+    def start(self, window=None):
+        """Включает режим drain и запускает постепенное закрытие соединений"""
+        if self.draining:
+            return
+        self.draining = True
+        metrics.gauge_set('ws_draining', 1)
+
+        if window is None:
+            window = getattr(settings, 'WS_DRAIN_WINDOW', 30)
+        self._task = asyncio.get_running_loop().create_task(self._drain(window))
+
+    async def _drain(self, window):
+        """
+        Каждое соединение закрывается своей задачей со сдвигом i * delay, поэтому
+        медленный клиент (до DRAIN_FLUSH_TIMEOUT на дочитывание очереди) не сдвигает
+        остальных. Ждем всех не дольше срока, укладывающегося в ASGI_GRACEFUL_TIMEOUT,
+        - после него процесс все равно будет остановлен
+        """
+        consumers = list(self._consumers)
+        random.shuffle(consumers)
+
+        deadline = max(getattr(settings, 'ASGI_GRACEFUL_TIMEOUT', 45) - FINISH_RESERVE, 1)
+        flush_timeout = max((getattr(consumer, 'DRAIN_FLUSH_TIMEOUT', 0) for consumer in consumers), default=0)
+        window = max(min(window, deadline - flush_timeout), 0)
+        logger.info("Draining %s websocket connections over %ss", len(consumers), window)
+
+        delay = window / len(consumers) if consumers else 0
+        loop = asyncio.get_running_loop()
+        tasks = [loop.create_task(self._drain_one(consumer, i * delay)) for i, consumer in enumerate(consumers)]
+        if tasks:
+            _, pending = await asyncio.wait(tasks, timeout=deadline)
+            for task in pending:
+                task.cancel()
+            if pending:
+                logger.warning("%s websocket connections were not drained in %ss", len(pending), deadline)
+
+        # last_seen, накопленные в памяти процесса, иначе потеряются при остановке
+        await presence.aflush()
+        self._finish()
+
+    async def _drain_one(self, consumer, offset):
+        await asyncio.sleep(offset)
+        try:
+            await consumer.drain()
+        except Exception:
+            logger.exception("Error draining websocket connection")
+        metrics.inc('ws_drained_connections')
+
+    def _finish(self):
+        """Возвращает обработчик SIGTERM сервера и повторяет сигнал, чтобы процесс завершился"""
+        if not self._installed:
+            return
+
+        asyncio.get_running_loop().remove_signal_handler(signal.SIGTERM)
+        signal.signal(signal.SIGTERM, self._previous_handler or signal.SIG_DFL)
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    def reconnect_hint(self, resume_token):
+        return {
+            "type": "reconnect",
+            "retry_after": round(random.uniform(0, getattr(settings, 'WS_DRAIN_JITTER', 10)), 2),
+            "resume": {"sync_token": resume_token},
+        }
+
+
+drain_controller = DrainController()
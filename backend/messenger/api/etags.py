@@ -0,0 +1,92 @@
+import hashlib
+
+from django.db.models import Max
+from django.utils.http import parse_etags
+from rest_framework import status
+from rest_framework.exceptions import APIException
+from rest_framework.response import Response
+
+from .models import ChangeLog
+
+
+class NotModified(APIException):
+    status_code = status.HTTP_304_NOT_MODIFIED
+
+    def __init__(self, etag):
+        super().__init__()
+        self.etag = etag
+
+
+def changes_version(condition):
+    """Версия ресурса - id последней записи журнала изменений по условию"""
+    return ChangeLog.objects.filter(condition).aggregate(version=Max('id'))['version'] or 0
+
+
+async def achanges_version(condition):
+    """Асинхронный вариант changes_version для async views"""
+    result = await ChangeLog.objects.filter(condition).aaggregate(version=Max('id'))
+    return result['version'] or 0
+
+
+def make_etag(request, scope, version):
+    """
+    Слабый ETag из версии данных. Пользователь и строка запроса входят
+    в хэш, так как от них зависит содержимое ответа.
+    """
+    key = f'{request.user.pk}:{request.get_full_path()}:{request.accepted_media_type}'
+    digest = hashlib.md5(key.encode(), usedforsecurity=False).hexdigest()[:12]
+    return f'W/"{scope}-{version}-{digest}"'
+
+
+def etag_matches(request, etag):
+    header = request.META.get('HTTP_IF_NONE_MATCH')
+    if not header:
+        return False
+    etags = parse_etags(header)
+    if '*' in etags:
+        return True
+    # Слабое сравнение: префикс W/ не учитываем
+    bare = etag[2:] if etag.startswith('W/') else etag
+    return any((tag[2:] if tag.startswith('W/') else tag) == bare for tag in etags)
+
+
+class ConditionalGetMixin:
+    """
+    Условные GET запросы для ViewSet'ов. Версия считается по журналу
+    изменений до сериализации: при совпадении If-None-Match сразу
+    возвращается 304 без выборки самих данных.
+
+    Наследник реализует get_etag_condition(), возвращающий Q для журнала
+    изменений или None, если для текущего действия ETag не нужен.
+    """
+    etag_actions = ('list', 'retrieve')
+
+    def get_etag_condition(self):
+        return None
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        self._etag = None
+
+        if request.method not in ('GET', 'HEAD') or self.action not in self.etag_actions:
+            return
+
+        condition = self.get_etag_condition()
+        if condition is None:
+            return
+
+        self._etag = make_etag(request, self.basename, changes_version(condition))
+        if etag_matches(request, self._etag):
+            raise NotModified(self._etag)
+
+    def handle_exception(self, exc):
+        if isinstance(exc, NotModified):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': exc.etag})
+        return super().handle_exception(exc)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        etag = getattr(self, '_etag', None)
+        if etag and response.status_code == status.HTTP_200_OK:
+            response['ETag'] = etag
+        return response
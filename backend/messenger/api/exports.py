@@ -0,0 +1,265 @@
+import csv
+import io
+import os
+import tempfile
+import zipfile
+
+from asgiref.sync import sync_to_async
+from django.db.models import Prefetch
+from django.http import StreamingHttpResponse
+
+from .models import Message, MessageAttachment
+
+# Размер пачки строк, которую читаем из серверного курсора
+EXPORT_CHUNK_SIZE = 2000
+
+# Размер куска при копировании вложений из MinIO в архив
+ATTACHMENT_CHUNK_SIZE = 256 * 1024
+
+# Сколько данных копим в буфере архива перед отправкой клиенту
+ZIP_FLUSH_SIZE = 256 * 1024
+
+# Размер куска при отдаче готового XLSX файла
+FILE_CHUNK_SIZE = 256 * 1024
+
+# Лимит строк на лист XLSX (ограничение формата)
+XLSX_MAX_ROWS = 1048576
+
+EXPORT_HEADER = [
+    'ID', 'Дата отправки', 'Логин отправителя', 'Отправитель',
+    'Текст', 'Отредактировано', 'Дата редактирования', 'Вложения',
+]
+
+DATE_FORMAT = '%d.%m.%Y %H:%M'
+
+_END = object()
+
+
+async def aiter_in_thread(iterator):
+    """
+    Асинхронная обертка над синхронным генератором выгрузки. Приложение работает
+    под ASGI, а синхронный streaming_content Django под ASGI сначала собирает в
+    список целиком. Здесь каждый следующий кусок вычисляется в потоке по запросу,
+    поэтому в памяти держится только он. thread_sensitive - все куски в одном
+    потоке, серверный курсор остается на своем соединении.
+    """
+    iterator = iter(iterator)
+    next_chunk = sync_to_async(lambda: next(iterator, _END))
+    try:
+        while True:
+            chunk = await next_chunk()
+            if chunk is _END:
+                break
+            yield chunk
+    finally:
+        # Клиент мог отключиться раньше: закрываем генератор и его курсор
+        close = getattr(iterator, 'close', None)
+        if close is not None:
+            await sync_to_async(close)()
+
+
+def iter_export_messages(conversation):
+    """
+    Потоково отдает сообщения беседы в порядке отправки.
+    iterator() читает через серверный курсор, вложения подгружаются пачками.
+    """
+    queryset = Message.objects.filter(
+        conversation=conversation
+    ).select_related(
+        'sender', 'sender__profile'
+    ).prefetch_related(
+        Prefetch('attachments', queryset=MessageAttachment.objects.only('id', 'message_id', 'file_name'))
+    ).order_by('sent_at', 'id')
+
+    return queryset.iterator(chunk_size=EXPORT_CHUNK_SIZE)
+
+
+def message_to_row(message):
+    """Преобразует сообщение в строку выгрузки"""
+    sender = message.sender
+    profile = getattr(sender, 'profile', None)
+    if profile and profile.last_name and profile.first_name:
+        sender_name = ' '.join(filter(None, [profile.last_name, profile.first_name, profile.second_name]))
+    else:
+        sender_name = sender.get_full_name() or sender.username
+
+    return [
+        message.id,
+        message.sent_at.strftime(DATE_FORMAT) if message.sent_at else '',
+        sender.username,
+        sender_name,
+        message.text,
+        'Да' if message.is_edited else 'Нет',
+        message.edited_at.strftime(DATE_FORMAT) if message.edited_at else '',
+        ', '.join(attachment.file_name for attachment in message.attachments.all()),
+    ]
+
+
+class Echo:
+    """Псевдо-буфер для csv.writer: возвращает записанную строку вместо хранения"""
+
+    def write(self, value):
+        return value
+
+
+def iter_conversation_csv(conversation):
+    """Генератор CSV выгрузки беседы"""
+    writer = csv.writer(Echo())
+    # BOM, чтобы Excel корректно открыл кириллицу
+    yield '\ufeff' + writer.writerow(EXPORT_HEADER)
+    for message in iter_export_messages(conversation):
+        yield writer.writerow(message_to_row(message))
+
+
+def conversation_csv_response(conversation):
+    response = StreamingHttpResponse(
+        aiter_in_thread(iter_conversation_csv(conversation)),
+        content_type='text/csv; charset=utf-8'
+    )
+    response['Content-Disposition'] = f'attachment; filename="conversation_{conversation.id}.csv"'
+    return response
+
+
+def conversation_xlsx_response(conversation):
+    """
+    XLSX выгрузка беседы. openpyxl в режиме write_only сбрасывает строки
+    во временный файл, поэтому память не растет с размером беседы. Архив XLSX
+    собирается целиком при сохранении, так что файл готовится на диске
+    и только потом отдается клиенту кусками.
+    """
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    sheet = None
+    rows_in_sheet = XLSX_MAX_ROWS
+
+    for message in iter_export_messages(conversation):
+        if rows_in_sheet >= XLSX_MAX_ROWS:
+            sheet = workbook.create_sheet(f'Сообщения {len(workbook.worksheets) + 1}')
+            sheet.append(EXPORT_HEADER)
+            rows_in_sheet = 1
+        sheet.append(message_to_row(message))
+        rows_in_sheet += 1
+
+    if sheet is None:
+        workbook.create_sheet('Сообщения 1').append(EXPORT_HEADER)
+
+    output = tempfile.TemporaryFile()
+    workbook.save(output)
+    size = output.tell()
+    output.seek(0)
+
+    response = StreamingHttpResponse(
+        aiter_in_thread(iter_file(output)),
+        content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    )
+    response['Content-Length'] = str(size)
+    response['Content-Disposition'] = f'attachment; filename="conversation_{conversation.id}.xlsx"'
+    return response
+
+
+def iter_file(file):
+    """Читает файл кусками и закрывает его по окончании"""
+    with file:
+        yield from iter(lambda: file.read(FILE_CHUNK_SIZE), b'')
+
+
+class ZipStream:
+    """
+    Файлоподобный объект без seek для zipfile. Записанные данные
+    накапливаются до вызова drain(), после чего отдаются клиенту.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._size = 0
+        self._position = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._size += len(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    @property
+    def pending(self):
+        return self._size
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        self._size = 0
+        return data
+
+
+def iter_conversations_zip(conversations, include_attachments=False):
+    """
+    Генератор ZIP архива: для каждой беседы messages.csv и, опционально,
+    вложения из MinIO. Архив пишется без seek (data descriptors), поэтому
+    отдается клиенту по мере формирования.
+    """
+    stream = ZipStream()
+
+    with zipfile.ZipFile(stream, 'w', compression=zipfile.ZIP_DEFLATED, allowZip64=True) as archive:
+        for conversation in conversations:
+            folder = f'conversation_{conversation.id}/'
+
+            with archive.open(folder + 'messages.csv', 'w', force_zip64=True) as entry:
+                text = io.TextIOWrapper(entry, encoding='utf-8', newline='')
+                for line in iter_conversation_csv(conversation):
+                    text.write(line)
+                    if stream.pending >= ZIP_FLUSH_SIZE:
+                        text.flush()
+                        yield stream.drain()
+                text.flush()
+                text.detach()
+            yield stream.drain()
+
+            if include_attachments:
+                yield from _iter_zip_attachments(archive, stream, conversation, folder)
+
+    yield stream.drain()
+
+
+def _iter_zip_attachments(archive, stream, conversation, folder):
+    """Копирует вложения беседы в архив кусками"""
+    attachments = MessageAttachment.objects.filter(
+        message__conversation=conversation
+    ).only('id', 'file', 'file_name').order_by('id').iterator(chunk_size=EXPORT_CHUNK_SIZE)
+
+    missing = []
+    for attachment in attachments:
+        if not attachment.file:
+            continue
+
+        name = f'{folder}attachments/{attachment.id}_{os.path.basename(attachment.file_name)}'
+        try:
+            source = attachment.file.open('rb')
+        except Exception:
+            missing.append(f'{attachment.id};{attachment.file.name}')
+            continue
+
+        with source, archive.open(name, 'w', force_zip64=True) as entry:
+            for chunk in iter(lambda: source.read(ATTACHMENT_CHUNK_SIZE), b''):
+                entry.write(chunk)
+                if stream.pending >= ZIP_FLUSH_SIZE:
+                    yield stream.drain()
+        yield stream.drain()
+
+    if missing:
+        archive.writestr(folder + 'missing_attachments.txt', '\n'.join(missing))
+
+
+def conversations_zip_response(conversations, include_attachments=False, filename='conversations.zip'):
+    response = StreamingHttpResponse(
+        aiter_in_thread(iter_conversations_zip(conversations, include_attachments)),
+        content_type='application/zip'
+    )
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
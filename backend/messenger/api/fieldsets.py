@@ -0,0 +1,105 @@
+from rest_framework import serializers
+
+
+def parse_field_list(value):
+    """Разбирает список полей вида 'id,text,sender'. None - параметр не передан"""
+    if value is None:
+        return None
+    return {name.strip() for name in value.split(',') if name.strip()}
+
+
+class SparseFieldsetMixin:
+    """
+    Поддержка ?fields= и ?expand= для сериализатора.
+
+    fields ограничивает набор полей ответа. Если передан fields или expand,
+    вложенные объекты, не перечисленные в expand, сворачиваются:
+    expandable_fields задает для них фабрику поля с id или None, если
+    поле убирается целиком. Без параметров ответ не меняется.
+
+    Параметры берутся из context['fields'] и context['expand'], которые
+    заполняет SparseFieldsetViewMixin, и применяются только к корневому
+    сериализатору ответа, но не к вложенным.
+    """
+    expandable_fields = {}
+
+    def get_fields(self):
+        fields = super().get_fields()
+        requested = self.context.get('fields')
+        expand = self.context.get('expand')
+
+        if (requested is None and expand is None) or not self._is_response_root():
+            return fields
+
+        if requested is not None:
+            for name in list(fields):
+                if name not in requested:
+                    del fields[name]
+
+        expand = expand or set()
+        for name, collapsed_field in self.expandable_fields.items():
+            if name not in fields or name in expand:
+                continue
+            if collapsed_field is None:
+                del fields[name]
+            else:
+                fields[name] = collapsed_field()
+
+        return fields
+
+    def _is_response_root(self):
+        parent = self.parent
+        if parent is None:
+            return True
+        return isinstance(parent, serializers.ListSerializer) and parent.parent is None
+
+
+class SparseFieldsetViewMixin:
+    """
+    Передает ?fields= и ?expand= в сериализатор и помогает get_queryset
+    не загружать данные, которые не попадут в ответ.
+    """
+    sparse_actions = ('list', 'retrieve')
+
+    def get_sparse_params(self):
+        if not hasattr(self, '_sparse_params'):
+            if self.action in self.sparse_actions:
+                # query_params у DRF Request, GET у обычного HttpRequest (async views)
+                params = getattr(self.request, 'query_params', self.request.GET)
+                self._sparse_params = (
+                    parse_field_list(params.get('fields')),
+                    parse_field_list(params.get('expand')),
+                )
+            else:
+                self._sparse_params = (None, None)
+        return self._sparse_params
+
+    def get_serializer_context(self):
+        parent = super()
+        if hasattr(parent, 'get_serializer_context'):
+            context = parent.get_serializer_context()
+        else:
+            # Простой ViewSet без GenericAPIView
+            context = {'request': self.request, 'format': self.format_kwarg, 'view': self}
+        context['fields'], context['expand'] = self.get_sparse_params()
+        return context
+
+    def wants_field(self, name):
+        requested, _ = self.get_sparse_params()
+        return requested is None or name in requested
+
+    def expands_field(self, name):
+        requested, expand = self.get_sparse_params()
+        if requested is None and expand is None:
+            return True
+        return self.wants_field(name) and expand is not None and name in expand
+
+    def only_requested(self, queryset, always=('id',)):
+        """Ограничивает выборку колонками запрошенных полей модели"""
+        requested, _ = self.get_sparse_params()
+        if requested is None:
+            return queryset
+
+        concrete = {field.name for field in queryset.model._meta.concrete_fields}
+        columns = set(always) | (requested & concrete)
+        return queryset.only(*columns)
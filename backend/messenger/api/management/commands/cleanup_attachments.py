@@ -0,0 +1,211 @@
+# messenger/management/commands/cleanup_attachments.py
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models.functions import Collate
+from django.utils import timezone
+
+from api.models import MessageAttachment
+from api.storage_utils import (
+    is_bucket_storage, iter_bucket_objects, delete_bucket_keys, storage_key, storage_name
+)
+
+# Префикс, под которым FileField сохраняет вложения (см. MessageAttachment.file.upload_to)
+ATTACHMENTS_PREFIX = 'message_attachments/'
+
+
+def unlinked_attachments(cutoff, after_pk, batch_size):
+    """Пачка вложений, не привязанных к сообщению и загруженных раньше cutoff: (pk, file, file_size)"""
+    return MessageAttachment.objects.filter(
+        message__isnull=True, uploaded_at__lt=cutoff, pk__gt=after_pk
+    ).order_by('pk').values_list('pk', 'file', 'file_size')[:batch_size]
+
+
+class Command(BaseCommand):
+    help = (
+        'Удаляет осиротевшие вложения: записи без сообщения и объекты MinIO без записи в БД. '
+        'Предназначена для периодического запуска (cron); с --dry-run только выводит отчет'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--older-than-hours', type=int, default=24,
+            help='Минимальный возраст сироты в часах (защита от удаления незавершенных загрузок)'
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help='Размер пачки для удаления и чтения из БД'
+        )
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Только отчет, без удаления'
+        )
+        parser.add_argument(
+            '--prefix', default=ATTACHMENTS_PREFIX,
+            help='Префикс ключей в бакете, который нужно сверять'
+        )
+        parser.add_argument(
+            '--skip-rows', action='store_true',
+            help='Не удалять записи вложений без сообщения'
+        )
+        parser.add_argument(
+            '--skip-bucket', action='store_true',
+            help='Не сверять бакет с таблицей вложений'
+        )
+
+    def handle(self, *args, **options):
+        if not is_bucket_storage():
+            raise CommandError('Хранилище по умолчанию не является бакетом S3/MinIO')
+
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size должен быть больше нуля')
+
+        self.verbosity = options['verbosity']
+        self.dry_run = options['dry_run']
+        self.batch_size = options['batch_size']
+        age = timedelta(hours=options['older_than_hours'])
+
+        if self.dry_run:
+            self.stdout.write(self.style.WARNING('Режим dry-run: данные не будут удалены'))
+
+        if not options['skip_rows']:
+            # uploaded_at хранится без часового пояса (USE_TZ = False)
+            self.cleanup_rows(timezone.now() - age)
+
+        if not options['skip_bucket']:
+            # LastModified из S3 всегда в UTC
+            self.cleanup_bucket(options['prefix'], datetime.now(dt_timezone.utc) - age)
+
+    def cleanup_rows(self, cutoff):
+        """Удаляет вложения, которые так и не были привязаны к сообщению"""
+        total_rows = 0
+        total_size = 0
+        last_pk = 0
+
+        while True:
+            batch = list(unlinked_attachments(cutoff, last_pk, self.batch_size))
+            if not batch:
+                break
+
+            last_pk = batch[-1][0]
+            pks = [pk for pk, _, _ in batch]
+            keys = [storage_key(name) for _, name, _ in batch if name]
+
+            total_rows += len(batch)
+            total_size += sum(size or 0 for _, _, size in batch)
+
+            for pk, name, _ in batch:
+                self.report_item(f'запись #{pk}', name)
+
+            if not self.dry_run:
+                failed = delete_bucket_keys(keys)
+                if failed:
+                    # Не удаляем записи, файлы которых остались в бакете
+                    failed_names = {storage_name(key) for key in failed}
+                    pks = [pk for pk, name, _ in batch if name not in failed_names]
+                    self.stderr.write(f'Не удалось удалить {len(failed)} объектов из бакета')
+                MessageAttachment.objects.filter(pk__in=pks).delete()
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Вложений без сообщения: {total_rows} ({self.human_size(total_size)})'
+            + ('' if self.dry_run else ' - удалены')
+        ))
+
+    def cleanup_bucket(self, prefix, cutoff):
+        """
+        Сверяет листинг бакета с таблицей вложений слиянием двух
+        отсортированных потоков. Ни один из потоков не загружается в память целиком.
+        """
+        names = self.iter_db_names(prefix)
+        db_name = next(names, None)
+
+        scanned = 0
+        orphaned = 0
+        orphaned_size = 0
+        missing = 0
+        pending = []
+
+        for obj in iter_bucket_objects(prefix, page_size=self.batch_size):
+            scanned += 1
+            name = storage_name(obj['Key'])
+
+            # Записи, для которых нет объекта в бакете
+            while db_name is not None and db_name < name:
+                missing += 1
+                self.report_item('нет файла для записи', db_name, verbosity=2)
+                db_name = next(names, None)
+
+            if db_name == name:
+                # Объект используется; пропускаем дубликаты имени в таблице
+                while db_name == name:
+                    db_name = next(names, None)
+                continue
+
+            if obj['LastModified'] >= cutoff:
+                continue
+
+            orphaned += 1
+            orphaned_size += obj.get('Size', 0)
+            self.report_item('объект без записи', obj['Key'])
+            pending.append(obj['Key'])
+
+            if len(pending) >= self.batch_size:
+                self.flush_keys(pending)
+                pending = []
+
+        if pending:
+            self.flush_keys(pending)
+
+        while db_name is not None:
+            missing += 1
+            self.report_item('нет файла для записи', db_name, verbosity=2)
+            db_name = next(names, None)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Просмотрено объектов: {scanned}; без записи в БД: {orphaned} '
+            f'({self.human_size(orphaned_size)})' + ('' if self.dry_run else ' - удалены')
+        ))
+        if missing:
+            self.stdout.write(self.style.WARNING(f'Записей без файла в бакете: {missing}'))
+
+    def iter_db_names(self, prefix):
+        """
+        Потоково отдает имена файлов из таблицы вложений в том же порядке,
+        что и листинг бакета (побайтовое сравнение UTF-8)
+        """
+        queryset = MessageAttachment.objects.filter(file__startswith=prefix)
+        collation = self.binary_collation()
+        if collation:
+            queryset = queryset.annotate(file_key=Collate('file', collation)).order_by('file_key')
+        else:
+            queryset = queryset.order_by('file')
+
+        return queryset.values_list('file', flat=True).iterator(chunk_size=self.batch_size)
+
+    def binary_collation(self):
+        """Collation, сортирующая строки побайтово, для текущей СУБД"""
+        return {
+            'postgresql': 'C',
+            'sqlite': 'BINARY',
+            'mysql': 'utf8mb4_bin',
+        }.get(connection.vendor)
+
+    def flush_keys(self, keys):
+        if self.dry_run:
+            return
+        failed = delete_bucket_keys(keys)
+        if failed:
+            self.stderr.write(f'Не удалось удалить {len(failed)} объектов из бакета')
+
+    def report_item(self, label, name, verbosity=2):
+        if self.verbosity >= verbosity:
+            self.stdout.write(f'  {label}: {name}')
+
+    @staticmethod
+    def human_size(size):
+        for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
+            if size < 1024.0:
+                return f"{size:.1f} {unit}"
+            size /= 1024.0
+        return f"{size:.1f} PB"
@@ -0,0 +1,98 @@
+# messenger/management/commands/manage_message_partitions.py
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from api.partitions import (
+    add_months, month_start, is_partitioned, list_partitions, ensure_partitions,
+    archive_partitions, default_partition_has_rows,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        'Обслуживает секции таблицы messages: создает секции будущих месяцев и '
+        'переводит старые секции в архив. Предназначена для периодического запуска (cron)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--ahead', type=int, default=settings.MESSAGES_PARTITIONS_AHEAD,
+            help='На сколько месяцев вперед создавать секции'
+        )
+        parser.add_argument(
+            '--archive', action='store_true',
+            help='Перевести в архив секции старше --archive-after-months'
+        )
+        parser.add_argument(
+            '--archive-after-months', type=int, default=settings.MESSAGES_ARCHIVE_AFTER_MONTHS,
+            help='Возраст секции в месяцах, после которого она уходит в архив'
+        )
+        parser.add_argument(
+            '--tablespace', default=settings.MESSAGES_ARCHIVE_TABLESPACE,
+            help='Табличное пространство для архивных секций'
+        )
+        parser.add_argument(
+            '--list', action='store_true',
+            help='Вывести список секций и ничего не менять'
+        )
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Только показать, что будет сделано'
+        )
+
+    def handle(self, *args, **options):
+        if not is_partitioned():
+            raise CommandError('Таблица messages не секционирована (нужен PostgreSQL и миграция 0018)')
+
+        if options['list']:
+            self.print_partitions()
+            return
+
+        if options['ahead'] < 0 or options['archive_after_months'] < 1:
+            raise CommandError('--ahead не может быть отрицательным, --archive-after-months - меньше 1')
+
+        dry_run = options['dry_run']
+        if dry_run:
+            self.stdout.write(self.style.WARNING('Режим dry-run: секции не будут изменены'))
+
+        created = ensure_partitions(options['ahead'], dry_run=dry_run)
+        for name in created:
+            self.stdout.write(f'  создана секция {name}')
+        self.stdout.write(self.style.SUCCESS(f'Новых секций: {len(created)}'))
+
+        if options['archive']:
+            before = add_months(month_start(timezone.now()), -options['archive_after_months'])
+            archived = archive_partitions(before, tablespace=options['tablespace'] or None, dry_run=dry_run)
+            for name in archived:
+                self.stdout.write(f'  в архив: {name}')
+            self.stdout.write(self.style.SUCCESS(f'Секций переведено в архив: {len(archived)}'))
+
+        if default_partition_has_rows():
+            self.stdout.write(self.style.WARNING(
+                'В секции messages_default есть сообщения: не хватило заранее созданных секций. '
+                'Секции за эти месяцы не могут быть созданы, пока строки не перенесены'
+            ))
+
+    def print_partitions(self):
+        for partition in list_partitions():
+            if partition.is_default:
+                bounds = 'DEFAULT'
+            else:
+                lower = f'{partition.lower:%Y-%m-%d}' if partition.lower else '...'
+                bounds = f'{lower} - {partition.upper:%Y-%m-%d}'
+            tier = 'архив' if partition.archived else 'оперативная'
+            if partition.tablespace:
+                tier += f' ({partition.tablespace})'
+            self.stdout.write(
+                f'{partition.name:<20} {bounds:<25} {tier:<25} '
+                f'~{partition.rows} строк, {self.human_size(partition.size)}'
+            )
+
+    @staticmethod
+    def human_size(size):
+        for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
+            if size < 1024.0:
+                return f"{size:.1f} {unit}"
+            size /= 1024.0
+        return f"{size:.1f} PB"
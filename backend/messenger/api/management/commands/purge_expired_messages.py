@@ -0,0 +1,154 @@
+# messenger/management/commands/purge_expired_messages.py
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from api.retention import (
+    conversations_with_retention, expired_messages, purge_batch, changelog_cutoff, prune_changelog_batch,
+    load_checkpoint, save_checkpoint, clear_checkpoint
+)
+
+
+class Command(BaseCommand):
+    help = (
+        'Удаляет сообщения и вложения старше срока хранения беседы, а также старые записи '
+        'журнала синхронизации. Удаляет пачками с паузами; прерванный запуск продолжается '
+        'с места остановки. Предназначена для периодического запуска (cron)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=settings.MESSAGES_PURGE_BATCH_SIZE,
+            help='Сколько сообщений удалять за одну транзакцию'
+        )
+        parser.add_argument(
+            '--pause', type=float, default=settings.MESSAGES_PURGE_PAUSE,
+            help='Пауза между пачками в секундах'
+        )
+        parser.add_argument(
+            '--max-runtime', type=int, default=0,
+            help='Остановиться через указанное число секунд (0 - без ограничения); '
+                 'следующий запуск продолжит с места остановки'
+        )
+        parser.add_argument(
+            '--restart', action='store_true',
+            help='Начать с первой беседы, игнорируя точку продолжения'
+        )
+        parser.add_argument(
+            '--skip-changelog', action='store_true',
+            help='Не удалять старые записи журнала синхронизации'
+        )
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Только подсчитать просроченные сообщения, без удаления'
+        )
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size должен быть больше нуля')
+        if options['pause'] < 0 or options['max_runtime'] < 0:
+            raise CommandError('--pause и --max-runtime не могут быть отрицательными')
+
+        self.verbosity = options['verbosity']
+        self.batch_size = options['batch_size']
+        self.pause = options['pause']
+        self.deadline = time.monotonic() + options['max_runtime'] if options['max_runtime'] else None
+
+        if options['restart']:
+            clear_checkpoint()
+
+        if options['dry_run']:
+            self.stdout.write(self.style.WARNING('Режим dry-run: данные не будут удалены'))
+            self.report_expired()
+            return
+
+        finished = self.purge_messages()
+        if finished and not options['skip_changelog']:
+            self.prune_changelog()
+
+    def purge_messages(self):
+        """Обходит беседы по id; возвращает False, если остановлена по --max-runtime"""
+        checkpoint = load_checkpoint()
+        if checkpoint:
+            self.stdout.write(f'Продолжение после беседы #{checkpoint}')
+
+        now = timezone.now()
+        total_messages = total_attachments = total_size = 0
+        started = time.monotonic()
+
+        for conversation_id, days in conversations_with_retention(after_id=checkpoint):
+            cutoff = now - timedelta(days=days)
+            deleted = 0
+
+            while True:
+                if self.out_of_time():
+                    self.stdout.write(self.style.WARNING(
+                        f'Остановлено по --max-runtime на беседе #{conversation_id}; '
+                        f'следующий запуск продолжит с нее'
+                    ))
+                    self.report_totals(total_messages, total_attachments, total_size, started)
+                    return False
+
+                messages, attachments, size = purge_batch(conversation_id, cutoff, self.batch_size)
+                deleted += messages
+                total_messages += messages
+                total_attachments += attachments
+                total_size += size
+
+                if messages and self.verbosity >= 2:
+                    self.stdout.write(f'  беседа #{conversation_id}: удалено {deleted}')
+                if messages < self.batch_size:
+                    break
+                time.sleep(self.pause)
+
+            if deleted:
+                self.stdout.write(
+                    f'Беседа #{conversation_id} (срок {days} дн.): удалено сообщений {deleted}; '
+                    f'всего {total_messages}'
+                )
+            save_checkpoint(conversation_id)
+
+        clear_checkpoint()
+        self.report_totals(total_messages, total_attachments, total_size, started)
+        return True
+
+    def prune_changelog(self):
+        cutoff = changelog_cutoff()
+        total = 0
+        while not self.out_of_time():
+            deleted = prune_changelog_batch(cutoff, self.batch_size)
+            total += deleted
+            if deleted < self.batch_size:
+                break
+            time.sleep(self.pause)
+        self.stdout.write(self.style.SUCCESS(f'Удалено записей журнала синхронизации: {total}'))
+
+    def report_expired(self):
+        now = timezone.now()
+        total = 0
+        for conversation_id, days in conversations_with_retention():
+            count = expired_messages(conversation_id, now - timedelta(days=days)).count()
+            if count:
+                self.stdout.write(f'Беседа #{conversation_id} (срок {days} дн.): просрочено сообщений {count}')
+            total += count
+        self.stdout.write(self.style.SUCCESS(f'Всего просроченных сообщений: {total}'))
+
+    def report_totals(self, messages, attachments, size, started):
+        self.stdout.write(self.style.SUCCESS(
+            f'Удалено сообщений: {messages}, вложений: {attachments} ({self.human_size(size)}) '
+            f'за {time.monotonic() - started:.1f} с'
+        ))
+
+    def out_of_time(self):
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    @staticmethod
+    def human_size(size):
+        for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
+            if size < 1024.0:
+                return f"{size:.1f} {unit}"
+            size /= 1024.0
+        return f"{size:.1f} PB"
@@ -0,0 +1,249 @@
+# messenger/management/commands/runasgi.py
+import multiprocessing
+import os
+import signal
+import socket
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+ASGI_APPLICATION = 'messenger.asgi:application'
+
+# Как часто мастер проверяет, живы ли рабочие процессы, секунды
+MONITOR_INTERVAL = 1
+
+# Как часто мастер создает недостающие секции messages (api/partitions.py), секунды
+PARTITIONS_CHECK_INTERVAL = 3600
+
+
+def run_worker(config, sockets):
+    """Точка входа рабочего процесса: uvicorn на уже открытых сокетах мастера"""
+    import uvicorn
+
+    uvicorn.Server(uvicorn.Config(ASGI_APPLICATION, **config)).run(sockets=sockets)
+
+
+class WorkerPool:
+    """Группа рабочих процессов с общими слушающими сокетами и одинаковой конфигурацией"""
+
+    def __init__(self, name, size, config, sockets, context):
+        self.name = name
+        self.size = size
+        self.config = config
+        self.sockets = sockets
+        self.context = context
+        self.processes = []
+
+    def spawn(self):
+        process = self.context.Process(
+            target=run_worker,
+            args=(self.config, self.sockets),
+            name=f'asgi-{self.name}',
+        )
+        process.start()
+        return process
+
+    def start(self):
+        self.processes = [self.spawn() for _ in range(self.size)]
+
+    def replace_dead(self, stdout):
+        for index, process in enumerate(self.processes):
+            if not process.is_alive():
+                stdout.write(f'[{self.name}] процесс {process.pid} завершился с кодом {process.exitcode}, перезапуск')
+                self.processes[index] = self.spawn()
+
+    def reload(self, grace):
+        """
+        Плавный перезапуск: новое поколение начинает принимать соединения
+        с тех же сокетов, и только после этого старое получает SIGTERM
+        (WebSocket соединения при этом закрываются постепенно, см. api/draining.py)
+        """
+        old = self.processes
+        self.start()
+        stop_processes(old, grace)
+
+    def stop(self, grace):
+        stop_processes(self.processes, grace)
+        self.processes = []
+
+
+def stop_processes(processes, grace):
+    for process in processes:
+        if process.is_alive():
+            os.kill(process.pid, signal.SIGTERM)
+
+    deadline = time.monotonic() + grace
+    for process in processes:
+        process.join(max(0, deadline - time.monotonic()))
+        if process.is_alive():
+            process.kill()
+            process.join()
+
+
+def process_local_settings():
+    """
+    Настройки, состояние которых живет внутри одного процесса. С ними несколько
+    процессов работают неправильно: например, событие, отправленное через слой
+    каналов в памяти, не доходит до WebSocket соединений другого процесса.
+    """
+    problems = []
+    if settings.CHANNEL_LAYERS.get('default', {}).get('BACKEND') == 'channels.layers.InMemoryChannelLayer':
+        problems.append('слой каналов в памяти процесса (задайте REDIS_URL)')
+    if getattr(settings, 'AUTH_USER_CACHE_BACKEND', 'local') == 'local':
+        problems.append('кэш пользователей в памяти процесса (AUTH_USER_CACHE_BACKEND)')
+    if getattr(settings, 'MEMBERSHIP_CACHE_BACKEND', 'local') == 'local':
+        problems.append('кэш членства в беседах в памяти процесса (MEMBERSHIP_CACHE_BACKEND)')
+    if getattr(settings, 'PRESENCE_BACKEND', 'local') == 'local':
+        problems.append('счетчики присутствия в памяти процесса (PRESENCE_BACKEND)')
+    return problems
+
+
+def bind_socket(host, port, backlog):
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+class Command(BaseCommand):
+    help = (
+        'Запускает production ASGI сервер: несколько процессов uvicorn на общих сокетах, '
+        'опционально отдельный пул для WebSocket. SIGHUP - плавный перезапуск, SIGTERM - остановка'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default=os.getenv('ASGI_HOST', '0.0.0.0'))
+        parser.add_argument('--port', type=int, default=int(os.getenv('ASGI_PORT', 8000)))
+        parser.add_argument(
+            '--workers', type=int, default=getattr(settings, 'ASGI_WORKERS', 0),
+            help='Количество процессов для HTTP (0 - по числу ядер, если состояние процессов общее)'
+        )
+        parser.add_argument(
+            '--ws-workers', type=int, default=getattr(settings, 'ASGI_WS_WORKERS', 0),
+            help='Количество процессов для WebSocket на --ws-port (0 - WebSocket обслуживает HTTP пул)'
+        )
+        parser.add_argument('--ws-port', type=int, default=int(os.getenv('ASGI_WS_PORT', 8001)))
+        parser.add_argument(
+            '--limit-concurrency', type=int, default=getattr(settings, 'ASGI_LIMIT_CONCURRENCY', None),
+            help='Максимум одновременных соединений и задач на HTTP процесс (сверх лимита - 503)'
+        )
+        parser.add_argument(
+            '--ws-limit-concurrency', type=int, default=getattr(settings, 'ASGI_WS_LIMIT_CONCURRENCY', None),
+            help='Максимум одновременных соединений на WebSocket процесс'
+        )
+        parser.add_argument('--backlog', type=int, default=2048)
+        parser.add_argument(
+            '--graceful-timeout', type=int, default=getattr(settings, 'ASGI_GRACEFUL_TIMEOUT', 45),
+            help='Сколько ждать завершения процесса после SIGTERM, секунды'
+        )
+
+    def handle(self, *args, **options):
+        try:
+            import uvicorn  # noqa: F401
+        except ImportError:
+            raise CommandError('Для runasgi нужен uvicorn (см. requirements.txt)')
+
+        workers = options['workers']
+        ws_workers = options['ws_workers']
+
+        problems = process_local_settings()
+        if problems:
+            if workers > 1 or ws_workers:
+                raise CommandError(
+                    'Нельзя запустить несколько процессов: ' + '; '.join(problems)
+                )
+            workers = 1
+            self.stderr.write('Запускается один процесс: ' + '; '.join(problems))
+        else:
+            workers = workers or os.cpu_count() or 1
+        grace = options['graceful_timeout']
+        # Процессы читают срок из настроек, чтобы уложить в него закрытие WebSocket соединений
+        os.environ['ASGI_GRACEFUL_TIMEOUT'] = str(grace)
+        context = multiprocessing.get_context('spawn')
+
+        common = {
+            'lifespan': 'off',
+            'proxy_headers': True,
+            'forwarded_allow_ips': '*',
+            # Время на завершение запросов и постепенное закрытие WebSocket после SIGTERM
+            'timeout_graceful_shutdown': grace,
+        }
+        websocket = {
+            'ws': 'websockets',
+            'ws_per_message_deflate': True,
+        }
+
+        http_socket = bind_socket(options['host'], options['port'], options['backlog'])
+        pools = [WorkerPool(
+            'http', workers,
+            dict(common, limit_concurrency=options['limit_concurrency'],
+                 **({'ws': 'none'} if ws_workers else websocket)),
+            [http_socket], context,
+        )]
+
+        if ws_workers:
+            ws_socket = bind_socket(options['host'], options['ws_port'], options['backlog'])
+            pools.append(WorkerPool(
+                'ws', ws_workers,
+                dict(common, limit_concurrency=options['ws_limit_concurrency'], **websocket),
+                [ws_socket], context,
+            ))
+
+        for pool in pools:
+            pool.start()
+            self.stdout.write(
+                f'[{pool.name}] {pool.size} процессов на '
+                f'{pool.sockets[0].getsockname()[0]}:{pool.sockets[0].getsockname()[1]}'
+            )
+
+        self.run_master(pools, grace)
+
+    def run_master(self, pools, grace):
+        pending = []
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+            signal.signal(signum, lambda signum, frame: pending.append(signum))
+
+        next_partitions_check = 0
+
+        while True:
+            if time.monotonic() >= next_partitions_check:
+                self.maintain_partitions()
+                next_partitions_check = time.monotonic() + PARTITIONS_CHECK_INTERVAL
+
+            time.sleep(MONITOR_INTERVAL)
+
+            while pending:
+                signum = pending.pop(0)
+                if signum == signal.SIGHUP:
+                    self.stdout.write('SIGHUP: плавный перезапуск процессов')
+                    for pool in pools:
+                        pool.reload(grace)
+                else:
+                    self.stdout.write('Остановка: ожидание завершения процессов')
+                    for pool in pools:
+                        pool.stop(grace)
+                    return
+
+            for pool in pools:
+                pool.replace_dead(self.stdout)
+
+    def maintain_partitions(self):
+        """Заранее создает секции messages на ближайшие месяцы; ошибка не мешает работе процессов"""
+        from django.db import connection
+        from api.partitions import is_partitioned, ensure_partitions
+
+        try:
+            if is_partitioned():
+                for name in ensure_partitions(settings.MESSAGES_PARTITIONS_AHEAD):
+                    self.stdout.write(f'Создана секция {name}')
+        except Exception as e:
+            self.stderr.write(f'Не удалось проверить секции messages: {e}')
+        finally:
+            # Мастер не обслуживает запросы и не держит соединений между проверками
+            connection.close()
+            if connection.settings_dict['OPTIONS'].get('pool'):
+                connection.close_pool()
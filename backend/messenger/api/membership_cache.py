@@ -0,0 +1,185 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+from .db_routers import PRIMARY_DB
+
+
+class LocalMembershipBackend:
+    """
+    Кэш членства в беседах внутри процесса.
+    Каждая инвалидация увеличивает версию пользователя, поэтому набор,
+    прочитанный из БД до инвалидации, не попадет в кэш после нее.
+    """
+
+    def __init__(self, max_size=10000, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # user_id -> (version, expires_at, ids)
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def version(self, user_id):
+        with self._lock:
+            return self._versions.get(user_id, 0)
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+
+            version, expires_at, ids = entry
+            if version != self._versions.get(user_id, 0) or expires_at < time.monotonic():
+                del self._entries[user_id]
+                return None
+
+            self._entries.move_to_end(user_id)
+            return ids
+
+    def set(self, user_id, version, ids):
+        with self._lock:
+            if version != self._versions.get(user_id, 0):
+                return
+            self._entries[user_id] = (version, time.monotonic() + self.ttl, ids)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._versions[user_id] = self._versions.get(user_id, 0) + 1
+            self._entries.pop(user_id, None)
+
+    # Все операции выполняются в памяти, отдельный поток не нужен
+    async def aversion(self, user_id):
+        return self.version(user_id)
+
+    async def aget(self, user_id):
+        return self.get(user_id)
+
+    async def aset(self, user_id, version, ids):
+        self.set(user_id, version, ids)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._versions.clear()
+
+
+class SharedMembershipBackend:
+    """
+    Кэш членства в общем кэше Django (например, Redis) для нескольких процессов.
+    Набор хранится под ключом с версией, инвалидация увеличивает версию.
+    """
+
+    def __init__(self, alias, ttl=300):
+        self.alias = alias
+        self.ttl = ttl
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def _version_key(self, user_id):
+        return f'acl:ver:{user_id}'
+
+    def _ids_key(self, user_id, version):
+        return f'acl:ids:{user_id}:{version}'
+
+    def version(self, user_id):
+        return self.cache.get(self._version_key(user_id), 0)
+
+    def get(self, user_id):
+        ids = self.cache.get(self._ids_key(user_id, self.version(user_id)))
+        return frozenset(ids) if ids is not None else None
+
+    def set(self, user_id, version, ids):
+        self.cache.set(self._ids_key(user_id, version), list(ids), self.ttl)
+
+    def invalidate(self, user_id):
+        key = self._version_key(user_id)
+        # Версия живет без срока, чтобы не вернуться к старому набору
+        self.cache.add(key, 0, None)
+        self.cache.incr(key)
+
+    async def aversion(self, user_id):
+        return await self.cache.aget(self._version_key(user_id), 0)
+
+    async def aget(self, user_id):
+        version = await self.aversion(user_id)
+        ids = await self.cache.aget(self._ids_key(user_id, version))
+        return frozenset(ids) if ids is not None else None
+
+    async def aset(self, user_id, version, ids):
+        await self.cache.aset(self._ids_key(user_id, version), list(ids), self.ttl)
+
+    def clear(self):
+        pass
+
+
+def _create_backend():
+    alias = getattr(settings, 'MEMBERSHIP_CACHE_BACKEND', 'local')
+    ttl = getattr(settings, 'MEMBERSHIP_CACHE_TTL', 300)
+    if alias == 'local':
+        return LocalMembershipBackend(
+            max_size=getattr(settings, 'MEMBERSHIP_CACHE_SIZE', 10000),
+            ttl=ttl,
+        )
+    return SharedMembershipBackend(alias, ttl=ttl)
+
+
+membership_backend = _create_backend()
+
+
+def _membership_queryset(user_id):
+    from .models import ConversationMember
+    # Из основной БД: устаревший набор с реплики остался бы в кэше до конца TTL
+    return ConversationMember.objects.using(PRIMARY_DB).filter(user_id=user_id).values_list('conversation_id', flat=True)
+
+
+def get_conversation_ids(user_id):
+    """Множество id бесед, в которых состоит пользователь"""
+    if user_id is None:
+        return frozenset()
+
+    ids = membership_backend.get(user_id)
+    if ids is None:
+        version = membership_backend.version(user_id)
+        ids = frozenset(_membership_queryset(user_id))
+        membership_backend.set(user_id, version, ids)
+    return ids
+
+
+async def aget_conversation_ids(user_id):
+    """Асинхронный вариант get_conversation_ids для consumers"""
+    if user_id is None:
+        return frozenset()
+
+    ids = await membership_backend.aget(user_id)
+    if ids is None:
+        version = await membership_backend.aversion(user_id)
+        ids = frozenset([conversation_id async for conversation_id in _membership_queryset(user_id)])
+        await membership_backend.aset(user_id, version, ids)
+    return ids
+
+
+def is_member(user_id, conversation_id):
+    return conversation_id in get_conversation_ids(user_id)
+
+
+async def ais_member(user_id, conversation_id):
+    return conversation_id in await aget_conversation_ids(user_id)
+
+
+def invalidate_user(user_id):
+    """
+    Сбрасывает кэш членства пользователя сразу и повторно после коммита,
+    чтобы параллельный запрос не закэшировал состояние до коммита
+    """
+    membership_backend.invalidate(user_id)
+    transaction.on_commit(lambda: membership_backend.invalidate(user_id))
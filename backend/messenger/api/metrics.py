@@ -0,0 +1,168 @@
+"""
+Простые метрики процесса: счетчики и измерители в памяти.
+Отдаются staff пользователям через эндпоинт metrics/.
+
+Снимок помечается процессом (worker). При нескольких процессах runasgi
+каждый процесс периодически записывает свой снимок в общий кэш
+(METRICS_BACKEND), и metrics/ возвращает сумму по живым процессам вместе с
+разбивкой. С METRICS_BACKEND = 'local' metrics/ отдает метрики только
+процесса, принявшего запрос: значения разных worker нужно суммировать.
+"""
+import asyncio
+import logging
+import os
+import socket
+import threading
+
+from django.conf import settings
+from django.core.cache import caches
+
+logger = logging.getLogger(__name__)
+
+
+def worker_id():
+    """Процесс в метриках; pid берется при вызове, так как процессы runasgi порождаются после импорта"""
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._counters = {}
+        self._gauges = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def gauge_add(self, name, value):
+        with self._lock:
+            self._gauges[name] = self._gauges.get(name, 0) + value
+
+    def gauge_set(self, name, value):
+        with self._lock:
+            self._gauges[name] = value
+
+    def gauge_max(self, name, value):
+        """Запоминает максимальное наблюдавшееся значение"""
+        with self._lock:
+            if value > self._gauges.get(name, 0):
+                self._gauges[name] = value
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'worker': worker_id(),
+                'counters': dict(self._counters),
+                'gauges': dict(self._gauges),
+            }
+
+
+metrics = MetricsRegistry()
+
+
+def aggregate(snapshots):
+    """Сумма снимков процессов; измерители *_max - максимум, а не сумма"""
+    counters = {}
+    gauges = {}
+    for snapshot in snapshots:
+        for name, value in snapshot['counters'].items():
+            counters[name] = counters.get(name, 0) + value
+        for name, value in snapshot['gauges'].items():
+            if name.endswith('_max'):
+                gauges[name] = max(gauges.get(name, value), value)
+            else:
+                gauges[name] = gauges.get(name, 0) + value
+    return {'counters': counters, 'gauges': gauges}
+
+
+class SharedMetrics:
+    """
+    Снимки метрик процессов в общем кэше. Снимок живет три интервала записи,
+    поэтому снимок остановленного или упавшего процесса пропадает из суммы сам
+    """
+    WORKERS_KEY = 'metrics:workers'
+
+    def __init__(self, alias, interval):
+        self.alias = alias
+        self.interval = interval
+        self._publisher = None
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    @staticmethod
+    def _key(worker):
+        return f'metrics:worker:{worker}'
+
+    async def apublish(self, registry):
+        snapshot = registry.snapshot()
+        worker = snapshot['worker']
+        await self.cache.aset(self._key(worker), snapshot, self.interval * 3)
+        # Список процессов без блокировок: процесс, потерянный при гонке, вернет себя следующей записью
+        workers = await self.cache.aget(self.WORKERS_KEY) or []
+        if worker not in workers:
+            await self.cache.aset(self.WORKERS_KEY, workers + [worker], None)
+
+    def collect(self):
+        """Снимки живых процессов: worker -> снимок"""
+        workers = self.cache.get(self.WORKERS_KEY) or []
+        found = self.cache.get_many([self._key(worker) for worker in workers])
+        snapshots = {worker: found[self._key(worker)] for worker in workers if self._key(worker) in found}
+        if len(snapshots) < len(workers):
+            self.cache.set(self.WORKERS_KEY, list(snapshots), None)
+        return snapshots
+
+    def ensure_publisher(self, registry):
+        """Запускает периодическую запись снимка в текущем event loop"""
+        if self._publisher is None or self._publisher.done():
+            self._publisher = asyncio.get_running_loop().create_task(self._publish_loop(registry))
+
+    async def _publish_loop(self, registry):
+        while True:
+            try:
+                await self.apublish(registry)
+            except Exception:
+                logger.exception("Error publishing metrics snapshot")
+            await asyncio.sleep(self.interval)
+
+
+def _create_shared_metrics():
+    alias = getattr(settings, 'METRICS_BACKEND', 'local')
+    if alias == 'local':
+        return None
+    return SharedMetrics(alias, interval=getattr(settings, 'METRICS_PUBLISH_INTERVAL', 10))
+
+
+shared_metrics = _create_shared_metrics()
+
+
+def ensure_metrics_publisher():
+    if shared_metrics is not None:
+        shared_metrics.ensure_publisher(metrics)
+
+
+def metrics_report():
+    """Данные для metrics/: сумма по процессам, если снимки собираются в общем кэше"""
+    data = metrics.snapshot()
+    if shared_metrics is None:
+        return data
+
+    workers = shared_metrics.collect()
+    # Свой снимок - текущий, а не записанный до интервала назад
+    workers[data['worker']] = data
+    return {**aggregate(workers.values()), 'workers': workers}
+
+
+def database_pool_stats():
+    """Статистика пулов соединений с БД текущего процесса (psycopg_pool.get_stats)"""
+    from django.db import connections
+
+    stats = {}
+    for alias in connections:
+        connection = connections[alias]
+        if connection.vendor != 'postgresql' or not getattr(connection, 'pool', None):
+            continue
+        stats[alias] = connection.pool.get_stats()
+    return stats
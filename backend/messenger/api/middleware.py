@@ -11,22 +11,21 @@ class WebSocketRemoteUserMiddleware(BaseMiddleware):
     async def __call__(self, scope, receive, send):
         # Ленивый импорт User, чтобы избежать AppRegistryNotReady
         from django.contrib.auth import get_user_model
+        from .user_cache import aget_user_by_username
         User = get_user_model()
 
-        # 1. Извлекаем заголовки из scope (WebSocket-подключение)
-        headers = dict(scope.get("headers", []))
-
-        # 2. Ищем заголовок 'x-remote-user' (в Channels они в bytes)
+        # 1. Ищем заголовок 'x-remote-user' (в Channels они в bytes)
+        #    прямо в списке заголовков scope, без построения словаря
         remote_user = None
-        for header_name, header_value in headers.items():
+        for header_name, header_value in scope.get("headers", []):
             if header_name.lower() == b'x-remote-user':
                 remote_user = header_value.decode()
                 break
 
-        # 3. Аутентифицируем пользователя
+        # 2. Аутентифицируем пользователя
         if remote_user:
             try:
-                scope["user"] = await User.objects.aget(username=remote_user)
+                scope["user"] = await aget_user_by_username(remote_user)
             except User.DoesNotExist:
                 scope["user"] = AnonymousUser()
         else:
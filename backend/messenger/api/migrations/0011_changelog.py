@@ -0,0 +1,32 @@
+# Generated by Django 5.2.4 on 2026-10-19 05:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_alter_messageattachment_message'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChangeLog',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('entity', models.CharField(choices=[('conversation', 'Беседа'), ('member', 'Участник беседы'), ('message', 'Сообщение'), ('profile', 'Профиль пользователя')], max_length=20, verbose_name='Сущность')),
+                ('action', models.CharField(choices=[('upsert', 'Создание или изменение'), ('delete', 'Удаление')], max_length=10, verbose_name='Действие')),
+                ('object_id', models.BigIntegerField(verbose_name='ID объекта')),
+                ('conversation_id', models.BigIntegerField(blank=True, db_index=True, null=True, verbose_name='ID беседы')),
+                ('user_id', models.BigIntegerField(blank=True, db_index=True, null=True, verbose_name='ID пользователя')),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='Дата изменения')),
+            ],
+            options={
+                'verbose_name': 'Изменение',
+                'verbose_name_plural': 'Журнал изменений',
+                'db_table': 'sync_changes',
+                'ordering': ['id'],
+                'indexes': [models.Index(fields=['entity', 'object_id'], name='sync_changes_entity_obj_idx')],
+            },
+        ),
+    ]
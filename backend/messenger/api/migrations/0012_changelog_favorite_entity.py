@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-19 05:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_changelog'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='changelog',
+            name='entity',
+            field=models.CharField(choices=[('conversation', 'Беседа'), ('member', 'Участник беседы'), ('message', 'Сообщение'), ('profile', 'Профиль пользователя'), ('favorite', 'Избранный контакт')], max_length=20, verbose_name='Сущность'),
+        ),
+    ]
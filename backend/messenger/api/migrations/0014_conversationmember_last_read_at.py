@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-19 05:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0013_message_client_message_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversationmember',
+            name='last_read_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Прочитано до'),
+        ),
+    ]
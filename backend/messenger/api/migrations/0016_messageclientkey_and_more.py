@@ -0,0 +1,76 @@
+# Generated by Django 5.2.4 on 2026-10-19 06:07
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def fill_client_keys(apps, schema_editor):
+    Message = apps.get_model('api', 'Message')
+    MessageClientKey = apps.get_model('api', 'MessageClientKey')
+
+    messages = Message.objects.filter(client_message_id__isnull=False).values_list(
+        'id', 'sender_id', 'client_message_id'
+    ).iterator(chunk_size=2000)
+
+    batch = []
+    for message_id, sender_id, client_message_id in messages:
+        batch.append(MessageClientKey(
+            message_id=message_id, sender_id=sender_id, client_message_id=client_message_id
+        ))
+        if len(batch) >= 2000:
+            MessageClientKey.objects.bulk_create(batch)
+            batch = []
+    if batch:
+        MessageClientKey.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0015_message_version'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageClientKey',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('client_message_id', models.CharField(max_length=64, verbose_name='Клиентский идентификатор')),
+            ],
+            options={
+                'verbose_name': 'Клиентский идентификатор сообщения',
+                'verbose_name_plural': 'Клиентские идентификаторы сообщений',
+                'db_table': 'message_client_keys',
+            },
+        ),
+        migrations.RemoveConstraint(
+            model_name='message',
+            name='messages_sender_client_id_uniq',
+        ),
+        migrations.AlterField(
+            model_name='messageattachment',
+            name='message',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='attachments', to='api.message', verbose_name='Сообщение'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(condition=models.Q(('client_message_id__isnull', False)), fields=['sender', 'client_message_id'], name='messages_sender_client_id_idx'),
+        ),
+        migrations.AddField(
+            model_name='messageclientkey',
+            name='message',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='api.message', verbose_name='Сообщение'),
+        ),
+        migrations.AddField(
+            model_name='messageclientkey',
+            name='sender',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='Отправитель'),
+        ),
+        migrations.AddConstraint(
+            model_name='messageclientkey',
+            constraint=models.UniqueConstraint(fields=('sender', 'client_message_id'), name='message_client_keys_uniq'),
+        ),
+        migrations.RunPython(fill_client_keys, migrations.RunPython.noop),
+    ]
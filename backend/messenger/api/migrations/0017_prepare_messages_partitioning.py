@@ -0,0 +1,73 @@
+from django.db import migrations
+
+# Уникальный индекс, который станет первичным ключом (id, sent_at) секции messages_legacy
+PARTITION_KEY_INDEX = 'messages_id_sent_at_key'
+# Проверочное ограничение на диапазон sent_at будущей секции messages_legacy
+LEGACY_RANGE_CONSTRAINT = 'messages_legacy_range'
+
+
+def prepare_messages_partitioning(apps, schema_editor):
+    """
+    Готовит messages к секционированию без долгих блокировок: все, что требует
+    чтения всей таблицы, выполняется здесь, вне транзакции и без ACCESS EXCLUSIVE.
+    Следующая миграция только переключает метаданные.
+
+    - уникальный индекс (id, sent_at) строится CONCURRENTLY и затем становится
+      первичным ключом секции через USING INDEX;
+    - ограничение на диапазон sent_at добавляется NOT VALID и проверяется
+      VALIDATE CONSTRAINT (SHARE UPDATE EXCLUSIVE не мешает чтению и записи);
+      по нему ATTACH PARTITION не просматривает таблицу.
+    """
+    connection = schema_editor.connection
+    if connection.vendor != 'postgresql':
+        return
+
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass('messages')")
+        if cursor.fetchone():
+            return
+
+        # Прерванный CREATE INDEX CONCURRENTLY оставляет невалидный индекс
+        cursor.execute(
+            "SELECT x.indisvalid FROM pg_index x WHERE x.indexrelid = to_regclass(%s)", [PARTITION_KEY_INDEX]
+        )
+        row = cursor.fetchone()
+        if row and not row[0]:
+            cursor.execute(f'DROP INDEX CONCURRENTLY "{PARTITION_KEY_INDEX}"')
+            row = None
+        if row is None:
+            cursor.execute(f'CREATE UNIQUE INDEX CONCURRENTLY "{PARTITION_KEY_INDEX}" ON messages (id, sent_at)')
+
+        cursor.execute(
+            "SELECT 1 FROM pg_constraint WHERE conrelid = 'messages'::regclass AND conname = %s",
+            [LEGACY_RANGE_CONSTRAINT]
+        )
+        if not cursor.fetchone():
+            # Граница - начало следующего месяца (в часовом поясе сессии): строки,
+            # вставленные до переключения, в нее укладываются
+            cursor.execute("""
+                SELECT to_char(
+                    date_trunc('month', GREATEST(now(), MAX(sent_at))) + interval '1 month',
+                    'YYYY-MM-DD HH24:MI:SS'
+                ) FROM messages
+            """)
+            (legacy_upper,) = cursor.fetchone()
+            cursor.execute(
+                f'ALTER TABLE messages ADD CONSTRAINT "{LEGACY_RANGE_CONSTRAINT}" '
+                f"CHECK (sent_at IS NOT NULL AND sent_at < '{legacy_upper}') NOT VALID"
+            )
+
+        cursor.execute(f'ALTER TABLE messages VALIDATE CONSTRAINT "{LEGACY_RANGE_CONSTRAINT}"')
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY не выполняется в транзакции
+    atomic = False
+
+    dependencies = [
+        ('api', '0016_messageclientkey_and_more'),
+    ]
+
+    operations = [
+        migrations.RunPython(prepare_messages_partitioning, migrations.RunPython.noop),
+    ]
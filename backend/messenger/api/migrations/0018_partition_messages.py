@@ -0,0 +1,152 @@
+import re
+
+from django.db import migrations
+from django.utils.dateparse import parse_datetime
+
+# Сколько будущих месяцев получают секции сразу; дальше их создает
+# manage_message_partitions (и периодическая проверка в runasgi)
+MONTHS_AHEAD = 3
+
+# Подготовлены миграцией 0017
+PARTITION_KEY_INDEX = 'messages_id_sent_at_key'
+LEGACY_RANGE_CONSTRAINT = 'messages_legacy_range'
+
+
+def add_months(value, months):
+    month = value.month - 1 + months
+    return value.replace(year=value.year + month // 12, month=month % 12 + 1)
+
+
+def literal(value):
+    return f"'{value:%Y-%m-%d %H:%M:%S}'"
+
+
+def legacy_upper_bound(cursor):
+    """Верхняя граница секции messages_legacy из проверочного ограничения миграции 0017"""
+    cursor.execute(
+        "SELECT pg_get_constraintdef(oid) FROM pg_constraint WHERE conrelid = 'messages'::regclass AND conname = %s",
+        [LEGACY_RANGE_CONSTRAINT]
+    )
+    (definition,) = cursor.fetchone()
+    # Время в часовом поясе сессии; литералы ниже интерпретируются в нем же
+    return parse_datetime(re.search(r"'([^']+)'", definition).group(1)).replace(tzinfo=None)
+
+
+def partition_messages(apps, schema_editor):
+    """
+    Превращает messages в таблицу, секционированную по месяцам sent_at.
+    Данные не копируются: прежняя таблица целиком становится секцией
+    messages_legacy до начала следующего месяца.
+
+    Миграция держит ACCESS EXCLUSIVE на messages, поэтому в ней нет операций,
+    читающих всю таблицу: первичный ключ (id, sent_at) переключается на индекс,
+    построенный CONCURRENTLY, ATTACH опирается на уже проверенное ограничение
+    диапазона, а внешние ключи секции остаются прежними (см. ниже).
+    """
+    connection = schema_editor.connection
+    if connection.vendor != 'postgresql':
+        return
+
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass('messages')")
+        if cursor.fetchone():
+            return
+
+        cursor.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM messages")
+        (next_id,) = cursor.fetchone()
+        legacy_upper = legacy_upper_bound(cursor)
+
+        cursor.execute(
+            "SELECT is_identity, pg_get_serial_sequence('messages', 'id') FROM information_schema.columns "
+            "WHERE table_schema = current_schema() AND table_name = 'messages' AND column_name = 'id'"
+        )
+        is_identity, sequence = cursor.fetchone()
+
+        cursor.execute("ALTER TABLE messages RENAME TO messages_legacy")
+
+        # Последовательность id переходит к новой таблице
+        if is_identity == 'YES':
+            cursor.execute("ALTER TABLE messages_legacy ALTER COLUMN id DROP IDENTITY")
+        else:
+            cursor.execute("ALTER TABLE messages_legacy ALTER COLUMN id DROP DEFAULT")
+            if sequence:
+                cursor.execute(f"DROP SEQUENCE {sequence}")
+
+        # Имена индексов уникальны в схеме: индексы секции переименовываются,
+        # а исходные имена (их знают миграции Django) получают индексы родителя
+        cursor.execute("""
+            SELECT c.conname FROM pg_constraint c
+            WHERE c.conrelid = 'messages_legacy'::regclass AND c.contype = 'p'
+        """)
+        (pkey,) = cursor.fetchone()
+        # Первичный ключ секции должен совпадать с ключом родителя (id, sent_at);
+        # USING INDEX только меняет метаданные, индекс уже построен
+        cursor.execute(
+            f'ALTER TABLE messages_legacy DROP CONSTRAINT "{pkey}", '
+            f'ADD CONSTRAINT messages_legacy_pkey PRIMARY KEY USING INDEX "{PARTITION_KEY_INDEX}"'
+        )
+
+        cursor.execute("""
+            SELECT i.relname, pg_get_indexdef(i.oid) FROM pg_index x
+            JOIN pg_class i ON i.oid = x.indexrelid
+            WHERE x.indrelid = 'messages_legacy'::regclass
+              AND NOT EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conindid = x.indexrelid)
+        """)
+        indexes = cursor.fetchall()
+        for name, _ in indexes:
+            cursor.execute(f'ALTER INDEX "{name}" RENAME TO "{name[:50]}_legacy"')
+
+        cursor.execute("""
+            SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint
+            WHERE conrelid = 'messages_legacy'::regclass AND contype = 'f'
+        """)
+        foreign_keys = cursor.fetchall()
+
+        cursor.execute(f"CREATE SEQUENCE messages_id_seq START WITH {next_id}")
+        cursor.execute("""
+            CREATE TABLE messages (
+                LIKE messages_legacy INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING STORAGE INCLUDING COMMENTS
+            ) PARTITION BY RANGE (sent_at)
+        """)
+        # LIKE копирует и ограничение диапазона, родителю оно не нужно
+        cursor.execute(f'ALTER TABLE messages DROP CONSTRAINT "{LEGACY_RANGE_CONSTRAINT}"')
+        cursor.execute("ALTER TABLE messages ALTER COLUMN id SET DEFAULT nextval('messages_id_seq')")
+        cursor.execute("ALTER SEQUENCE messages_id_seq OWNED BY messages.id")
+        # Уникальный ключ секционированной таблицы обязан включать ключ секционирования
+        cursor.execute(f'ALTER TABLE messages ADD CONSTRAINT "{pkey}" PRIMARY KEY (id, sent_at)')
+
+        # Родитель пока пуст, поэтому внешние ключи на нем не проверяют строк. NOT VALID для
+        # секционированных таблиц PostgreSQL не поддерживает, но и не нужен: при ATTACH
+        # совпадающие и уже проверенные внешние ключи messages_legacy присоединяются без проверки
+        for name, definition in foreign_keys:
+            cursor.execute(f'ALTER TABLE messages ADD CONSTRAINT "{name}" {definition}')
+        for name, definition in indexes:
+            cursor.execute(re.sub(r' ON (\S+\.)?messages_legacy ', r' ON \1messages ', definition, count=1))
+
+        # Проверенное ограничение диапазона избавляет ATTACH от просмотра таблицы
+        cursor.execute(
+            "ALTER TABLE messages ATTACH PARTITION messages_legacy "
+            f"FOR VALUES FROM (MINVALUE) TO ({literal(legacy_upper)})"
+        )
+        cursor.execute(f'ALTER TABLE messages_legacy DROP CONSTRAINT "{LEGACY_RANGE_CONSTRAINT}"')
+
+        cursor.execute("CREATE TABLE messages_default PARTITION OF messages DEFAULT")
+        for offset in range(MONTHS_AHEAD):
+            lower = add_months(legacy_upper, offset)
+            cursor.execute(
+                f"CREATE TABLE messages_p{lower:%Y%m} PARTITION OF messages "
+                f"FOR VALUES FROM ({literal(lower)}) TO ({literal(add_months(lower, 1))})"
+            )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0017_prepare_messages_partitioning'),
+    ]
+
+    operations = [
+        # Обратного преобразования нет: секционированная таблица совместима
+        # с предыдущими версиями моделей
+        migrations.RunPython(partition_messages, migrations.RunPython.noop),
+    ]
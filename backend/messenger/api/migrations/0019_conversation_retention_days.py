@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-19 06:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0018_partition_messages'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='retention_days',
+            field=models.PositiveIntegerField(blank=True, help_text='Пусто - срок по типу беседы (MESSAGES_RETENTION_DAYS), 0 - хранить бессрочно', null=True, verbose_name='Срок хранения сообщений (дней)'),
+        ),
+    ]
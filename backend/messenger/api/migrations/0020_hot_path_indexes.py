@@ -0,0 +1,63 @@
+# Generated by Django 5.2.4 on 2026-10-19 06:17
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0019_conversation_retention_days'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(fields=['-last_message_at'], name='conversations_last_msg_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['conversation', 'sent_at', 'id'], name='messages_conv_sent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='messageattachment',
+            index=models.Index(condition=models.Q(('message__isnull', True)), fields=['uploaded_at'], name='attachments_unlinked_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userfavorite',
+            index=models.Index(fields=['user', 'friend'], name='users_fav_user_friend_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userprofile',
+            index=models.Index(fields=['last_seen'], name='users_profiles_last_seen_idx'),
+        ),
+        # Старые индексы внешних ключей покрыты составными индексами выше. AlterField
+        # пересоздал бы и сами внешние ключи с проверкой всей таблицы messages,
+        # поэтому в БД удаляются только индексы
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunSQL(
+                    'DROP INDEX IF EXISTS "messages_conversation_id_5ef638db"',
+                    reverse_sql='CREATE INDEX "messages_conversation_id_5ef638db" ON "messages" ("conversation_id")',
+                ),
+                migrations.RunSQL(
+                    'DROP INDEX IF EXISTS "users_favorites_user_id_ee62fe85"',
+                    reverse_sql='CREATE INDEX "users_favorites_user_id_ee62fe85" ON "users_favorites" ("user_id")',
+                ),
+            ],
+            state_operations=[
+                migrations.AlterField(
+                    model_name='message',
+                    name='conversation',
+                    field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='messages', to='api.conversation', verbose_name='Беседа'),
+                ),
+                migrations.AlterField(
+                    model_name='userfavorite',
+                    name='user',
+                    field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='user', to=settings.AUTH_USER_MODEL, verbose_name='Пользователь'),
+                ),
+            ],
+        ),
+    ]
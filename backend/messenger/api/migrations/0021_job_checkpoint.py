@@ -0,0 +1,26 @@
+# Generated by Django 5.2.4 on 2026-10-19 06:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0020_hot_path_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='JobCheckpoint',
+            fields=[
+                ('name', models.CharField(max_length=100, primary_key=True, serialize=False, verbose_name='Команда')),
+                ('value', models.BigIntegerField(verbose_name='Значение')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Дата изменения')),
+            ],
+            options={
+                'verbose_name': 'Точка продолжения',
+                'verbose_name_plural': 'Точки продолжения',
+                'db_table': 'job_checkpoints',
+            },
+        ),
+    ]
@@ -22,6 +22,9 @@ class UserProfile(models.Model):
 
     class Meta:
         db_table = 'users_profiles'
+        indexes = [
+            models.Index(fields=['last_seen'], name='users_profiles_last_seen_idx'),
+        ]
         verbose_name = _('Профиль пользователя')
         verbose_name_plural = _('Профили пользователей')
 
@@ -47,10 +50,18 @@ class Conversation(models.Model):
                                    verbose_name=_('Создатель'))
     created_at = models.DateTimeField(auto_now_add=True, verbose_name=_('Дата создания'))
     last_message_at = models.DateTimeField(auto_now=True, verbose_name=_('Последнее сообщение'))
+    retention_days = models.PositiveIntegerField(
+        null=True, blank=True,
+        verbose_name=_('Срок хранения сообщений (дней)'),
+        help_text=_('Пусто - срок по типу беседы (MESSAGES_RETENTION_DAYS), 0 - хранить бессрочно')
+    )
 
     class Meta:
         db_table = 'conversations'
         ordering = ['-last_message_at']
+        indexes = [
+            models.Index(fields=['-last_message_at'], name='conversations_last_msg_idx'),
+        ]
         verbose_name = _('Беседа')
         verbose_name_plural = _('Беседы')
 
@@ -86,6 +97,7 @@ class ConversationMember(models.Model):
                                      verbose_name=_('Беседа'))
     role = models.CharField(max_length=10, choices=ROLES, default=MEMBER, verbose_name=_('Роль'))
     joined_at = models.DateTimeField(auto_now_add=True, verbose_name=_('Дата присоединения'))
+    last_read_at = models.DateTimeField(null=True, blank=True, verbose_name=_('Прочитано до'))
 
     class Meta:
         db_table = 'conversation_members'
@@ -99,28 +111,80 @@ class ConversationMember(models.Model):
 
 class Message(models.Model):
     """Модель сообщения"""
+    # Отдельный индекс не нужен: conversation - первая колонка messages_conv_sent_idx
     conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='messages',
-                                     verbose_name=_('Беседа'))
+                                     db_index=False, verbose_name=_('Беседа'))
     sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='sent_messages',
                                verbose_name=_('Отправитель'))
     text = models.TextField(verbose_name=_('Текст сообщения'))
     sent_at = models.DateTimeField(auto_now_add=True, verbose_name=_('Дата отправки'))
     edited_at = models.DateTimeField(null=True, blank=True, verbose_name=_('Дата редактирования'))
     is_edited = models.BooleanField(default=False, verbose_name=_('Отредактировано'))
+    # Идентификатор, сгенерированный клиентом: повторная отправка не создает дубликат
+    client_message_id = models.CharField(max_length=64, null=True, blank=True,
+                                         verbose_name=_('Клиентский идентификатор'))
+    # Увеличивается при каждой правке; клиенты применяют дельты только поверх более старой версии
+    version = models.PositiveIntegerField(default=1, verbose_name=_('Версия'))
 
     class Meta:
         db_table = 'messages'
         ordering = ['sent_at']
         verbose_name = _('Сообщение')
         verbose_name_plural = _('Сообщения')
+        # На PostgreSQL таблица секционирована по sent_at (миграция 0018, api/partitions.py),
+        # поэтому уникальность client_message_id обеспечивает MessageClientKey
+        indexes = [
+            # История беседы по времени и последнее сообщение (sent_at, id - порядок в подзапросе)
+            models.Index(fields=['conversation', 'sent_at', 'id'], name='messages_conv_sent_idx'),
+            models.Index(
+                fields=['sender', 'client_message_id'],
+                condition=models.Q(client_message_id__isnull=False),
+                name='messages_sender_client_id_idx',
+            ),
+        ]
 
     def __str__(self):
         return f"Сообщение от {self.sender.username}"
 
 
+class MessageClientKey(models.Model):
+    """
+    Занятые client_message_id отправителя. Уникальный индекс секционированной
+    таблицы messages обязан включать sent_at, поэтому повторная отправка
+    отсекается здесь: запись создается в одной транзакции с сообщением
+    """
+    sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+', verbose_name=_('Отправитель'))
+    client_message_id = models.CharField(max_length=64, verbose_name=_('Клиентский идентификатор'))
+    # Внешний ключ на секционированную таблицу возможен только по (id, sent_at)
+    message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name='+', db_constraint=False,
+                                verbose_name=_('Сообщение'))
+
+    @classmethod
+    def claim(cls, message):
+        """
+        Занимает client_message_id нового сообщения. Вызывается в той же транзакции,
+        что и создание сообщения: повтор падает здесь с IntegrityError и откатывает
+        вставку сообщения вместе с транзакцией
+        """
+        if message.client_message_id:
+            cls.objects.create(
+                sender_id=message.sender_id, client_message_id=message.client_message_id, message=message
+            )
+
+    class Meta:
+        db_table = 'message_client_keys'
+        verbose_name = _('Клиентский идентификатор сообщения')
+        verbose_name_plural = _('Клиентские идентификаторы сообщений')
+        constraints = [
+            models.UniqueConstraint(fields=['sender', 'client_message_id'], name='message_client_keys_uniq'),
+        ]
+
+
 class MessageAttachment(models.Model):
+    # Вложение может быть загружено заранее и привязано к сообщению позже.
+    # Без ограничения в БД: messages секционирована и не имеет уникального ключа по id
     message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name='attachments',
-                                verbose_name=_('Сообщение'))
+                                null=True, blank=True, db_constraint=False, verbose_name=_('Сообщение'))
     file = models.FileField(
         upload_to='message_attachments/Год %Y/Месяц %m/День %d/',  # Добавляем дату в путь
         verbose_name=_('Файл'),
@@ -146,6 +210,14 @@ class MessageAttachment(models.Model):
 
     class Meta:
         db_table = 'message_attachments'
+        indexes = [
+            # Вложения, так и не привязанные к сообщению (cleanup_attachments)
+            models.Index(
+                fields=['uploaded_at'],
+                condition=models.Q(message__isnull=True),
+                name='attachments_unlinked_idx',
+            ),
+        ]
         verbose_name = _('Вложение сообщения')
         verbose_name_plural = _('Вложения сообщений')
 
@@ -287,10 +359,79 @@ class MessageAttachment(models.Model):
 
 
 class UserFavorite(models.Model):
-    user = models.ForeignKey(User, on_delete=models.DO_NOTHING, related_name='user', verbose_name=_('Пользователь'))
+    # Выборки по user обслуживает составной индекс users_fav_user_friend_idx
+    user = models.ForeignKey(User, on_delete=models.DO_NOTHING, related_name='user', db_index=False,
+                             verbose_name=_('Пользователь'))
     friend = models.ForeignKey(User, on_delete=models.DO_NOTHING, related_name='friend', verbose_name=_('Друг'))
 
     class Meta:
         db_table = 'users_favorites'
+        indexes = [
+            models.Index(fields=['user', 'friend'], name='users_fav_user_friend_idx'),
+        ]
         verbose_name = _('Избранный контакт')
         verbose_name_plural = _('Избранные контакты')
+
+
+class ChangeLog(models.Model):
+    """Журнал изменений для инкрементальной синхронизации клиентов"""
+    CONVERSATION = 'conversation'
+    MEMBER = 'member'
+    MESSAGE = 'message'
+    PROFILE = 'profile'
+    FAVORITE = 'favorite'
+
+    ENTITIES = [
+        (CONVERSATION, _('Беседа')),
+        (MEMBER, _('Участник беседы')),
+        (MESSAGE, _('Сообщение')),
+        (PROFILE, _('Профиль пользователя')),
+        (FAVORITE, _('Избранный контакт')),
+    ]
+
+    UPSERT = 'upsert'
+    DELETE = 'delete'
+
+    ACTIONS = [
+        (UPSERT, _('Создание или изменение')),
+        (DELETE, _('Удаление')),
+    ]
+
+    # Ссылки хранятся числами, а не внешними ключами: записи об удалении
+    # должны пережить удаленные объекты
+    entity = models.CharField(max_length=20, choices=ENTITIES, verbose_name=_('Сущность'))
+    action = models.CharField(max_length=10, choices=ACTIONS, verbose_name=_('Действие'))
+    object_id = models.BigIntegerField(verbose_name=_('ID объекта'))
+    conversation_id = models.BigIntegerField(null=True, blank=True, db_index=True, verbose_name=_('ID беседы'))
+    user_id = models.BigIntegerField(null=True, blank=True, db_index=True, verbose_name=_('ID пользователя'))
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True, verbose_name=_('Дата изменения'))
+
+    class Meta:
+        db_table = 'sync_changes'
+        ordering = ['id']
+        indexes = [
+            models.Index(fields=['entity', 'object_id'], name='sync_changes_entity_obj_idx'),
+        ]
+        verbose_name = _('Изменение')
+        verbose_name_plural = _('Журнал изменений')
+
+    def __str__(self):
+        return f"{self.entity} #{self.object_id}: {self.action}"
+
+
+class JobCheckpoint(models.Model):
+    """
+    Точки продолжения периодических команд (например, purge_expired_messages).
+    Хранятся в БД, чтобы переживать перезапуски и не зависеть от кэша
+    """
+    name = models.CharField(max_length=100, primary_key=True, verbose_name=_('Команда'))
+    value = models.BigIntegerField(verbose_name=_('Значение'))
+    updated_at = models.DateTimeField(auto_now=True, verbose_name=_('Дата изменения'))
+
+    class Meta:
+        db_table = 'job_checkpoints'
+        verbose_name = _('Точка продолжения')
+        verbose_name_plural = _('Точки продолжения')
+
+    def __str__(self):
+        return f"{self.name}: {self.value}"
@@ -0,0 +1,180 @@
+"""
+Помесячное секционирование таблицы messages по sent_at (только PostgreSQL).
+
+Схема после миграции 0018:
+- messages - секционированная таблица с первичным ключом (id, sent_at);
+- messages_legacy - прежняя таблица целиком, секция от начала истории до месяца перехода;
+- messages_pYYYYMM - секции по месяцам, создаются заранее (ensure_partitions);
+- messages_default - страховочная секция для дат вне созданных секций, обычно пустая.
+
+Запросы с условием на sent_at читают только подходящие секции. Старые секции
+переводятся в архив (archive_partitions): переносятся в отдельное табличное
+пространство и замораживаются. Архивные секции остаются частью messages,
+поэтому история и поиск читают их без изменений в API.
+"""
+import logging
+import re
+from collections import namedtuple
+from datetime import datetime
+
+from django.db import DatabaseError, connection, transaction
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+PARENT_TABLE = 'messages'
+LEGACY_PARTITION = 'messages_legacy'
+DEFAULT_PARTITION = 'messages_default'
+
+# Комментарий, которым помечаются секции, переведенные в архив
+ARCHIVE_COMMENT = 'archive'
+
+BOUND_RE = re.compile(r"FROM \((?P<lower>[^)]*)\) TO \((?P<upper>[^)]*)\)")
+
+Partition = namedtuple('Partition', 'name lower upper is_default archived tablespace size rows')
+
+
+def month_start(value):
+    return datetime(value.year, value.month, 1)
+
+
+def add_months(value, months):
+    month = value.month - 1 + months
+    return datetime(value.year + month // 12, month % 12 + 1, 1)
+
+
+def partition_name(month):
+    return f'{PARENT_TABLE}_p{month:%Y%m}'
+
+
+def _parse_bound(value):
+    value = value.strip()
+    if value in ('MINVALUE', 'MAXVALUE'):
+        return None
+    # Граница выводится в часовом поясе сессии: 2024-05-01 00:00:00+05
+    return datetime.strptime(value.strip("'")[:19], '%Y-%m-%d %H:%M:%S')
+
+
+def _literal(value):
+    return f"'{value:%Y-%m-%d %H:%M:%S}'"
+
+
+def is_partitioned():
+    """Секционирована ли таблица messages в текущей БД"""
+    if connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)",
+            [PARENT_TABLE]
+        )
+        return cursor.fetchone() is not None
+
+
+def list_partitions():
+    """Секции messages в порядке границ"""
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT c.relname, pg_get_expr(c.relpartbound, c.oid), COALESCE(t.spcname, ''),
+                   COALESCE(obj_description(c.oid, 'pg_class'), ''),
+                   pg_total_relation_size(c.oid), GREATEST(c.reltuples, 0)::bigint
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            LEFT JOIN pg_tablespace t ON t.oid = c.reltablespace
+            WHERE i.inhparent = %s::regclass
+        """, [PARENT_TABLE])
+        rows = cursor.fetchall()
+
+    partitions = []
+    for name, bound, tablespace, comment, size, estimate in rows:
+        match = BOUND_RE.search(bound)
+        lower = _parse_bound(match['lower']) if match else None
+        upper = _parse_bound(match['upper']) if match else None
+        partitions.append(Partition(
+            name=name, lower=lower, upper=upper, is_default=match is None,
+            archived=comment == ARCHIVE_COMMENT, tablespace=tablespace, size=size, rows=estimate,
+        ))
+
+    # Страховочная секция в конце, остальные по нижней границе
+    return sorted(partitions, key=lambda p: (p.is_default, p.lower or datetime.min))
+
+
+def _is_covered(partitions, month):
+    return any(
+        not p.is_default and (p.lower is None or p.lower <= month) and (p.upper is None or month < p.upper)
+        for p in partitions
+    )
+
+
+def ensure_partitions(months_ahead, now=None, dry_run=False):
+    """
+    Создает секции текущего месяца и months_ahead следующих, если их нет.
+    Возвращает имена созданных секций.
+    """
+    partitions = list_partitions()
+    current = month_start(now or timezone.now())
+    created = []
+
+    for offset in range(months_ahead + 1):
+        month = add_months(current, offset)
+        if _is_covered(partitions, month):
+            continue
+
+        name = partition_name(month)
+        if not dry_run:
+            try:
+                # Отдельная транзакция: ошибка одной секции не откатывает остальные
+                with transaction.atomic(), connection.cursor() as cursor:
+                    cursor.execute(
+                        f"CREATE TABLE IF NOT EXISTS {connection.ops.quote_name(name)} "
+                        f"PARTITION OF {connection.ops.quote_name(PARENT_TABLE)} "
+                        f"FOR VALUES FROM ({_literal(month)}) TO ({_literal(add_months(month, 1))})"
+                    )
+            except DatabaseError:
+                # Например, в страховочной секции уже есть строки за этот месяц
+                logger.exception("Could not create message partition %s", name)
+                continue
+        created.append(name)
+
+    return created
+
+
+def archive_partitions(before, tablespace=None, dry_run=False):
+    """
+    Переводит в архив секции, целиком лежащие раньше before: переносит
+    таблицу и индексы в tablespace (если задано) и выполняет VACUUM FREEZE,
+    после которого секция больше не требует обслуживания автовакуумом.
+    Возвращает имена обработанных секций.
+    """
+    archived = []
+    quote = connection.ops.quote_name
+
+    for partition in list_partitions():
+        if partition.is_default or partition.archived or partition.upper is None or partition.upper > before:
+            continue
+
+        archived.append(partition.name)
+        if dry_run:
+            continue
+
+        table = quote(partition.name)
+        with connection.cursor() as cursor:
+            if tablespace:
+                cursor.execute(f"ALTER TABLE {table} SET TABLESPACE {quote(tablespace)}")
+                cursor.execute(
+                    "SELECT indexrelid::regclass::text FROM pg_index WHERE indrelid = %s::regclass",
+                    [partition.name]
+                )
+                for (index,) in cursor.fetchall():
+                    cursor.execute(f"ALTER INDEX {index} SET TABLESPACE {quote(tablespace)}")
+            cursor.execute(f"VACUUM (FREEZE, ANALYZE) {table}")
+            cursor.execute(f"COMMENT ON TABLE {table} IS '{ARCHIVE_COMMENT}'")
+
+    return archived
+
+
+def default_partition_has_rows():
+    """Попали ли сообщения в страховочную секцию (не хватило заранее созданных секций)"""
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT EXISTS (SELECT 1 FROM {connection.ops.quote_name(DEFAULT_PARTITION)})")
+        return cursor.fetchone()[0]
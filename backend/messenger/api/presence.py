@@ -0,0 +1,232 @@
+"""
+Присутствие пользователей в сети.
+
+Трекер считает WebSocket соединения пользователя (несколько устройств/вкладок).
+Переход 0 -> 1 и 1 -> 0 рассылается как событие присутствия, а last_seen
+копится в памяти процесса и периодически сбрасывается в users_profiles
+одним UPDATE на пачку. В журнал синхронизации last_seen не пишется: иначе
+каждый пользователь в сети раз в PRESENCE_FLUSH_INTERVAL менял бы ETag и
+ответы sync/ всех своих собеседников. Клиенты узнают о присутствии из событий
+WebSocket, а актуальный last_seen - при следующей загрузке профиля. Счетчики соединений живут в памяти процесса (PRESENCE_BACKEND
+= 'local') или в общем кэше, если процессов несколько.
+"""
+import asyncio
+import logging
+import threading
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import Case, When, Value, DateTimeField
+from django.utils import timezone
+
+from .membership_cache import get_conversation_ids
+from .models import ConversationMember, UserFavorite, UserProfile
+
+logger = logging.getLogger(__name__)
+
+# Размер пачки пользователей в одном UPDATE
+FLUSH_BATCH_SIZE = 500
+
+
+def user_group(user_id):
+    """Персональная группа channel layer для всех соединений пользователя"""
+    return f"user_{user_id}"
+
+
+class PresenceTracker:
+    """Счетчики соединений в памяти процесса"""
+
+    def __init__(self):
+        self._connections = {}  # user_id -> количество соединений
+        self._last_seen = {}  # user_id -> время активности, еще не записанное в БД
+        self._lock = threading.Lock()
+        self._flusher = None
+
+    def connect(self, user_id):
+        """Регистрирует соединение. True, если пользователь только что появился в сети"""
+        with self._lock:
+            count = self._connections.get(user_id, 0) + 1
+            self._connections[user_id] = count
+            self._last_seen[user_id] = timezone.now()
+        return count == 1
+
+    def disconnect(self, user_id):
+        """Снимает соединение. True, если это было последнее соединение пользователя"""
+        with self._lock:
+            count = self._connections.get(user_id, 0) - 1
+            if count > 0:
+                self._connections[user_id] = count
+            else:
+                self._connections.pop(user_id, None)
+            self._last_seen[user_id] = timezone.now()
+        return count <= 0
+
+    def touch(self, user_id):
+        """Heartbeat: обновляет время активности без записи в БД"""
+        with self._lock:
+            if user_id in self._connections:
+                self._last_seen[user_id] = timezone.now()
+
+    async def aconnect(self, user_id):
+        return self.connect(user_id)
+
+    async def adisconnect(self, user_id):
+        return self.disconnect(user_id)
+
+    async def atouch(self, user_id):
+        self.touch(user_id)
+
+    def mark_seen(self, user_id):
+        with self._lock:
+            self._last_seen[user_id] = timezone.now()
+
+    def take_pending(self):
+        """Забирает несохраненные last_seen"""
+        with self._lock:
+            pending, self._last_seen = self._last_seen, {}
+        return pending
+
+    def flush(self):
+        """
+        Записывает накопленные last_seen пачками UPDATE ... CASE. update() не
+        вызывает сигналы, поэтому журнал синхронизации и ETag не меняются
+        """
+        pending = self.take_pending()
+        items = list(pending.items())
+
+        for start in range(0, len(items), FLUSH_BATCH_SIZE):
+            chunk = items[start:start + FLUSH_BATCH_SIZE]
+            UserProfile.objects.filter(
+                user_id__in=[user_id for user_id, _ in chunk]
+            ).update(last_seen=Case(
+                *[When(user_id=user_id, then=Value(seen)) for user_id, seen in chunk],
+                output_field=DateTimeField(),
+            ))
+
+        return len(items)
+
+    async def aflush(self):
+        try:
+            return await database_sync_to_async(self.flush)()
+        except Exception:
+            logger.exception("Error flushing presence last_seen")
+            return 0
+
+    def ensure_flusher(self):
+        """Запускает периодический сброс last_seen в текущем event loop"""
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.get_running_loop().create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        interval = getattr(settings, 'PRESENCE_FLUSH_INTERVAL', 30)
+        while True:
+            await asyncio.sleep(interval)
+            await self.aflush()
+
+
+class SharedPresenceTracker(PresenceTracker):
+    """
+    Счетчики соединений в общем кэше: пользователь в сети, пока у него есть
+    соединение в любом процессе. Ключ живет ttl секунд и продлевается heartbeat,
+    поэтому счетчик упавшего процесса не держит пользователя в сети вечно.
+    last_seen по-прежнему копится в процессе, принявшем соединение.
+    """
+
+    def __init__(self, alias, ttl):
+        super().__init__()
+        self.alias = alias
+        self.ttl = ttl
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    @staticmethod
+    def _key(user_id):
+        return f'presence:conn:{user_id}'
+
+    def connect(self, user_id):
+        self.mark_seen(user_id)
+        key = self._key(user_id)
+        self.cache.add(key, 0, self.ttl)
+        count = self.cache.incr(key)
+        self.cache.touch(key, self.ttl)
+        return count == 1
+
+    def disconnect(self, user_id):
+        self.mark_seen(user_id)
+        try:
+            count = self.cache.decr(self._key(user_id))
+        except ValueError:
+            # Ключ истек: соединений в других процессах тоже нет
+            return True
+        return count <= 0
+
+    def touch(self, user_id):
+        self.mark_seen(user_id)
+        self.cache.touch(self._key(user_id), self.ttl)
+
+    async def aconnect(self, user_id):
+        self.mark_seen(user_id)
+        key = self._key(user_id)
+        await self.cache.aadd(key, 0, self.ttl)
+        count = await self.cache.aincr(key)
+        await self.cache.atouch(key, self.ttl)
+        return count == 1
+
+    async def adisconnect(self, user_id):
+        self.mark_seen(user_id)
+        try:
+            count = await self.cache.adecr(self._key(user_id))
+        except ValueError:
+            return True
+        return count <= 0
+
+    async def atouch(self, user_id):
+        self.mark_seen(user_id)
+        await self.cache.atouch(self._key(user_id), self.ttl)
+
+
+def _create_tracker():
+    alias = getattr(settings, 'PRESENCE_BACKEND', 'local')
+    if alias == 'local':
+        return PresenceTracker()
+    # Ключ переживает несколько пропущенных heartbeat
+    return SharedPresenceTracker(alias, ttl=getattr(settings, 'WS_HEARTBEAT_TIMEOUT', 60) * 2)
+
+
+presence = _create_tracker()
+
+
+def presence_audience(user_id):
+    """
+    Кому рассылать присутствие пользователя: участникам общих бесед
+    и тем, кто добавил его в избранное
+    """
+    audience = set(
+        ConversationMember.objects.filter(
+            conversation_id__in=get_conversation_ids(user_id)
+        ).values_list('user_id', flat=True)
+    )
+    audience.update(
+        UserFavorite.objects.filter(friend_id=user_id).values_list('user_id', flat=True)
+    )
+    audience.discard(user_id)
+    return audience
+
+
+async def broadcast_presence(channel_layer, user_id, online):
+    audience = await database_sync_to_async(presence_audience)(user_id)
+    event = {
+        "type": "presence.changed",
+        "data": {
+            "entity": {
+                "user": user_id,
+                "online": online,
+                "last_seen": timezone.now().isoformat(),
+            },
+        }
+    }
+    for audience_user_id in audience:
+        await channel_layer.group_send(user_group(audience_user_id), event)
@@ -0,0 +1,132 @@
+"""
+Сроки хранения сообщений и их удаление пачками.
+
+Срок беседы берется из Conversation.retention_days, а если он не задан -
+из settings.MESSAGES_RETENTION_DAYS по типу беседы; 0 означает бессрочное
+хранение. Сообщения удаляются небольшими пачками по индексу
+(conversation_id, sent_at), каждая пачка - отдельная транзакция, поэтому
+прерванное удаление можно просто запустить снова.
+"""
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .db_routers import PRIMARY_DB
+from .models import ChangeLog, Conversation, JobCheckpoint, Message, MessageAttachment
+from .storage_utils import is_bucket_storage, delete_bucket_keys, storage_key
+
+logger = logging.getLogger(__name__)
+
+# Точка продолжения удаления: id последней полностью обработанной беседы
+PURGE_CHECKPOINT = 'purge_expired_messages'
+
+
+def type_retention_days():
+    return getattr(settings, 'MESSAGES_RETENTION_DAYS', {})
+
+
+def retention_days(conversation_type, override=None):
+    """Срок хранения в днях для беседы; 0 - бессрочно"""
+    if override is not None:
+        return override
+    return type_retention_days().get(conversation_type, 0)
+
+
+def conversations_with_retention(after_id=0):
+    """
+    Беседы с ограниченным сроком хранения в порядке id:
+    пары (id, срок в днях)
+    """
+    limited_types = [kind for kind, days in type_retention_days().items() if days]
+    queryset = Conversation.objects.filter(pk__gt=after_id).filter(
+        Q(retention_days__gt=0) | Q(retention_days__isnull=True, type__in=limited_types)
+    ).order_by('pk').values_list('pk', 'type', 'retention_days')
+
+    for pk, conversation_type, override in queryset.iterator():
+        yield pk, retention_days(conversation_type, override)
+
+
+def load_checkpoint(name=PURGE_CHECKPOINT):
+    # Из основной БД: реплика может еще не получить последнюю точку
+    value = JobCheckpoint.objects.using(PRIMARY_DB).filter(name=name).values_list('value', flat=True).first()
+    return value or 0
+
+
+def save_checkpoint(value, name=PURGE_CHECKPOINT):
+    JobCheckpoint.objects.update_or_create(name=name, defaults={'value': value})
+
+
+def clear_checkpoint(name=PURGE_CHECKPOINT):
+    JobCheckpoint.objects.filter(name=name).delete()
+
+
+def expired_messages(conversation_id, cutoff):
+    return Message.objects.filter(conversation_id=conversation_id, sent_at__lt=cutoff)
+
+
+def purge_batch(conversation_id, cutoff, batch_size):
+    """
+    Удаляет до batch_size самых старых просроченных сообщений беседы
+    вместе с вложениями. Возвращает (сообщений, вложений, байт вложений).
+
+    Строки удаляются через ORM, чтобы сработали каскады (вложения, ключи
+    клиентских id) и записи об удалении в журнал синхронизации. Файлы
+    удаляются после коммита: если удаление файла не удалось, объект без записи
+    позже уберет cleanup_attachments.
+    """
+    ids = list(
+        expired_messages(conversation_id, cutoff).order_by('sent_at').values_list('pk', flat=True)[:batch_size]
+    )
+    if not ids:
+        return 0, 0, 0
+
+    attachments = list(
+        MessageAttachment.objects.filter(message_id__in=ids).values_list('file', 'file_size')
+    )
+
+    with transaction.atomic():
+        # Условие на sent_at позволяет PostgreSQL не читать свежие секции messages
+        Message.objects.filter(pk__in=ids, sent_at__lt=cutoff).delete()
+
+    delete_files([name for name, _ in attachments if name])
+    return len(ids), len(attachments), sum(size or 0 for _, size in attachments)
+
+
+def delete_files(names):
+    """Удаляет файлы вложений из хранилища; возвращает количество неудачных удалений"""
+    if not names:
+        return 0
+
+    if is_bucket_storage():
+        failed = delete_bucket_keys(storage_key(name) for name in names)
+        if failed:
+            logger.warning("Could not delete %d attachment objects from bucket", len(failed))
+        return len(failed)
+
+    failed = 0
+    for name in names:
+        try:
+            default_storage.delete(name)
+        except Exception:
+            failed += 1
+            logger.exception("Could not delete attachment file %s", name)
+    return failed
+
+
+def changelog_cutoff():
+    return timezone.now() - timedelta(days=getattr(settings, 'SYNC_CHANGELOG_RETENTION_DAYS', 30))
+
+
+def prune_changelog_batch(cutoff, batch_size):
+    """Удаляет пачку самых старых записей журнала изменений; возвращает их количество"""
+    ids = list(
+        ChangeLog.objects.filter(created_at__lt=cutoff).order_by('id').values_list('id', flat=True)[:batch_size]
+    )
+    if ids:
+        ChangeLog.objects.filter(pk__in=ids).delete()
+    return len(ids)
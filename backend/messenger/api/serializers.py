@@ -1,16 +1,23 @@
 import os
 
 from django.contrib.auth.models import User
+from django.db import transaction
 from rest_framework import serializers
 from django.core.exceptions import ValidationError as DjangoValidationError
 
 
 from .models import Conversation, ConversationMember, Message, MessageAttachment, UserFavorite
+from .storage_utils import is_bucket_storage, save_files_concurrently, delete_saved_files
+from .fieldsets import SparseFieldsetMixin
 
 
-class UserSerializer(serializers.ModelSerializer):
+class UserSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     profile = serializers.SerializerMethodField()
 
+    expandable_fields = {
+        'profile': None,
+    }
+
     class Meta:
         model = User
         fields = ['id', 'username', 'email', 'first_name', 'last_name', 'profile']
@@ -37,7 +44,14 @@ class ConversationMemberSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = ConversationMember
-        fields = ['id', 'user', 'role', 'joined_at']
+        fields = ['id', 'user', 'role', 'joined_at', 'last_read_at']
+
+
+class SyncMemberSerializer(ConversationMemberSerializer):
+    """Участник беседы для синхронизации: с id беседы"""
+
+    class Meta(ConversationMemberSerializer.Meta):
+        fields = ConversationMemberSerializer.Meta.fields + ['conversation']
 
 
 class MessageAttachmentSerializer(serializers.ModelSerializer):
@@ -224,32 +238,62 @@ class MessageAttachmentSerializer(serializers.ModelSerializer):
         return icons.get(file_type, '📎')
 
 
-class MessageSerializer(serializers.ModelSerializer):
+class MessageSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     sender = UserSerializer(read_only=True)
     attachments = MessageAttachmentSerializer(many=True, read_only=True)
     sent_at = serializers.DateTimeField(format='%d.%m.%Y %H:%M', required=False, allow_null=True)
     edited_at = serializers.DateTimeField(format='%d.%m.%Y %H:%M', required=False, allow_null=True)
+    client_message_id = serializers.CharField(max_length=64, required=False, allow_null=True)
+
+    expandable_fields = {
+        'sender': lambda: serializers.PrimaryKeyRelatedField(read_only=True),
+        'attachments': lambda: serializers.PrimaryKeyRelatedField(many=True, read_only=True),
+    }
 
     class Meta:
         model = Message
-        fields = ['id', 'conversation', 'sender', 'text', 'attachments', 'sent_at', 'edited_at', 'is_edited']
+        fields = ['id', 'conversation', 'sender', 'text', 'attachments', 'sent_at', 'edited_at', 'is_edited',
+                  'client_message_id', 'version']
+        read_only_fields = ['version']
+        # Уникальность client_message_id проверяется в MessageViewSet.create
+        validators = []
 
+    def update(self, instance, validated_data):
+        # Клиентский идентификатор задается только при создании
+        validated_data.pop('client_message_id', None)
+        return super().update(instance, validated_data)
 
-class ConversationSerializer(serializers.ModelSerializer):
+
+class ConversationSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     members = ConversationMemberSerializer(many=True, read_only=True)
     last_message = serializers.SerializerMethodField()
 
+    expandable_fields = {
+        # Свернутые участники - список id пользователей, последнее сообщение - его id
+        'members': lambda: serializers.SlugRelatedField(slug_field='user_id', many=True, read_only=True),
+        'last_message': lambda: serializers.SerializerMethodField(method_name='get_last_message_id'),
+    }
+
     class Meta:
         model = Conversation
         fields = ['id', 'type', 'title', 'avatar', 'created_by', 'members', 'last_message', 'created_at',
                   'last_message_at']
 
     def get_last_message(self, obj):
-        last_message = obj.messages.last()
+        # Последнее сообщение может быть загружено заранее (см. async_views)
+        if hasattr(obj, 'prefetched_last_message'):
+            last_message = obj.prefetched_last_message
+        else:
+            last_message = obj.messages.last()
         if last_message:
             return MessageSerializer(last_message).data
         return None
 
+    def get_last_message_id(self, obj):
+        if hasattr(obj, 'last_message_pk'):
+            return obj.last_message_pk
+        return obj.messages.order_by('-sent_at').values_list('id', flat=True).first()
+
 
 class CreateConversationSerializer(serializers.ModelSerializer):
     member_ids = serializers.ListField(
@@ -434,10 +478,12 @@ class CreateMessageWithFilesSerializer(serializers.ModelSerializer):
         write_only=True,
         required=False
     )
+    client_message_id = serializers.CharField(max_length=64, required=False, allow_null=True)
 
     class Meta:
         model = Message
-        fields = ['conversation', 'text', 'files']
+        fields = ['conversation', 'text', 'files', 'client_message_id']
+        validators = []
 
     def validate(self, data):
         request = self.context.get('request')
@@ -455,18 +501,59 @@ class CreateMessageWithFilesSerializer(serializers.ModelSerializer):
 
         # ВАЖНО: sender НЕ передаем здесь
         # Он будет передан через serializer.save(sender=request.user) в perform_create
-        message = Message.objects.create(**validated_data)
+        with transaction.atomic():
+            message = Message.objects.create(**validated_data)
+
+            if files:
+                self._create_attachments(message, files)
 
-        for file_obj in files:
-            MessageAttachment.objects.create(
+        return message
+
+    def _create_attachments(self, message, files):
+        """
+        Загружает файлы в MinIO параллельно и одним запросом создает записи.
+        При ошибке уже загруженные файлы удаляются, а транзакция откатывается.
+        """
+        file_field = MessageAttachment._meta.get_field('file')
+        attachments = [
+            MessageAttachment(
                 message=message,
-                file=file_obj,
                 file_name=file_obj.name,
                 file_size=file_obj.size,
                 mime_type=file_obj.content_type or 'application/octet-stream'
             )
+            for file_obj in files
+        ]
 
-        return message
+        # Одинаковые имена в одном сообщении разводим заранее: параллельные
+        # загрузки не видят друг друга при проверке существования файла
+        names = []
+        for attachment, file_obj in zip(attachments, files):
+            name = file_field.generate_filename(attachment, file_obj.name)
+            root, ext = os.path.splitext(name)
+            suffix = 1
+            # Новое имя тоже может быть занято: a_1.txt, a.txt, a.txt
+            while name in names:
+                name = f"{root}_{suffix}{ext}"
+                suffix += 1
+            names.append(name)
+
+        saved_names = save_files_concurrently(zip(names, files))
+
+        # bulk_create не вызывает MessageAttachment.save(), заполняем поля сами
+        stored_in_minio = is_bucket_storage()
+        for attachment, name in zip(attachments, saved_names):
+            attachment.file = name
+            attachment.storage_path = name
+            attachment.is_stored_in_minio = stored_in_minio
+
+        try:
+            MessageAttachment.objects.bulk_create(attachments)
+        except Exception:
+            delete_saved_files(saved_names)
+            raise
+
+        return attachments
 
 class UserFavoritesSerializer(serializers.ModelSerializer):
     user = UserSerializer(read_only=True)
@@ -0,0 +1,100 @@
+import logging
+
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .membership_cache import invalidate_user
+from .models import UserProfile, Conversation, ConversationMember, Message, UserFavorite, ChangeLog
+from .sync import record_change
+from .user_cache import user_cache
+from .utils import notify_membership_changed
+
+logger = logging.getLogger(__name__)
+
+
+def _invalidate_cached_user(user_id=None, username=None):
+    # Повторно после коммита: параллельный запрос мог закэшировать состояние до коммита
+    user_cache.invalidate(user_id=user_id, username=username)
+    transaction.on_commit(lambda: user_cache.invalidate(user_id=user_id, username=username))
+
+
+@receiver([post_save, post_delete], sender=User)
+def invalidate_cached_user(sender, instance, **kwargs):
+    # Логин мог измениться, поэтому сбрасываем и по id, и по текущему логину
+    _invalidate_cached_user(user_id=instance.pk)
+    _invalidate_cached_user(username=instance.username)
+
+
+@receiver([post_save, post_delete], sender=UserProfile)
+def invalidate_cached_profile(sender, instance, **kwargs):
+    _invalidate_cached_user(user_id=instance.user_id)
+
+
+@receiver([post_save, post_delete], sender=ConversationMember)
+def invalidate_cached_membership(sender, instance, **kwargs):
+    invalidate_user(instance.user_id)
+
+    # Соединения пользователя должны войти в группу новой беседы или выйти из старой
+    if kwargs.get('created') or kwargs['signal'] is post_delete:
+        user_id = instance.user_id
+        transaction.on_commit(lambda: _notify_membership_changed(user_id))
+
+
+def _notify_membership_changed(user_id):
+    try:
+        notify_membership_changed(user_id)
+    except Exception:
+        logger.exception("Error notifying membership change for user %s", user_id)
+
+
+# === ЖУРНАЛ ИЗМЕНЕНИЙ ДЛЯ СИНХРОНИЗАЦИИ ===
+def _sync_action(kwargs):
+    return ChangeLog.DELETE if kwargs['signal'] is post_delete else ChangeLog.UPSERT
+
+
+@receiver([post_save, post_delete], sender=Conversation)
+def log_conversation_change(sender, instance, **kwargs):
+    if kwargs.get('raw'):
+        return
+    record_change(ChangeLog.CONVERSATION, _sync_action(kwargs), instance.pk, conversation_id=instance.pk)
+
+
+@receiver([post_save, post_delete], sender=ConversationMember)
+def log_member_change(sender, instance, **kwargs):
+    if kwargs.get('raw'):
+        return
+    record_change(
+        ChangeLog.MEMBER, _sync_action(kwargs), instance.pk,
+        conversation_id=instance.conversation_id, user_id=instance.user_id
+    )
+
+
+@receiver([post_save, post_delete], sender=Message)
+def log_message_change(sender, instance, **kwargs):
+    if kwargs.get('raw'):
+        return
+    record_change(ChangeLog.MESSAGE, _sync_action(kwargs), instance.pk, conversation_id=instance.conversation_id)
+
+
+@receiver([post_save, post_delete], sender=User)
+def log_user_change(sender, instance, **kwargs):
+    if kwargs.get('raw'):
+        return
+    record_change(ChangeLog.PROFILE, _sync_action(kwargs), instance.pk)
+
+
+@receiver([post_save, post_delete], sender=UserProfile)
+def log_profile_change(sender, instance, **kwargs):
+    if kwargs.get('raw'):
+        return
+    # Профиль отдается вместе с пользователем, удаление профиля - это изменение пользователя
+    record_change(ChangeLog.PROFILE, ChangeLog.UPSERT, instance.user_id)
+
+
+@receiver([post_save, post_delete], sender=UserFavorite)
+def log_favorite_change(sender, instance, **kwargs):
+    if kwargs.get('raw'):
+        return
+    record_change(ChangeLog.FAVORITE, _sync_action(kwargs), instance.pk, user_id=instance.user_id)
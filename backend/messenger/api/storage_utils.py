@@ -0,0 +1,161 @@
+import posixpath
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from django.conf import settings
+from django.core.files.storage import default_storage, storages
+
+# Максимальное количество ключей в одном запросе DeleteObjects (ограничение S3/MinIO)
+DELETE_OBJECTS_LIMIT = 1000
+
+# Экземпляры storage для рабочих потоков загрузки
+_thread_local = threading.local()
+
+_upload_executor = None
+_upload_executor_lock = threading.Lock()
+
+
+def is_bucket_storage(storage=None):
+    """Проверяет, что storage работает с бакетом S3/MinIO"""
+    storage = storage or default_storage
+    return hasattr(storage, 'bucket_name') and hasattr(storage, 'connection')
+
+
+def get_bucket_client(storage=None):
+    """Возвращает низкоуровневый boto3 клиент текущего потока"""
+    storage = storage or default_storage
+    return storage.connection.meta.client
+
+
+def storage_key(name, storage=None):
+    """Переводит имя файла FileField в ключ объекта в бакете"""
+    storage = storage or default_storage
+    location = getattr(storage, 'location', '') or ''
+    return posixpath.join(location, name) if location else name
+
+
+def storage_name(key, storage=None):
+    """Обратное преобразование: ключ объекта в бакете -> имя файла FileField"""
+    storage = storage or default_storage
+    location = getattr(storage, 'location', '') or ''
+    if location and key.startswith(location.rstrip('/') + '/'):
+        return key[len(location.rstrip('/')) + 1:]
+    return key
+
+
+def iter_bucket_objects(prefix='', storage=None, page_size=1000):
+    """
+    Потоково перебирает объекты бакета в порядке возрастания ключей.
+    ListObjectsV2 отдает ключи отсортированными по байтам UTF-8,
+    в памяти держится только одна страница листинга.
+    """
+    storage = storage or default_storage
+    paginator = get_bucket_client(storage).get_paginator('list_objects_v2')
+    pages = paginator.paginate(
+        Bucket=storage.bucket_name,
+        Prefix=storage_key(prefix, storage),
+        PaginationConfig={'PageSize': page_size},
+    )
+    for page in pages:
+        for obj in page.get('Contents', []):
+            yield obj
+
+
+def delete_bucket_keys(keys, storage=None):
+    """
+    Удаляет объекты из бакета пачками через DeleteObjects.
+    Возвращает список ключей, которые удалить не удалось.
+    """
+    storage = storage or default_storage
+    client = get_bucket_client(storage)
+    keys = list(keys)
+    failed = []
+
+    for start in range(0, len(keys), DELETE_OBJECTS_LIMIT):
+        chunk = keys[start:start + DELETE_OBJECTS_LIMIT]
+        response = client.delete_objects(
+            Bucket=storage.bucket_name,
+            Delete={'Objects': [{'Key': key} for key in chunk], 'Quiet': True},
+        )
+        failed.extend(error['Key'] for error in response.get('Errors', []))
+
+    return failed
+
+
+def get_thread_storage():
+    """
+    Возвращает отдельный экземпляр storage по умолчанию для текущего потока.
+    S3Boto3Storage кэширует boto3 resource/bucket в экземпляре, а они не
+    потокобезопасны, поэтому каждый поток загрузки получает свой экземпляр.
+    """
+    storage = getattr(_thread_local, 'storage', None)
+    if storage is None:
+        storage = storages.create_storage(settings.STORAGES['default'])
+        _thread_local.storage = storage
+    return storage
+
+
+def get_upload_executor():
+    """Общий для процесса ограниченный пул потоков загрузки файлов"""
+    global _upload_executor
+    if _upload_executor is None:
+        with _upload_executor_lock:
+            if _upload_executor is None:
+                _upload_executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, 'ATTACHMENT_UPLOAD_WORKERS', 4),
+                    thread_name_prefix='attachment-upload',
+                )
+    return _upload_executor
+
+
+def save_files_concurrently(items):
+    """
+    Параллельно сохраняет файлы в storage по умолчанию.
+
+    items - список пар (имя, файл). Возвращает список сохраненных имен
+    в том же порядке. Если хотя бы одна загрузка завершилась ошибкой,
+    уже загруженные файлы удаляются, а первая ошибка пробрасывается дальше.
+    """
+    items = list(items)
+    if not items:
+        return []
+
+    if len(items) == 1:
+        name, content = items[0]
+        return [default_storage.save(name, content)]
+
+    def save(item):
+        name, content = item
+        return get_thread_storage().save(name, content)
+
+    futures = [get_upload_executor().submit(save, item) for item in items]
+    wait(futures)
+
+    saved_names = []
+    error = None
+    for future in futures:
+        exc = future.exception()
+        if exc is None:
+            saved_names.append(future.result())
+        elif error is None:
+            error = exc
+
+    if error is not None:
+        delete_saved_files(saved_names)
+        raise error
+
+    return saved_names
+
+
+def delete_saved_files(names, storage=None):
+    """Компенсирующее удаление уже сохраненных файлов"""
+    storage = storage or default_storage
+    names = [name for name in names if name]
+    if not names:
+        return
+
+    if is_bucket_storage(storage):
+        delete_bucket_keys([storage_key(name, storage) for name in names], storage)
+    else:
+        for name in names:
+            storage.delete(name)
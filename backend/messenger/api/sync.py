@@ -0,0 +1,189 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Q, Max, Min, Prefetch
+from django.utils import timezone
+
+from .membership_cache import get_conversation_ids
+from .models import ChangeLog, Conversation, ConversationMember, Message, MessageAttachment, UserFavorite
+
+
+def record_change(entity, action, object_id, conversation_id=None, user_id=None):
+    """
+    Добавляет запись в журнал изменений после коммита транзакции.
+    Так id записей выдаются в порядке коммитов, и клиент, продвинувший
+    токен, не пропустит изменение из долгой транзакции.
+    """
+    def write():
+        ChangeLog.objects.create(
+            entity=entity,
+            action=action,
+            object_id=object_id,
+            conversation_id=conversation_id,
+            user_id=user_id,
+        )
+
+    transaction.on_commit(write)
+
+
+def latest_token():
+    return ChangeLog.objects.aggregate(latest=Max('id'))['latest'] or 0
+
+
+def safety_cutoff():
+    """Записи новее этой отметки sync/ еще не отдает: их соседи по id могут быть не записаны"""
+    return timezone.now() - timedelta(seconds=getattr(settings, 'SYNC_SAFETY_LAG', 2))
+
+
+async def asettled_token():
+    """
+    Токен последнего изменения старше SYNC_SAFETY_LAG. События о таких
+    изменениях уже разосланы, поэтому соединение, очередь которого пуста,
+    доставило клиенту все, что было до этого токена
+    """
+    result = await ChangeLog.objects.filter(created_at__lt=safety_cutoff()).aaggregate(latest=Max('id'))
+    return result['latest'] or 0
+
+
+class SettledTokenCache:
+    """asettled_token(), общий для соединений процесса: запрос к БД не чаще раза в ttl секунд"""
+
+    def __init__(self, ttl=1.0):
+        self.ttl = ttl
+        self._token = 0
+        self._checked_at = None
+
+    async def aget(self):
+        now = time.monotonic()
+        if self._checked_at is None or now - self._checked_at >= self.ttl:
+            # Остальные соединения до конца запроса получают прежнее значение
+            self._checked_at = now
+            self._token = await asettled_token()
+        return self._token
+
+
+settled_tokens = SettledTokenCache()
+
+
+def member_user_ids(conversation_ids):
+    """Участники бесед: их профили входят в ответы о беседах"""
+    return set(
+        ConversationMember.objects.filter(
+            conversation_id__in=conversation_ids
+        ).values_list('user_id', flat=True)
+    )
+
+
+def favorite_user_ids(user_id):
+    """Избранные контакты пользователя"""
+    return set(UserFavorite.objects.filter(user_id=user_id).values_list('friend_id', flat=True))
+
+
+def profiles_condition(user_ids):
+    """Изменения профилей только указанных пользователей, а не всех в системе"""
+    return Q(entity=ChangeLog.PROFILE, object_id__in=user_ids)
+
+
+def collect_changes(user, token, limit):
+    """
+    Возвращает изменения, видимые пользователю, с id больше token.
+    Несколько изменений одного объекта сворачиваются в последнее.
+    """
+    conversation_ids = get_conversation_ids(user.id)
+
+    # Свежие записи пропускаем: их соседи по id могут быть еще не записаны
+    changes = list(
+        ChangeLog.objects.filter(
+            id__gt=token,
+            created_at__lt=safety_cutoff(),
+        ).filter(
+            Q(conversation_id__in=conversation_ids) |
+            Q(user_id=user.id) |
+            # Профили собеседников и избранных контактов
+            profiles_condition(member_user_ids(conversation_ids) | favorite_user_ids(user.id) | {user.id})
+        ).exclude(
+            # Избранное используется только для ETag и в синхронизацию не входит
+            entity=ChangeLog.FAVORITE
+        ).order_by('id').values('id', 'entity', 'action', 'object_id', 'conversation_id', 'user_id')[:limit + 1]
+    )
+
+    has_more = len(changes) > limit
+    changes = changes[:limit]
+    next_token = changes[-1]['id'] if changes else token
+
+    latest = {}
+    for change in changes:
+        latest[(change['entity'], change['object_id'])] = change
+
+    return latest.values(), conversation_ids, next_token, has_more
+
+
+def build_sync_payload(user, token, limit, context=None):
+    """Собирает ответ эндпоинта синхронизации"""
+    from .serializers import ConversationSerializer, MessageSerializer, SyncMemberSerializer, UserSerializer
+
+    oldest = ChangeLog.objects.aggregate(oldest=Min('id'))['oldest']
+    if token and oldest is not None and token < oldest - 1:
+        # Нужные записи журнала уже удалены, клиенту требуется полная загрузка
+        return {'token': latest_token(), 'has_more': False, 'full_resync': True}
+
+    changes, conversation_ids, next_token, has_more = collect_changes(user, token, limit)
+
+    upserts = {entity: set() for entity, _ in ChangeLog.ENTITIES}
+    deleted = {entity: set() for entity, _ in ChangeLog.ENTITIES}
+
+    for change in changes:
+        if change['action'] == ChangeLog.DELETE:
+            deleted[change['entity']].add(change['object_id'])
+            if (change['entity'] == ChangeLog.MEMBER and change['user_id'] == user.id
+                    and change['conversation_id'] not in conversation_ids):
+                # Пользователя исключили из беседы - удаляем у него и саму беседу
+                deleted[ChangeLog.CONVERSATION].add(change['conversation_id'])
+            continue
+
+        upserts[change['entity']].add(change['object_id'])
+        if change['entity'] == ChangeLog.MEMBER and change['user_id'] == user.id:
+            # Пользователя добавили в беседу - отдаем саму беседу
+            upserts[ChangeLog.CONVERSATION].add(change['conversation_id'])
+
+    # Изменения бесед, из которых пользователя исключили, отдаем как удаление
+    for conversation_id in upserts[ChangeLog.CONVERSATION] - conversation_ids:
+        deleted[ChangeLog.CONVERSATION].add(conversation_id)
+    upserts[ChangeLog.CONVERSATION] &= conversation_ids
+
+    conversations = Conversation.objects.filter(
+        id__in=upserts[ChangeLog.CONVERSATION]
+    ).prefetch_related('members__user__profile')
+
+    members = ConversationMember.objects.filter(
+        id__in=upserts[ChangeLog.MEMBER],
+        conversation_id__in=conversation_ids,
+    ).select_related('user__profile')
+
+    messages = Message.objects.filter(
+        id__in=upserts[ChangeLog.MESSAGE],
+        conversation_id__in=conversation_ids,
+    ).select_related('sender__profile').prefetch_related(
+        Prefetch('attachments', queryset=MessageAttachment.objects.order_by('id'))
+    )
+
+    profiles = User.objects.filter(id__in=upserts[ChangeLog.PROFILE]).select_related('profile')
+
+    return {
+        'token': next_token,
+        'has_more': has_more,
+        'full_resync': False,
+        'conversations': ConversationSerializer(conversations, many=True, context=context).data,
+        'members': SyncMemberSerializer(members, many=True, context=context).data,
+        'messages': MessageSerializer(messages, many=True, context=context).data,
+        'profiles': UserSerializer(profiles, many=True, context=context).data,
+        'deleted': {
+            'conversations': sorted(deleted[ChangeLog.CONVERSATION]),
+            'members': sorted(deleted[ChangeLog.MEMBER]),
+            'messages': sorted(deleted[ChangeLog.MESSAGE]),
+            'profiles': sorted(deleted[ChangeLog.PROFILE]),
+        },
+    }
@@ -1,3 +1,686 @@
-from django.test import TestCase
+"""
+Тесты API.
 
-# Create your tests here.
+Планы запросов горячих путей (HotPathQueryPlanTests): тесты заполняют БД реалистичным объемом данных, собирают статистику (ANALYZE)
+и проверяют через EXPLAIN, что запросы эндпоинтов читают таблицы по индексам
+и не сортируют результат отдельно. Запросы строят те же функции и view, что
+обслуживают эндпоинты, команды и админку, поэтому изменение запроса в коде
+сразу проверяется тестом. На PostgreSQL разбирается EXPLAIN (FORMAT JSON),
+на SQLite - EXPLAIN QUERY PLAN.
+
+Поведение синхронизации (sync/) и повторной отправки сообщений с тем же
+client_message_id - SyncTests и ClientMessageIdTests.
+
+Запуск: python manage.py test api.tests
+"""
+import json
+import os
+import random
+import re
+import tempfile
+from datetime import timedelta
+from unittest import mock
+
+from django.apps import apps
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.db import connection, connections, transaction
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from . import db_routers, ws_actions
+from .async_views import ConversationListView, ConversationMessagesView
+from .membership_cache import membership_backend
+from .management.commands.cleanup_attachments import unlinked_attachments
+from .models import (
+    ChangeLog, Conversation, ConversationMember, Message, MessageAttachment, MessageClientKey, UserFavorite,
+    UserProfile
+)
+from .retention import prune_changelog_batch
+from .views import conversation_messages, user_favorites
+
+USERS = 5000
+CONVERSATIONS = 1500
+MESSAGES_PER_CONVERSATION = 40
+FAVORITES_PER_USER = 10
+
+INDEX_SCANS = ('Index Scan', 'Index Only Scan', 'Bitmap Index Scan')
+SQLITE_INDEX_RE = re.compile(r'USING (?:COVERING )?INDEX (\w+)|USING (?:INTEGER )?PRIMARY KEY')
+
+# Таблицы, присоединяемые по первичному ключу (select_related отправителя и профиля).
+# На тестовом объеме PostgreSQL честно выбирает для них полный просмотр и hash join,
+# на боевом - поиск по ключу, поэтому их просмотр не проверяется
+LOOKUP_TABLES = ('auth_user', 'users_profiles')
+
+
+class QueryPlanMixin:
+    """Разбор планов запросов PostgreSQL и SQLite"""
+
+    def explain(self, queryset):
+        """
+        Возвращает (просмотры таблиц, использованные индексы, есть ли отдельная сортировка).
+        Просмотр - пара (таблица, по индексу ли он выполняется). Вместо queryset можно
+        передать SQL уже выполненного запроса (например, prefetch_related)
+        """
+        if connection.vendor == 'postgresql':
+            return self.explain_postgresql(queryset)
+        if connection.vendor == 'sqlite':
+            return self.explain_sqlite(queryset)
+        self.skipTest(f'Разбор планов для {connection.vendor} не реализован')
+
+    @staticmethod
+    def plan_text(query, json_format=False):
+        if not isinstance(query, str):
+            return query.explain(format='json') if json_format else query.explain()
+
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                cursor.execute(('EXPLAIN (FORMAT JSON) ' if json_format else 'EXPLAIN ') + query)
+                rows = cursor.fetchall()
+                return json.dumps(rows[0][0]) if json_format else '\n'.join(row[0] for row in rows)
+            cursor.execute('EXPLAIN QUERY PLAN ' + query)
+            return '\n'.join(row[-1] for row in cursor.fetchall())
+
+    def explain_postgresql(self, queryset):
+        plan = json.loads(self.plan_text(queryset, json_format=True))[0]['Plan']
+        scans, indexes, sorted_separately = [], set(), False
+        returned_rows = plan['Plan Rows']
+
+        nodes = [plan]
+        while nodes:
+            node = nodes.pop()
+            children = node.get('Plans', [])
+            nodes.extend(children)
+            node_type = node['Node Type']
+            # Сортировка над Append только сливает строки секций, каждая из которых
+            # прочитана по индексу; сортировка не больше строк, чем в ответе, тоже
+            # зависит от размера ответа, а не таблицы. Incremental Sort досортировывает
+            # только строки с равным ключом индекса
+            if node_type == 'Sort' and not (children and children[0]['Node Type'] == 'Append') \
+                    and node['Plan Rows'] > returned_rows:
+                sorted_separately = True
+            if node_type in INDEX_SCANS:
+                indexes.add(self.parent_relation(node['Index Name']))
+            # Пустые секции (будущие месяцы, страховочная) читаются целиком за нулевую стоимость
+            if 'Relation Name' in node and not self.is_empty(node['Relation Name']):
+                scans.append((self.parent_relation(node['Relation Name']),
+                              node_type in INDEX_SCANS or node_type == 'Bitmap Heap Scan'))
+
+        return scans, indexes, sorted_separately
+
+    def explain_sqlite(self, queryset):
+        scans, indexes, sorted_separately = [], set(), False
+
+        for detail in self.plan_text(queryset).splitlines():
+            # RIGHT PART OF ORDER BY - досортировка строк с равным ключом индекса
+            if 'TEMP B-TREE' in detail and 'RIGHT PART' not in detail:
+                sorted_separately = True
+            match = re.search(r'\b(SCAN|SEARCH) (\w+)', detail)
+            if not match or match[2] in ('CONSTANT', 'SUBQUERY'):
+                continue
+            index = SQLITE_INDEX_RE.search(detail)
+            if index and index[1]:
+                indexes.add(index[1])
+            scans.append((match[2], index is not None))
+
+        return scans, indexes, sorted_separately
+
+    @staticmethod
+    def is_empty(table):
+        """Пуста ли таблица по статистике последнего ANALYZE"""
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT relpages = 0 FROM pg_class WHERE relname = %s", [table])
+            return cursor.fetchone()[0]
+
+    @staticmethod
+    def parent_relation(name):
+        """Секция или ее индекс -> секционированная таблица или ее индекс"""
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                SELECT p.relname FROM pg_inherits i
+                JOIN pg_class c ON c.oid = i.inhrelid
+                JOIN pg_class p ON p.oid = i.inhparent
+                WHERE c.relname = %s
+            """, [name])
+            row = cursor.fetchone()
+        return row[0] if row else name
+
+    def assertUsesIndex(self, queryset, index, ordered=False):
+        scans, indexes, sorted_separately = self.explain(queryset)
+        plan = self.plan_text(queryset)
+        self.assertTrue(scans, plan)
+        full_scans = [table for table, indexed in scans if not indexed and table not in LOOKUP_TABLES]
+        self.assertEqual(full_scans, [], f'Полный просмотр:\n{plan}')
+        self.assertIn(index, indexes, plan)
+        if ordered:
+            self.assertFalse(sorted_separately, f'Отдельная сортировка:\n{plan}')
+
+
+class HotPathQueryPlanTests(QueryPlanMixin, TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        rnd = random.Random(42)
+        now = timezone.now()
+
+        users = User.objects.bulk_create(User(username=f'plan_user_{i}') for i in range(USERS))
+        UserProfile.objects.bulk_create(UserProfile(user=user) for user in users)
+        profiles = list(UserProfile.objects.all())
+        for profile in profiles:
+            profile.last_seen = now - timedelta(minutes=rnd.randint(0, 60 * 24 * 90))
+        UserProfile.objects.bulk_update(profiles, ['last_seen'], batch_size=500)
+
+        conversations = Conversation.objects.bulk_create(
+            Conversation(type=rnd.choice([Conversation.PRIVATE, Conversation.GROUP]),
+                         title='plan', created_by=rnd.choice(users))
+            for _ in range(CONVERSATIONS)
+        )
+        for conversation in conversations:
+            conversation.last_message_at = now - timedelta(minutes=rnd.randint(0, 60 * 24 * 365))
+        Conversation.objects.bulk_update(conversations, ['last_message_at'], batch_size=500)
+
+        ConversationMember.objects.bulk_create(
+            ConversationMember(conversation=conversation, user=user)
+            for conversation in conversations
+            for user in rnd.sample(users, rnd.randint(2, 5))
+        )
+
+        # sent_at заполняется при вставке (auto_now_add), поэтому даты разносятся отдельно
+        Message.objects.bulk_create(
+            (Message(conversation=conversation, sender=rnd.choice(users), text='plan')
+             for conversation in conversations for _ in range(MESSAGES_PER_CONVERSATION)),
+            batch_size=2000,
+        )
+        cls.spread_sent_at()
+        messages = list(Message.objects.only('pk'))
+
+        # Вложения у каждого десятого сообщения и немного непривязанных
+        MessageAttachment.objects.bulk_create(
+            [MessageAttachment(message=message, file=f'message_attachments/plan_{message.pk}', file_name='plan',
+                               file_size=1, mime_type='text/plain') for message in messages[::10]]
+            + [MessageAttachment(file=f'message_attachments/unlinked_{i}', file_name='plan', file_size=1,
+                                 mime_type='text/plain') for i in range(300)],
+            batch_size=2000,
+        )
+        # Непривязанные вложения - в основном свежие загрузки, старых сирот немного
+        unlinked = list(MessageAttachment.objects.filter(message__isnull=True))
+        for i, attachment in enumerate(unlinked):
+            age = timedelta(days=rnd.randint(2, 30)) if i % 30 == 0 else timedelta(minutes=rnd.randint(0, 60 * 24))
+            attachment.uploaded_at = now - age
+        MessageAttachment.objects.bulk_update(unlinked, ['uploaded_at'])
+
+        UserFavorite.objects.bulk_create(
+            UserFavorite(user=user, friend=friend)
+            for user in users for friend in rnd.sample(users, FAVORITES_PER_USER)
+        )
+
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+        cls.user = users[0]
+        cls.conversation = conversations[CONVERSATIONS // 2]
+        cls.conversation_ids = list(
+            ConversationMember.objects.filter(user=cls.user).values_list('conversation_id', flat=True)
+        )
+        cls.now = now
+        cls.admin = User.objects.create(username='plan_admin', is_staff=True, is_superuser=True)
+
+    @staticmethod
+    def spread_sent_at():
+        """Разносит даты сообщений на год назад одним UPDATE"""
+        minutes = '(id * 7919) %% %s'
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                sql = f"UPDATE messages SET sent_at = sent_at - {minutes} * interval '1 minute'"
+            else:
+                sql = f"UPDATE messages SET sent_at = datetime(sent_at, '-' || ({minutes}) || ' minutes')"
+            cursor.execute(sql, [60 * 24 * 365])
+
+    def view(self, view_class, **params):
+        """Async view эндпоинта с запросом от имени пользователя (для его get_queryset и выбора полей)"""
+        request = RequestFactory().get('/', params)
+        request.user = self.user
+        view = view_class()
+        view.setup(request)
+        return view
+
+    def changelist(self, model, **params):
+        """Запрос первой страницы списка объектов в админке"""
+        model_admin = admin.site._registry[model]
+        request = RequestFactory().get('/', params)
+        request.user = self.admin
+        queryset = model_admin.get_changelist_instance(request).get_queryset(request)
+        return queryset[:model_admin.list_per_page]
+
+    def test_conversation_messages(self):
+        """История беседы: conversations/<id>/messages/"""
+        view = self.view(ConversationMessagesView)
+        messages = conversation_messages(view, self.conversation.pk, view.request.GET)
+        self.assertUsesIndex(messages, 'messages_conv_sent_idx', ordered=True)
+
+    def test_conversation_messages_sent_range(self):
+        """История беседы за период: ?sent_after=&sent_before="""
+        view = self.view(
+            ConversationMessagesView,
+            sent_after=(self.now - timedelta(days=30)).strftime('%Y-%m-%dT%H:%M:%S'),
+            sent_before=self.now.strftime('%Y-%m-%dT%H:%M:%S'),
+        )
+        messages = conversation_messages(view, self.conversation.pk, view.request.GET)
+        self.assertUsesIndex(messages, 'messages_conv_sent_idx', ordered=True)
+
+    def test_conversation_last_message(self):
+        """Список бесед с последним сообщением (подзапрос ConversationListView)"""
+        conversations = self.view(ConversationListView).get_queryset(self.conversation_ids)
+        self.assertUsesIndex(conversations, 'messages_conv_sent_idx')
+
+    def test_message_attachments(self):
+        """Вложения сообщений страницы истории (prefetch_related('attachments'))"""
+        view = self.view(ConversationMessagesView)
+        with CaptureQueriesContext(connection) as queries:
+            list(conversation_messages(view, self.conversation.pk, view.request.GET))
+        attachments = [query['sql'] for query in queries if 'message_attachments' in query['sql']]
+        self.assertEqual(len(attachments), 1, queries.captured_queries)
+        self.assertUsesIndex(attachments[0], 'message_attachments_message_id_c7a3e22d')
+
+    def test_recent_conversations(self):
+        """Последние активные беседы: список бесед в админке"""
+        conversations = self.changelist(Conversation)
+        self.assertUsesIndex(conversations, 'conversations_last_msg_idx', ordered=True)
+
+    def test_unlinked_attachments(self):
+        """Непривязанные вложения (cleanup_attachments)"""
+        attachments = unlinked_attachments(self.now - timedelta(hours=24), 0, 500)
+        # SQLite выбирает поиск NULL по индексу внешнего ключа, он тоже не читает всю таблицу
+        index = 'attachments_unlinked_idx' if connection.vendor == 'postgresql' else \
+            'message_attachments_message_id_c7a3e22d'
+        self.assertUsesIndex(attachments, index)
+
+    def test_user_favorites(self):
+        """Избранные контакты пользователя: favorites/"""
+        self.assertUsesIndex(user_favorites(self.user), 'users_fav_user_friend_idx')
+
+    def test_recently_seen_profiles(self):
+        """Профили, бывшие в сети за последние 7 дней, по убыванию last_seen: список профилей в админке"""
+        profiles = self.changelist(
+            UserProfile,
+            last_seen__gte=(self.now - timedelta(days=7)).date().isoformat(),
+            last_seen__lt=(self.now + timedelta(days=1)).date().isoformat(),
+            o='-4',
+        )
+        self.assertUsesIndex(profiles, 'users_profiles_last_seen_idx', ordered=True)
+
+
+class MessengerTestCase(TestCase):
+    """Два участника беседы и посторонний пользователь; запросы от имени участника"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice, cls.bob, cls.carol = (
+            User.objects.create(username=username) for username in ('sync_alice', 'sync_bob', 'sync_carol')
+        )
+        for user in (cls.alice, cls.bob, cls.carol):
+            UserProfile.objects.get_or_create(user=user)
+
+        cls.conversation = Conversation.objects.create(type=Conversation.GROUP, title='sync', created_by=cls.alice)
+        cls.other = Conversation.objects.create(type=Conversation.GROUP, title='other', created_by=cls.carol)
+        ConversationMember.objects.create(conversation=cls.conversation, user=cls.alice)
+        ConversationMember.objects.create(conversation=cls.conversation, user=cls.bob)
+        ConversationMember.objects.create(conversation=cls.other, user=cls.carol)
+
+    def setUp(self):
+        # Кэш членства живет дольше транзакции теста
+        membership_backend.clear()
+        self.client.defaults['HTTP_X_REMOTE_USER'] = self.alice.username
+
+    def send(self, text, conversation=None, sender=None):
+        """Сообщение через ORM; записи журнала изменений пишутся после коммита"""
+        with self.captureOnCommitCallbacks(execute=True):
+            return Message.objects.create(
+                conversation=conversation or self.conversation, sender=sender or self.bob, text=text
+            )
+
+
+class SyncTests(MessengerTestCase):
+
+    def sync(self, token=None, **params):
+        if token is not None:
+            params['token'] = token
+        response = self.client.get(reverse('sync-list'), params)
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()
+
+    @staticmethod
+    def age_changes(seconds=60):
+        """Сдвигает записи журнала в прошлое, за пределы окна SYNC_SAFETY_LAG"""
+        ChangeLog.objects.update(created_at=timezone.now() - timedelta(seconds=seconds))
+
+    def test_without_token_requires_full_resync(self):
+        self.send('hello')
+        self.age_changes()
+        payload = self.sync()
+        self.assertTrue(payload['full_resync'])
+        self.assertEqual(payload['token'], ChangeLog.objects.latest('id').id)
+
+    def test_returns_changes_after_token(self):
+        token = self.sync()['token']
+        message = self.send('hello')
+        self.age_changes()
+
+        payload = self.sync(token)
+        self.assertFalse(payload['full_resync'])
+        self.assertEqual([m['id'] for m in payload['messages']], [message.id])
+        self.assertGreater(payload['token'], token)
+
+        # С новым токеном изменение повторно не приходит
+        again = self.sync(payload['token'])
+        self.assertEqual(again['messages'], [])
+        self.assertEqual(again['token'], payload['token'])
+
+    def test_fresh_changes_wait_for_safety_lag(self):
+        token = self.sync()['token']
+        message = self.send('hello')
+
+        # Запись моложе SYNC_SAFETY_LAG: соседние id могут быть еще не закоммичены
+        with override_settings(SYNC_SAFETY_LAG=60):
+            payload = self.sync(token)
+        self.assertEqual(payload['messages'], [])
+        self.assertEqual(payload['token'], token)
+
+        self.age_changes(seconds=120)
+        with override_settings(SYNC_SAFETY_LAG=60):
+            payload = self.sync(token)
+        self.assertEqual([m['id'] for m in payload['messages']], [message.id])
+
+    def test_skips_conversations_of_other_users(self):
+        token = self.sync()['token']
+        self.send('secret', conversation=self.other, sender=self.carol)
+        self.age_changes()
+
+        payload = self.sync(token)
+        self.assertEqual(payload['messages'], [])
+        self.assertEqual(payload['conversations'], [])
+
+    def test_profiles_only_of_related_users(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            UserFavorite.objects.create(user=self.carol, friend=self.alice)
+        token = self.sync()['token']
+        for user in (self.bob, self.carol):
+            with self.captureOnCommitCallbacks(execute=True):
+                user.profile.save()
+        self.age_changes()
+
+        # Carol добавила Alice в избранное, но не наоборот: ее профиль Alice не нужен
+        payload = self.sync(token)
+        self.assertEqual([profile['id'] for profile in payload['profiles']], [self.bob.id])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            UserFavorite.objects.create(user=self.alice, friend=self.carol)
+        payload = self.sync(token)
+        self.assertEqual(sorted(profile['id'] for profile in payload['profiles']), [self.bob.id, self.carol.id])
+
+    def test_deleted_message(self):
+        message = self.send('hello')
+        token = ChangeLog.objects.latest('id').id
+        message_id = message.id
+        with self.captureOnCommitCallbacks(execute=True):
+            message.delete()
+        self.age_changes()
+
+        payload = self.sync(token)
+        self.assertEqual(payload['messages'], [])
+        self.assertEqual(payload['deleted']['messages'], [message_id])
+
+    def test_removed_member_loses_conversation(self):
+        token = self.sync()['token']
+        member = ConversationMember.objects.get(conversation=self.conversation, user=self.alice)
+        member_id = member.id
+        with self.captureOnCommitCallbacks(execute=True):
+            member.delete()
+        self.age_changes()
+
+        payload = self.sync(token)
+        self.assertEqual(payload['deleted']['members'], [member_id])
+        self.assertEqual(payload['deleted']['conversations'], [self.conversation.id])
+
+    def test_limit_splits_changes(self):
+        token = self.sync()['token']
+        messages = [self.send(f'message {i}') for i in range(3)]
+        self.age_changes()
+
+        first = self.sync(token, limit=2)
+        self.assertTrue(first['has_more'])
+        second = self.sync(first['token'], limit=2)
+        self.assertFalse(second['has_more'])
+
+        received = [m['id'] for m in first['messages'] + second['messages']]
+        self.assertEqual(sorted(received), [message.id for message in messages])
+
+    def test_full_resync_after_changelog_pruned(self):
+        self.send('seen')
+        token = ChangeLog.objects.latest('id').id
+        self.send('old')
+        self.send('older')
+        self.age_changes(seconds=3600)
+        self.send('recent')
+
+        # Записи старше часа удалены: токен клиента указывает на удаленную часть журнала
+        pruned = prune_changelog_batch(timezone.now() - timedelta(minutes=30), batch_size=100)
+        self.assertEqual(pruned, 3)
+
+        payload = self.sync(token)
+        self.assertTrue(payload['full_resync'])
+        self.assertEqual(payload['token'], ChangeLog.objects.latest('id').id)
+
+    def test_token_at_pruning_boundary_is_still_incremental(self):
+        self.send('old')
+        token = ChangeLog.objects.latest('id').id
+        self.send('kept')
+        kept = ChangeLog.objects.latest('id')
+        ChangeLog.objects.filter(pk=token).update(created_at=timezone.now() - timedelta(hours=2))
+        ChangeLog.objects.filter(pk=kept.pk).update(created_at=timezone.now() - timedelta(minutes=1))
+
+        prune_changelog_batch(timezone.now() - timedelta(hours=1), batch_size=100)
+
+        # Удалены только записи, которые клиент уже получил
+        payload = self.sync(token)
+        self.assertFalse(payload['full_resync'])
+        self.assertEqual([m['text'] for m in payload['messages']], ['kept'])
+
+
+class EtagTests(MessengerTestCase):
+
+    def etag(self, name, **kwargs):
+        response = self.client.get(reverse(name, kwargs=kwargs))
+        self.assertEqual(response.status_code, 200, response.content)
+        return response['ETag']
+
+    def touch_profile(self, user):
+        with self.captureOnCommitCallbacks(execute=True):
+            user.profile.save()
+
+    def test_conversations_depend_only_on_members_profiles(self):
+        list_etag = self.etag('conversations-list')
+        detail_etag = self.etag('conversations-detail', pk=self.conversation.pk)
+
+        self.touch_profile(self.carol)
+        self.assertEqual(self.etag('conversations-list'), list_etag)
+        self.assertEqual(self.etag('conversations-detail', pk=self.conversation.pk), detail_etag)
+
+        self.touch_profile(self.bob)
+        self.assertNotEqual(self.etag('conversations-list'), list_etag)
+        self.assertNotEqual(self.etag('conversations-detail', pk=self.conversation.pk), detail_etag)
+
+    def test_favorites_depend_only_on_friends_profiles(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            UserFavorite.objects.create(user=self.alice, friend=self.carol)
+        etag = self.etag('favorites-list')
+
+        self.touch_profile(self.bob)
+        self.assertEqual(self.etag('favorites-list'), etag)
+
+        self.touch_profile(self.carol)
+        self.assertNotEqual(self.etag('favorites-list'), etag)
+
+    def test_not_modified(self):
+        etag = self.etag('conversations-list')
+        response = self.client.get(reverse('conversations-list'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+
+class ClientMessageIdTests(MessengerTestCase):
+
+    def post(self, client_message_id, conversation=None, text='hello'):
+        return self.client.post(reverse('messages-list'), {
+            'conversation': (conversation or self.conversation).id,
+            'text': text,
+            'client_message_id': client_message_id,
+        }, content_type='application/json')
+
+    def test_retry_returns_original_message(self):
+        with mock.patch('api.views.send_message') as send_message, \
+                self.captureOnCommitCallbacks(execute=True):
+            first = self.post('retry-1')
+            second = self.post('retry-1')
+
+        self.assertEqual(first.status_code, 201, first.content)
+        self.assertEqual(second.status_code, 200, second.content)
+        self.assertEqual(first.json()['id'], second.json()['id'])
+        self.assertEqual(Message.objects.filter(client_message_id='retry-1').count(), 1)
+        self.assertEqual(MessageClientKey.objects.filter(client_message_id='retry-1').count(), 1)
+        send_message.assert_called_once()
+
+    def test_same_id_from_other_sender_is_independent(self):
+        self.post('shared-id')
+        self.client.defaults['HTTP_X_REMOTE_USER'] = self.bob.username
+        response = self.post('shared-id')
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertEqual(MessageClientKey.objects.filter(client_message_id='shared-id').count(), 2)
+
+    def test_reuse_in_other_conversation_conflicts(self):
+        conversation = Conversation.objects.create(type=Conversation.GROUP, title='second', created_by=self.alice)
+        ConversationMember.objects.create(conversation=conversation, user=self.alice)
+
+        self.post('moved')
+        response = self.post('moved', conversation=conversation)
+        self.assertEqual(response.status_code, 409, response.content)
+
+    def test_concurrent_retry_loses_on_key(self):
+        """Повтор, не нашедший оригинал при проверке, упирается в MessageClientKey и получает оригинал"""
+        original = self.post('race').json()
+        existing = Message.objects.get(pk=original['id'])
+
+        with mock.patch('api.views.MessageViewSet.find_client_message', side_effect=[None, existing]), \
+                mock.patch('api.views.send_message') as send_message, \
+                self.captureOnCommitCallbacks(execute=True):
+            response = self.post('race')
+
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(response.json()['id'], original['id'])
+        self.assertEqual(Message.objects.filter(client_message_id='race').count(), 1)
+        # Откаченное сообщение не рассылается
+        send_message.assert_not_called()
+
+    def test_websocket_retry_returns_original_message(self):
+        data = {'conversation': self.conversation.id, 'text': 'hello', 'client_message_id': 'ws-1'}
+        with mock.patch('api.utils.send_message') as send_message, \
+                self.captureOnCommitCallbacks(execute=True):
+            first = ws_actions.create_message(self.alice, data)
+            second = ws_actions.create_message(self.alice, data)
+
+        self.assertEqual(first['id'], second['id'])
+        self.assertEqual(Message.objects.filter(client_message_id='ws-1').count(), 1)
+        send_message.assert_called_once()
+
+    def test_websocket_concurrent_retry_loses_on_key(self):
+        data = {'conversation': self.conversation.id, 'text': 'hello', 'client_message_id': 'ws-race'}
+        original = ws_actions.create_message(self.alice, data)
+        existing = Message.objects.get(pk=original['id'])
+
+        with mock.patch('api.ws_actions._find_client_message', side_effect=[None, existing]), \
+                mock.patch('api.utils.send_message') as send_message, \
+                self.captureOnCommitCallbacks(execute=True):
+            retry = ws_actions.create_message(self.alice, data)
+
+        self.assertEqual(retry['id'], original['id'])
+        self.assertEqual(MessageClientKey.objects.filter(client_message_id='ws-race').count(), 1)
+        send_message.assert_not_called()
+
+    def test_rolled_back_message_releases_client_id(self):
+        data = {'conversation': self.conversation.id, 'text': 'hello', 'client_message_id': 'rollback'}
+        with mock.patch('api.utils.send_message') as send_message, \
+                self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    ws_actions.create_message(self.alice, data)
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+        send_message.assert_not_called()
+        self.assertFalse(MessageClientKey.objects.filter(client_message_id='rollback').exists())
+
+        # Клиент может отправить сообщение повторно
+        message = ws_actions.create_message(self.alice, data)
+        self.assertTrue(Message.objects.filter(pk=message['id']).exists())
+
+
+@override_settings(DATABASE_REPLICAS=['replica'])
+class BatchReplicaRoutingTests(TransactionTestCase):
+    """
+    Реплика - отдельный файл SQLite со схемой, но без строк: чтение, ушедшее
+    на нее, видно по пустому ответу. Данные в основной БД закоммичены, чтобы их
+    видели соединения рабочих потоков batch.
+    """
+    # Псевдоним replica регистрируется в setUpClass, '__all__' раскрывается после этого
+    databases = '__all__'
+
+    @classmethod
+    def setUpClass(cls):
+        handle, cls.replica_path = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(handle)
+        connections.settings['replica'] = {
+            **connections['default'].settings_dict, 'ENGINE': 'django.db.backends.sqlite3', 'NAME': cls.replica_path,
+            'OPTIONS': {}, 'CONN_MAX_AGE': 0, 'CONN_HEALTH_CHECKS': False,
+        }
+        with connections['replica'].schema_editor() as editor:
+            for app_label in ('auth', 'contenttypes', 'api'):
+                for model in apps.get_app_config(app_label).get_models():
+                    editor.create_model(model)
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        connections['replica'].close()
+        del connections['replica']
+        del connections.settings['replica']
+        os.remove(cls.replica_path)
+
+    def setUp(self):
+        membership_backend.clear()
+        db_routers.lag_monitor.reset()
+        self.user = User.objects.create(username='batch_user')
+        conversation = Conversation.objects.create(type=Conversation.GROUP, title='batch', created_by=self.user)
+        ConversationMember.objects.create(conversation=conversation, user=self.user)
+        self.message = Message.objects.create(conversation=conversation, sender=self.user, text='fresh')
+        self.path = f'messages/?conversation_id={conversation.id}'
+
+    def batch(self, concurrent):
+        response = self.client.post(reverse('batch'), {
+            'requests': [{'method': 'GET', 'path': self.path}] * 3,
+            'concurrent': concurrent,
+        }, content_type='application/json', HTTP_X_REMOTE_USER=self.user.username)
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()['responses']
+
+    def test_replica_is_stale(self):
+        response = self.client.get(f'/messenger/api/{self.path}', HTTP_X_REMOTE_USER=self.user.username)
+        self.assertEqual(response.json(), [])
+
+    def test_subrequests_read_from_primary(self):
+        # POST batch читает из основной БД - и последовательно, и в рабочих потоках
+        for concurrent in (False, True):
+            for entry in self.batch(concurrent):
+                self.assertEqual(entry['status'], 200, entry)
+                self.assertEqual([message['id'] for message in entry['body']], [self.message.id])
@@ -0,0 +1,77 @@
+"""
+Индикатор набора текста.
+
+Клиент может присылать typing на каждое нажатие клавиши, но в беседу
+уходит не больше одного события за половину TTL на пару (пользователь, беседа).
+Получатели сами скрывают индикатор через expires_in секунд, поэтому
+отдельное событие "перестал печатать" не нужно.
+"""
+import threading
+import time
+
+from django.conf import settings
+
+# Как часто чистить истекшие записи коалесцера
+PURGE_INTERVAL = 60
+
+
+def conversation_group(conversation_id):
+    """Группа channel layer со всеми соединениями участников беседы"""
+    return f"conversation_{conversation_id}"
+
+
+class TypingCoalescer:
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self._expires = {}  # (user_id, conversation_id) -> monotonic время истечения
+        self._lock = threading.Lock()
+        self._next_purge = time.monotonic() + PURGE_INTERVAL
+
+    def get_ttl(self):
+        return self.ttl if self.ttl is not None else getattr(settings, 'TYPING_TTL', 5)
+
+    def should_broadcast(self, user_id, conversation_id):
+        """
+        True, если событие нужно разослать. Пока до истечения
+        разосланного индикатора больше половины TTL, новые события поглощаются
+        """
+        ttl = self.get_ttl()
+        now = time.monotonic()
+        key = (user_id, conversation_id)
+
+        with self._lock:
+            if now >= self._next_purge:
+                self._purge(now)
+
+            expires_at = self._expires.get(key)
+            if expires_at is not None and expires_at - now > ttl / 2:
+                return False
+
+            self._expires[key] = now + ttl
+            return True
+
+    def _purge(self, now):
+        self._expires = {key: expires for key, expires in self._expires.items() if expires > now}
+        self._next_purge = now + PURGE_INTERVAL
+
+
+class TokenBucket:
+    """Ограничение частоты входящих событий одного соединения"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def allow(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+typing_coalescer = TypingCoalescer()
@@ -1,7 +1,7 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 
-from . import views
+from . import async_views, views
 
 router = DefaultRouter()
 router.register(r'users', views.UserViewSet, basename='users')
@@ -10,7 +10,15 @@ router.register(r'conversations', views.ConversationViewSet, basename='conversat
 router.register(r'messages', views.MessageViewSet, basename='messages')
 router.register(r'me', views.CurrentUserViewSet, basename='current-user')
 router.register(r'attachments', views.MessageAttachmentViewSet, basename='attachments')
+router.register(r'sync', views.SyncViewSet, basename='sync')
 
 urlpatterns = [
+    path('batch/', views.BatchView.as_view(), name='batch'),
+    path('metrics/', views.MetricsView.as_view(), name='metrics'),
+    # Асинхронные версии нагруженных GET эндпоинтов; остальные методы уходят в ViewSet'ы
+    path('conversations/', async_views.ConversationListView.as_view()),
+    path('conversations/<pk>/messages/', async_views.ConversationMessagesView.as_view()),
+    path('users/', async_views.UserListView.as_view()),
+    path('me/', async_views.CurrentUserView.as_view()),
     path('', include(router.urls)),
 ]
\ No newline at end of file
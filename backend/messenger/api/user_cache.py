@@ -0,0 +1,159 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .db_routers import PRIMARY_DB
+
+
+class UserCache:
+    """
+    Ограниченный LRU кэш пользователей (вместе с профилем) с временем жизни записей
+    внутри процесса. Используется аутентификацией REST и WebSocket по заголовку remote user.
+    """
+
+    def __init__(self, max_size=10000, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # username -> (expires_at, user)
+        self._usernames = {}  # user_id -> username, для инвалидации по id
+        self._lock = threading.Lock()
+
+    def get(self, username):
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is None:
+                return None
+
+            expires_at, user = entry
+            if expires_at < time.monotonic():
+                self._pop(username)
+                return None
+
+            self._entries.move_to_end(username)
+
+        # Отдаем копию: экземпляр из кэша разделяется между запросами
+        return copy.copy(user)
+
+    def set(self, user):
+        if self.max_size <= 0:
+            return
+
+        with self._lock:
+            self._pop(user.username)
+            self._entries[user.username] = (time.monotonic() + self.ttl, copy.copy(user))
+            self._usernames[user.pk] = user.username
+
+            while len(self._entries) > self.max_size:
+                username, (_, evicted) = self._entries.popitem(last=False)
+                self._usernames.pop(evicted.pk, None)
+
+    # Все операции выполняются в памяти, отдельный поток не нужен
+    async def aget(self, username):
+        return self.get(username)
+
+    async def aset(self, user):
+        self.set(user)
+
+    def invalidate(self, user_id=None, username=None):
+        with self._lock:
+            if username is None:
+                username = self._usernames.get(user_id)
+            if username is not None:
+                self._pop(username)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._usernames.clear()
+
+    def _pop(self, username):
+        entry = self._entries.pop(username, None)
+        if entry is not None:
+            self._usernames.pop(entry[1].pk, None)
+
+
+class SharedUserCache:
+    """
+    Кэш пользователей в общем кэше Django (например, Redis) для нескольких процессов:
+    изменение или деактивация пользователя сбрасывает запись сразу во всех процессах
+    """
+
+    def __init__(self, alias, ttl=60):
+        self.alias = alias
+        self.ttl = ttl
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def _user_key(self, username):
+        return f'auth:user:{username}'
+
+    def _username_key(self, user_id):
+        return f'auth:uid:{user_id}'
+
+    def get(self, username):
+        return self.cache.get(self._user_key(username))
+
+    def set(self, user):
+        self.cache.set_many({
+            self._user_key(user.username): user,
+            self._username_key(user.pk): user.username,
+        }, self.ttl)
+
+    async def aget(self, username):
+        return await self.cache.aget(self._user_key(username))
+
+    async def aset(self, user):
+        await self.cache.aset_many({
+            self._user_key(user.username): user,
+            self._username_key(user.pk): user.username,
+        }, self.ttl)
+
+    def invalidate(self, user_id=None, username=None):
+        if username is None:
+            username = self.cache.get(self._username_key(user_id))
+        if username is not None:
+            self.cache.delete(self._user_key(username))
+
+    def clear(self):
+        pass
+
+
+def _create_cache():
+    alias = getattr(settings, 'AUTH_USER_CACHE_BACKEND', 'local')
+    ttl = getattr(settings, 'AUTH_USER_CACHE_TTL', 60)
+    if alias == 'local':
+        return UserCache(max_size=getattr(settings, 'AUTH_USER_CACHE_SIZE', 10000), ttl=ttl)
+    return SharedUserCache(alias, ttl=ttl)
+
+
+user_cache = _create_cache()
+
+
+def _user_queryset():
+    from django.contrib.auth.models import User
+    # Из основной БД, чтобы не закэшировать устаревшие данные с реплики
+    return User.objects.using(PRIMARY_DB).select_related('profile')
+
+
+def get_user_by_username(username):
+    """Возвращает пользователя по логину из кэша или БД. Бросает User.DoesNotExist"""
+    user = user_cache.get(username)
+    if user is None:
+        user = _user_queryset().get(username=username)
+        user_cache.set(user)
+    return user
+
+
+async def aget_user_by_username(username):
+    """Асинхронный вариант get_user_by_username для WebSocket подключений"""
+    user = await user_cache.aget(username)
+    if user is None:
+        user = await _user_queryset().aget(username=username)
+        await user_cache.aset(user)
+    return user
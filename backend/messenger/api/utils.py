@@ -21,18 +21,34 @@ def send_message(instance=None):
         }
     )
 
-def update_message(instance=None):
+# Поля сообщения, которые могут попасть в событие правки
+DELTA_FIELDS = ('text', 'is_edited', 'edited_at', 'sent_at')
+
+
+def update_message(instance=None, fields=None):
+    """
+    Событие правки содержит только id, беседу, версию и измененные поля.
+    Клиент применяет его к своей копии сообщения, если его версия меньше.
+    """
     channel_layer = get_channel_layer()
 
-    serializer = MessageSerializer(instance)
-    serialized_data = serializer.data
+    serializer_fields = MessageSerializer().fields
+    entity = {
+        "id": instance.id,
+        "conversation": instance.conversation_id,
+        "version": instance.version,
+    }
+    for name in fields or DELTA_FIELDS:
+        if name in DELTA_FIELDS:
+            value = getattr(instance, name)
+            entity[name] = serializer_fields[name].to_representation(value) if value is not None else None
 
     async_to_sync(channel_layer.group_send)(
         "messages",
         {
             "type": "message.updated",
             "data": {
-                "entity": serialized_data,
+                "entity": entity,
                 "message": "Updated message",
             }
         }
@@ -40,18 +56,31 @@ def update_message(instance=None):
 
 
 def delete_message(instance=None):
+    """Событие удаления несет только идентификаторы"""
     channel_layer = get_channel_layer()
 
-    serializer = MessageSerializer(instance)
-    serialized_data = serializer.data
-
     async_to_sync(channel_layer.group_send)(
         "messages",
         {
             "type": "message.deleted",
             "data": {
-                "entity": serialized_data,
+                "entity": {
+                    "id": instance.id,
+                    "conversation": instance.conversation_id,
+                },
                 "message": "Deleted message",
             }
         }
-    )
\ No newline at end of file
+    )
+
+
+def notify_membership_changed(user_id):
+    """Сообщает соединениям пользователя, что состав его бесед изменился"""
+    channel_layer = get_channel_layer()
+
+    async_to_sync(channel_layer.group_send)(
+        f"user_{user_id}",
+        {
+            "type": "membership.changed",
+        }
+    )
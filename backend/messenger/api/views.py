@@ -1,16 +1,30 @@
+from datetime import datetime, time
+
+from django.conf import settings
 from django.contrib.auth.models import User
-from django.db.models import Q
+from django.db import IntegrityError, transaction
+from django.db.models import F, OuterRef, Prefetch, Q, Subquery
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
 
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
 from rest_framework.parsers import JSONParser
 from rest_framework.parsers import MultiPartParser, FormParser
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAuthenticated, IsAdminUser
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
 from .serializers import *
 from .utils import send_message, delete_message, update_message
+from .exports import conversation_csv_response, conversation_xlsx_response, conversations_zip_response
+from .membership_cache import get_conversation_ids
+from .sync import build_sync_payload, latest_token, member_user_ids, favorite_user_ids, profiles_condition
+from .etags import ConditionalGetMixin
+from .fieldsets import SparseFieldsetViewMixin
+from .batch import BatchExecutor
+from .metrics import metrics_report, database_pool_stats
 from .models import *
 from .serializers import (
     UserSerializer, ConversationSerializer,
@@ -18,43 +32,139 @@ from .serializers import (
 )
 
 
-class UserViewSet(viewsets.ReadOnlyModelViewSet):
+def sparse_message_queryset(view, queryset):
+    """Загружает для сообщений только то, что запрошено через ?fields= / ?expand="""
+    queryset = view.only_requested(queryset)
+    if view.expands_field('sender'):
+        queryset = queryset.select_related('sender__profile')
+    if view.expands_field('attachments'):
+        queryset = queryset.prefetch_related('attachments')
+    elif view.wants_field('attachments'):
+        queryset = queryset.prefetch_related(
+            Prefetch('attachments', queryset=MessageAttachment.objects.only('id', 'message_id'))
+        )
+    return queryset
+
+
+def filter_sent_range(queryset, params):
+    """
+    Фильтры ?sent_after= / ?sent_before= (дата или дата и время в ISO формате).
+    На PostgreSQL условие по sent_at ограничивает запрос нужными секциями messages
+    """
+    for param, lookup in (('sent_after', 'sent_at__gte'), ('sent_before', 'sent_at__lt')):
+        value = params.get(param)
+        if not value:
+            continue
+        try:
+            parsed = parse_datetime(value)
+            if parsed is None:
+                parsed_date = parse_date(value)
+                parsed = datetime.combine(parsed_date, time.min) if parsed_date else None
+        except ValueError:
+            parsed = None
+        if parsed is None:
+            raise ValidationError({param: 'Ожидается дата в формате ГГГГ-ММ-ДД или ГГГГ-ММ-ДДTЧЧ:ММ[:СС]'})
+        if timezone.is_aware(parsed):
+            # Даты хранятся без часового пояса (USE_TZ = False)
+            parsed = timezone.make_naive(parsed)
+        queryset = queryset.filter(**{lookup: parsed})
+    return queryset
+
+
+def conversation_messages(view, conversation_id, params):
+    """История беседы: выбор полей ?fields= / ?expand= и период ?sent_after= / ?sent_before="""
+    queryset = sparse_message_queryset(view, Message.objects.filter(conversation_id=conversation_id))
+    return filter_sent_range(queryset, params)
+
+
+def with_last_message(queryset):
+    """Добавляет беседам id последнего сообщения (last_message_pk) подзапросом по (conversation_id, sent_at)"""
+    return queryset.annotate(last_message_pk=Subquery(
+        Message.objects.filter(conversation=OuterRef('pk')).order_by('-sent_at', '-id').values('id')[:1]
+    ))
+
+
+def user_favorites(user):
+    return UserFavorite.objects.filter(user=user)
+
+
+def search_users(queryset, search_param):
+    """Поиск пользователей по полям User и связанным полям UserProfile"""
+    if not search_param:
+        return queryset
+
+    return queryset.filter(
+        Q(username__icontains=search_param) |
+        Q(email__icontains=search_param) |
+        Q(first_name__icontains=search_param) |
+        Q(last_name__icontains=search_param) |
+        # Поля из UserProfile
+        Q(profile__first_name__icontains=search_param) |
+        Q(profile__last_name__icontains=search_param) |
+        Q(profile__second_name__icontains=search_param) |
+        Q(profile__staff__icontains=search_param) |
+        Q(profile__filial__icontains=search_param) |
+        Q(profile__email__icontains=search_param) |
+        Q(profile__phone__icontains=search_param) |
+        Q(profile__status__icontains=search_param)
+    ).distinct()  # Добавляем distinct для исключения дубликатов
+
+
+class UserViewSet(ConditionalGetMixin, SparseFieldsetViewMixin, viewsets.ReadOnlyModelViewSet):
     """Просмотр пользователей"""
     serializer_class = UserSerializer
     permission_classes = [IsAuthenticated]
 
+    def get_etag_condition(self):
+        if self.action == 'retrieve':
+            if not str(self.kwargs['pk']).isdigit():
+                return None
+            return Q(entity=ChangeLog.PROFILE, object_id=self.kwargs['pk'])
+        return Q(entity=ChangeLog.PROFILE)
+
     def get_queryset(self):
-        queryset = User.objects.all()
-        search_param = self.request.query_params.get('search', None)
-
-        if search_param:
-            # Ищем по полям User и связанным полям UserProfile
-            queryset = queryset.filter(
-                Q(username__icontains=search_param) |
-                Q(email__icontains=search_param) |
-                Q(first_name__icontains=search_param) |
-                Q(last_name__icontains=search_param) |
-                # Поля из UserProfile
-                Q(profile__first_name__icontains=search_param) |
-                Q(profile__last_name__icontains=search_param) |
-                Q(profile__second_name__icontains=search_param) |
-                Q(profile__staff__icontains=search_param) |
-                Q(profile__filial__icontains=search_param) |
-                Q(profile__email__icontains=search_param) |
-                Q(profile__phone__icontains=search_param) |
-                Q(profile__status__icontains=search_param)
-            ).distinct()  # Добавляем distinct для исключения дубликатов
+        queryset = self.only_requested(User.objects.all())
+        if self.expands_field('profile'):
+            queryset = queryset.select_related('profile')
 
-        return queryset
+        return search_users(queryset, self.request.query_params.get('search', None))
 
 
-class ConversationViewSet(viewsets.ModelViewSet):
+class ConversationViewSet(ConditionalGetMixin, SparseFieldsetViewMixin, viewsets.ModelViewSet):
     permission_classes = [IsAuthenticated]
+    # Для messages поля относятся к сообщениям, а не к беседе
+    sparse_actions = ('list', 'retrieve', 'messages')
+
+    def get_etag_condition(self):
+        # В ответ входят участники с профилями и последнее сообщение
+        if self.action == 'retrieve':
+            if not str(self.kwargs['pk']).isdigit():
+                return None
+            conversation_id = int(self.kwargs['pk'])
+            return Q(conversation_id=conversation_id) | profiles_condition(member_user_ids([conversation_id]))
+
+        conversation_ids = get_conversation_ids(self.request.user.id)
+        return (
+            Q(conversation_id__in=conversation_ids) |
+            Q(entity=ChangeLog.MEMBER, user_id=self.request.user.id) |
+            profiles_condition(member_user_ids(conversation_ids))
+        )
 
     def get_queryset(self):
-        return Conversation.objects.filter(
-            members__user=self.request.user
-        ).distinct()
+        queryset = Conversation.objects.filter(
+            id__in=get_conversation_ids(self.request.user.id)
+        )
+
+        if self.action in ('list', 'retrieve'):
+            queryset = self.only_requested(queryset)
+            if self.expands_field('members'):
+                queryset = queryset.prefetch_related('members__user__profile')
+            elif self.wants_field('members'):
+                queryset = queryset.prefetch_related(
+                    Prefetch('members', queryset=ConversationMember.objects.only('id', 'conversation_id', 'user_id'))
+                )
+
+        return queryset
 
     def get_serializer_class(self):
         if self.action == 'create':
@@ -71,21 +181,80 @@ class ConversationViewSet(viewsets.ModelViewSet):
     @action(detail=True, methods=['get'])
     def messages(self, request, pk=None):
         conversation = self.get_object()
-        messages = conversation.messages.all()
-        serializer = MessageSerializer(messages, many=True)
+        messages = conversation_messages(self, conversation.pk, request.query_params)
+        serializer = MessageSerializer(messages, many=True, context=self.get_serializer_context())
         return Response(serializer.data)
 
+    @action(detail=True, methods=['get'])
+    def export(self, request, pk=None):
+        """
+        Потоковая выгрузка истории беседы.
+        ?file_format=csv|xlsx|zip, для zip ?attachments=1 добавляет файлы вложений
+        """
+        conversation = self.get_object()
+        file_format = request.query_params.get('file_format', 'csv').lower()
+
+        if file_format == 'csv':
+            return conversation_csv_response(conversation)
+        if file_format == 'xlsx':
+            return conversation_xlsx_response(conversation)
+        if file_format == 'zip':
+            include_attachments = request.query_params.get('attachments') in ('1', 'true')
+            return conversations_zip_response(
+                [conversation],
+                include_attachments=include_attachments,
+                filename=f'conversation_{conversation.id}.zip'
+            )
+
+        return Response(
+            {'error': 'Неподдерживаемый формат выгрузки. Доступны: csv, xlsx, zip'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+
 
-class CurrentUserViewSet(viewsets.ViewSet):
+class CurrentUserViewSet(ConditionalGetMixin, SparseFieldsetViewMixin, viewsets.ViewSet):
     """Текущий пользователь"""
     permission_classes = [IsAuthenticated]
 
+    def get_etag_condition(self):
+        return Q(entity=ChangeLog.PROFILE, object_id=self.request.user.id)
+
     def list(self, request):
-        serializer = UserSerializer(request.user)
+        serializer = UserSerializer(request.user, context=self.get_serializer_context())
         return Response(serializer.data)
 
 
-class MessageViewSet(viewsets.ModelViewSet):
+class SyncViewSet(viewsets.ViewSet):
+    """
+    Инкрементальная синхронизация клиента.
+    ?token= - токен из предыдущего ответа, ?limit= - размер пачки изменений.
+    Без токена возвращает текущий токен и признак полной загрузки.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def list(self, request):
+        token = request.query_params.get('token')
+        default_limit = getattr(settings, 'SYNC_BATCH_SIZE', 500)
+        max_limit = getattr(settings, 'SYNC_MAX_BATCH_SIZE', 1000)
+
+        try:
+            limit = int(request.query_params.get('limit', default_limit))
+            token = int(token) if token is not None else None
+        except ValueError:
+            return Response(
+                {'error': 'token и limit должны быть целыми числами'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        limit = max(1, min(limit, max_limit))
+
+        if token is None:
+            return Response({'token': latest_token(), 'has_more': False, 'full_resync': True})
+
+        return Response(build_sync_payload(request.user, token, limit, context={'request': request}))
+
+
+class MessageViewSet(SparseFieldsetViewMixin, viewsets.ModelViewSet):
     permission_classes = [IsAuthenticated]
     # Добавляем поддержку multipart/form-data для загрузки файлов
     parser_classes = [MultiPartParser, FormParser, JSONParser]
@@ -114,21 +283,42 @@ class MessageViewSet(viewsets.ModelViewSet):
         """
         Получаем только сообщения из бесед, где пользователь является участником
         """
-        queryset = Message.objects.filter(
-            conversation__members__user=self.request.user
-        ).select_related('sender', 'conversation').prefetch_related('attachments')
+        conversation_ids = get_conversation_ids(self.request.user.id)
+        queryset = Message.objects.all()
+
+        if self.action in self.sparse_actions:
+            queryset = sparse_message_queryset(self, queryset)
+        else:
+            queryset = queryset.select_related('sender__profile').prefetch_related('attachments')
+
+        if self.action == 'list':
+            queryset = filter_sent_range(queryset, self.request.query_params)
 
         # Опциональная фильтрация по conversation_id
         conversation_id = self.request.query_params.get('conversation_id')
         if conversation_id:
-            queryset = queryset.filter(conversation_id=conversation_id)
+            try:
+                conversation_id = int(conversation_id)
+            except ValueError:
+                return queryset.none()
+            if conversation_id not in conversation_ids:
+                return queryset.none()
+            return queryset.filter(conversation_id=conversation_id)
 
-        return queryset
+        return queryset.filter(conversation_id__in=conversation_ids)
 
     def create(self, request, *args, **kwargs):
         """
         Переопределяем метод create для обработки файлов
         """
+        # Повтор уже доставленного сообщения: возвращаем оригинал без вставки,
+        # загрузки файлов и повторной рассылки
+        client_message_id = request.data.get('client_message_id')
+        if client_message_id:
+            existing = self.find_client_message(client_message_id)
+            if existing is not None:
+                return self.client_message_response(existing, request)
+
         # Проверяем, есть ли файлы в запросе
         has_files = any(key.startswith('files') or key.startswith('attachments')
                         for key in request.FILES.keys())
@@ -146,7 +336,15 @@ class MessageViewSet(viewsets.ModelViewSet):
         serializer.is_valid(raise_exception=True)
 
         try:
-            self.perform_create(serializer)
+            # Сообщение и его client_message_id (MessageClientKey) создаются вместе
+            with transaction.atomic():
+                self.perform_create(serializer)
+        except IntegrityError:
+            # Параллельный повтор с тем же client_message_id успел вставить сообщение первым
+            existing = self.find_client_message(client_message_id) if client_message_id else None
+            if existing is None:
+                raise
+            return self.client_message_response(existing, request)
         except Exception as e:
             return Response(
                 {'error': f'Ошибка при создании сообщения: {str(e)}'},
@@ -167,19 +365,39 @@ class MessageViewSet(viewsets.ModelViewSet):
             headers=headers
         )
 
+    def find_client_message(self, client_message_id):
+        return Message.objects.select_related('sender__profile').prefetch_related('attachments').filter(
+            sender=self.request.user, client_message_id=client_message_id
+        ).first()
+
+    def client_message_response(self, message, request):
+        """Ответ на повторную отправку сообщения с тем же client_message_id"""
+        conversation_id = request.data.get('conversation')
+        if conversation_id and str(conversation_id) != str(message.conversation_id):
+            return Response(
+                {'error': 'client_message_id уже использован для сообщения в другой беседе'},
+                status=status.HTTP_409_CONFLICT
+            )
+
+        serializer = MessageSerializer(message, context={'request': request})
+        return Response(serializer.data, status=status.HTTP_200_OK)
+
     def perform_update(self, serializer):
         """
         Обновляем сообщение и отправляем через update_message
         """
-        instance = serializer.save(sender=self.request.user)
-        instance.is_edited = True
-        instance.edited_at = timezone.now()
-        instance.save()
+        instance = serializer.save(
+            sender=self.request.user,
+            is_edited=True,
+            edited_at=timezone.now(),
+            version=F('version') + 1,
+        )
+        instance.refresh_from_db(fields=['version'])
 
         # TODO Обновляем время последнего изменения сообщения в беседе
 
         try:
-            update_message(instance)
+            update_message(instance, fields=list(serializer.validated_data) + ['is_edited', 'edited_at'])
         except Exception as e:
             # Логируем ошибку, но не прерываем выполнение
             import logging
@@ -189,17 +407,23 @@ class MessageViewSet(viewsets.ModelViewSet):
 
     def perform_create(self, serializer):
         """
-        Сохраняем сообщение и отправляем через send_message
+        Сохраняем сообщение и отправляем через send_message после коммита.
+        Вызывается внутри transaction.atomic() из create
         """
         instance = serializer.save(sender=self.request.user)
+        MessageClientKey.claim(instance)
 
         # TODO Обновляем время последнего сообщения в беседе
         # instance.conversation.last_message_at = instance.timestamp
         # instance.conversation.save(update_fields=['last_message_at'])
 
-        # Отправляем сообщение
+        # Иначе при откате (например, повтор client_message_id) клиенты получат несуществующее сообщение
+        transaction.on_commit(lambda: self.broadcast_created(instance))
+
+    @staticmethod
+    def broadcast_created(message):
         try:
-            send_message(instance)
+            send_message(message)
         except Exception as e:
             # Логируем ошибку, но не прерываем выполнение
             import logging
@@ -207,16 +431,24 @@ class MessageViewSet(viewsets.ModelViewSet):
             logger.error(f"Error sending message via send_message: {str(e)}")
 
     def perform_destroy(self, instance):
-        MessageAttachment.objects.filter(message=instance).delete()
-        # Удаляем сообщение
+        # delete() обнуляет pk экземпляра, поэтому событию передаем копию идентификаторов
+        deleted = Message(id=instance.id, conversation_id=instance.conversation_id)
+
+        with transaction.atomic():
+            MessageAttachment.objects.filter(message=instance).delete()
+            # Удаляем сообщение
+            instance.delete()
+            transaction.on_commit(lambda: self.broadcast_deleted(deleted))
+
+    @staticmethod
+    def broadcast_deleted(message):
         try:
-            delete_message(instance)
+            delete_message(message)
         except Exception as e:
             # Логируем ошибку, но не прерываем выполнение
             import logging
             logger = logging.getLogger(__name__)
             logger.error(f"Error delete message via delete_message: {str(e)}")
-        instance.delete()
 
     @action(detail=True, methods=['post'])
     def add_attachment(self, request, pk=None):
@@ -297,7 +529,7 @@ class MessageAttachmentViewSet(viewsets.ReadOnlyModelViewSet):
         где пользователь является участником беседы
         """
         queryset = MessageAttachment.objects.filter(
-            message__conversation__members__user=self.request.user
+            message__conversation_id__in=get_conversation_ids(self.request.user.id)
         )
 
         # Опциональная фильтрация по message_id
@@ -395,7 +627,7 @@ class MessageAttachmentViewSet(viewsets.ReadOnlyModelViewSet):
                 try:
                     message = Message.objects.get(
                         id=message_id,
-                        conversation__members__user=request.user
+                        conversation_id__in=get_conversation_ids(request.user.id)
                     )
                     attachment.message = message
                 except Message.DoesNotExist:
@@ -444,9 +676,64 @@ class MessageAttachmentViewSet(viewsets.ReadOnlyModelViewSet):
             )
 
 
-class FavoritesViewSet(viewsets.ModelViewSet):
+class FavoritesViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     permission_classes = [IsAuthenticated]
     serializer_class = UserFavoritesSerializer
 
+    def get_etag_condition(self):
+        # В ответ входят профили пользователя и друзей
+        user_id = self.request.user.id
+        return (
+            Q(entity=ChangeLog.FAVORITE, user_id=user_id) |
+            profiles_condition(favorite_user_ids(user_id) | {user_id})
+        )
+
     def get_queryset(self):
-        return UserFavorite.objects.filter(user=self.request.user)
+        return user_favorites(self.request.user)
+
+
+class BatchView(APIView):
+    """
+    Несколько запросов к API за один round trip.
+    {"requests": [{"method": "GET", "path": "me/", "headers": {...}, "body": {...}}], "concurrent": false}
+    concurrent=true выполняет запросы параллельно, если все они на чтение.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        specs = request.data.get('requests')
+        max_requests = getattr(settings, 'BATCH_MAX_REQUESTS', 20)
+
+        if not isinstance(specs, list) or not specs:
+            return Response(
+                {'error': 'Поле requests должно быть непустым списком'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        if len(specs) > max_requests:
+            return Response(
+                {'error': f'Не более {max_requests} запросов в одной пачке'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        # Префикс API, относительно которого разрешаются пути вложенных запросов
+        api_prefix = request.path[:request.path.rindex('batch/')]
+        executor = BatchExecutor(request, api_prefix, type(self))
+        responses = executor.run(specs, concurrent=bool(request.data.get('concurrent')))
+
+        return Response({'responses': responses})
+
+
+class MetricsView(APIView):
+    """
+    Метрики (очереди WebSocket, соединения, пул БД) для staff пользователей.
+    Счетчики и измерители - сумма по процессам при общем METRICS_BACKEND,
+    иначе только процесса, принявшего запрос; пул БД - всегда этого процесса
+    """
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        data = metrics_report()
+        data['db_pool'] = database_pool_stats()
+        return Response(data)
+
@@ -0,0 +1,93 @@
+"""
+Формат кадров WebSocket.
+
+По умолчанию кадры - JSON. Клиент может запросить подпротокол
+messenger.msgpack: тогда кадры бинарные, в MessagePack, а известные ключи
+заменены короткими (таблица SHORT_KEYS). Неизвестные ключи передаются как есть.
+"""
+try:
+    import msgpack
+except ImportError:  # msgpack необязателен, без него доступен только JSON
+    msgpack = None
+
+MSGPACK_SUBPROTOCOL = 'messenger.msgpack'
+
+SHORT_KEYS = {
+    # Конверт события и команды
+    'type': 't',
+    'entity': 'e',
+    'message': 'm',
+    'action': 'a',
+    'request_id': 'r',
+    'data': 'd',
+    'ok': 'ok',
+    'errors': 'er',
+    'reason': 'rs',
+    'sync_url': 'su',
+    # Сообщение
+    'id': 'i',
+    'conversation': 'c',
+    'sender': 's',
+    'text': 'x',
+    'attachments': 'at',
+    'sent_at': 'sa',
+    'edited_at': 'ea',
+    'is_edited': 'ie',
+    'client_message_id': 'cm',
+    'version': 'v',
+    # Пользователь и профиль
+    'user': 'u',
+    'username': 'un',
+    'email': 'em',
+    'first_name': 'fn',
+    'last_name': 'ln',
+    'second_name': 'sn',
+    'profile': 'p',
+    'avatar': 'av',
+    'status': 'st',
+    'last_seen': 'ls',
+    'online': 'on',
+    'expires_in': 'ex',
+    # Вложение
+    'file_name': 'f',
+    'file_size': 'fs',
+    'human_readable_size': 'hs',
+    'mime_type': 'mt',
+    'file_extension': 'fe',
+    'file_type': 'ft',
+    'uploaded_at': 'ua',
+    'file_url': 'fu',
+    'download_url': 'du',
+}
+
+LONG_KEYS = {short: long for long, short in SHORT_KEYS.items()}
+
+
+def msgpack_available():
+    return msgpack is not None
+
+
+def _rename_keys(value, table):
+    if isinstance(value, dict):
+        return {table.get(key, key): _rename_keys(item, table) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_rename_keys(item, table) for item in value]
+    return value
+
+
+def compact(payload):
+    """Заменяет известные ключи короткими"""
+    return _rename_keys(payload, SHORT_KEYS)
+
+
+def expand(payload):
+    """Восстанавливает полные ключи во входящем кадре"""
+    return _rename_keys(payload, LONG_KEYS)
+
+
+def pack(payload):
+    return msgpack.packb(compact(payload), use_bin_type=True)
+
+
+def unpack(data):
+    return expand(msgpack.unpackb(data, raw=False))
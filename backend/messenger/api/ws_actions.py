@@ -0,0 +1,119 @@
+"""
+Команды, которые клиент отправляет через WebSocket (см. MessagesConsumer.receive_json).
+Функции синхронные: consumer вызывает их через database_sync_to_async.
+"""
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from . import utils
+from .membership_cache import is_member
+from .models import ChangeLog, ConversationMember, Message, MessageAttachment, MessageClientKey
+from .serializers import MessageSerializer
+from .sync import record_change
+
+
+class CommandError(Exception):
+    """Ошибка выполнения команды, возвращается клиенту в подтверждении"""
+
+    def __init__(self, errors):
+        super().__init__(str(errors))
+        self.errors = errors
+
+
+def _get_own_message(user, message_id):
+    try:
+        message = Message.objects.select_related('sender__profile').get(pk=int(message_id))
+    except (TypeError, ValueError, Message.DoesNotExist):
+        raise CommandError({'id': 'Сообщение не найдено'})
+
+    if not is_member(user.id, message.conversation_id):
+        raise CommandError({'id': 'Сообщение не найдено'})
+    if message.sender_id != user.id:
+        raise CommandError({'id': 'Можно изменять только свои сообщения'})
+    return message
+
+
+def _find_client_message(user, client_message_id):
+    return Message.objects.select_related('sender__profile').prefetch_related('attachments').filter(
+        sender=user, client_message_id=client_message_id
+    ).first()
+
+
+def create_message(user, data):
+    """Создает текстовое сообщение. Повтор с тем же client_message_id возвращает оригинал"""
+    client_message_id = data.get('client_message_id')
+    if client_message_id:
+        existing = _find_client_message(user, client_message_id)
+        if existing is not None:
+            return MessageSerializer(existing).data
+
+    serializer = MessageSerializer(data=data)
+    if not serializer.is_valid():
+        raise CommandError(serializer.errors)
+
+    conversation = serializer.validated_data['conversation']
+    if not is_member(user.id, conversation.id):
+        raise CommandError({'conversation': 'Вы не являетесь участником этой беседы'})
+
+    try:
+        with transaction.atomic():
+            message = serializer.save(sender=user)
+            MessageClientKey.claim(message)
+            # Рассылаем только после коммита: при откате клиенты не получат несуществующее сообщение
+            transaction.on_commit(lambda: utils.send_message(message))
+    except IntegrityError:
+        existing = _find_client_message(user, client_message_id) if client_message_id else None
+        if existing is None:
+            raise
+        return MessageSerializer(existing).data
+
+    return serializer.data
+
+
+def edit_message(user, data):
+    message = _get_own_message(user, data.get('id'))
+
+    serializer = MessageSerializer(message, data={'text': data.get('text')}, partial=True)
+    if not serializer.is_valid():
+        raise CommandError(serializer.errors)
+
+    message = serializer.save(is_edited=True, edited_at=timezone.now(), version=F('version') + 1)
+    message.refresh_from_db(fields=['version'])
+    utils.update_message(message, fields=['text', 'is_edited', 'edited_at'])
+    return MessageSerializer(message).data
+
+
+def delete_message(user, data):
+    message = _get_own_message(user, data.get('id'))
+    # delete() обнуляет pk экземпляра, поэтому событию передаем копию идентификаторов
+    deleted = Message(id=message.id, conversation_id=message.conversation_id)
+
+    with transaction.atomic():
+        MessageAttachment.objects.filter(message=message).delete()
+        message.delete()
+        # Рассылаем только после коммита, иначе при откате клиенты уберут существующее сообщение
+        transaction.on_commit(lambda: utils.delete_message(deleted))
+
+    return {'id': deleted.id}
+
+
+def mark_read(user, data):
+    """Отмечает беседу прочитанной текущим пользователем"""
+    try:
+        conversation_id = int(data.get('conversation'))
+    except (TypeError, ValueError):
+        raise CommandError({'conversation': 'Некорректный идентификатор беседы'})
+
+    member_id = ConversationMember.objects.filter(
+        user_id=user.id, conversation_id=conversation_id
+    ).values_list('id', flat=True).first()
+    if member_id is None:
+        raise CommandError({'conversation': 'Вы не являетесь участником этой беседы'})
+
+    # update() без сигналов, поэтому запись в журнал синхронизации добавляем сами
+    read_at = timezone.now()
+    ConversationMember.objects.filter(pk=member_id).update(last_read_at=read_at)
+    record_change(ChangeLog.MEMBER, ChangeLog.UPSERT, member_id,
+                  conversation_id=conversation_id, user_id=user.id)
+    return {'conversation': conversation_id, 'last_read_at': read_at.isoformat()}
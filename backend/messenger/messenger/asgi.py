@@ -2,8 +2,6 @@ import os
 
 from django.core.asgi import get_asgi_application
 
-from api.consumers import MessagesConsumer
-
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'messenger.settings')
 
 # Инициализируем Django перед импортом middleware
@@ -13,7 +11,8 @@ from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.auth import AuthMiddlewareStack
 from django.urls import path
 
-# Импортируем middleware ПОСЛЕ инициализации Django
+# Импортируем middleware и consumers ПОСЛЕ инициализации Django
+from api.consumers import MessagesConsumer
 from api.middleware import WebSocketRemoteUserMiddleware
 
 application = ProtocolTypeRouter({
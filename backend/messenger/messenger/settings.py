@@ -1,7 +1,9 @@
 from enum import verify
 from pathlib import Path
+import math
 import os
 from dotenv import load_dotenv
+from django.core.exceptions import ImproperlyConfigured
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -29,6 +31,8 @@ MINIO_USE_HTTPS = False
 MINIO_MEDIA_BUCKET_NAME = os.getenv('MINIO_MEDIA_BUCKET_NAME', 'django-media')
 MINIO_STATIC_BUCKET_NAME = os.getenv('MINIO_STATIC_BUCKET_NAME', 'django-static')
 MINIO_EXTERNAL_ENDPOINT = os.getenv('MINIO_EXTERNAL_ENDPOINT', MINIO_ENDPOINT)
+# Количество потоков для параллельной загрузки вложений одного сообщения
+ATTACHMENT_UPLOAD_WORKERS = int(os.getenv('ATTACHMENT_UPLOAD_WORKERS', 4))
 
 ALLOWED_HOSTS = ['127.0.0.1', 'localhost', 'test-vapp-03.sgp.ru',
                  'sco1-vapp-04.sgp.ru', '0.0.0.0', 'sco1-vapp-09.sgp.ru']
@@ -51,7 +55,8 @@ INSTALLED_APPS = [
 # Добавьте 'storages' после staticfiles
 INSTALLED_APPS.insert(INSTALLED_APPS.index('django.contrib.staticfiles') + 1, 'storages')
 
-# Channels
+# Channels. Слой в памяти работает только внутри одного процесса; при REDIS_URL
+# используется общий слой Redis (ниже), без него runasgi запускает один процесс
 CHANNEL_LAYERS = {
     "default": {
         "BACKEND": "channels.layers.InMemoryChannelLayer",
@@ -84,6 +89,7 @@ MIDDLEWARE = [
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'api.middleware.RemoteUserMiddleware',
+    'api.db_routers.ReadYourWritesMiddleware',
 ]
 
 AUTHENTICATION_BACKENDS = [
@@ -91,6 +97,109 @@ AUTHENTICATION_BACKENDS = [
     'api.backends.RemoteUserBackend',
 ]
 
+# Кэш пользователей для аутентификации по remote user (REST и WebSocket)
+AUTH_USER_CACHE_SIZE = int(os.getenv('AUTH_USER_CACHE_SIZE', 10000))
+AUTH_USER_CACHE_TTL = int(os.getenv('AUTH_USER_CACHE_TTL', 60))  # секунды
+
+# Кэш
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+}
+
+# Общий кэш для нескольких процессов (нужен пакет redis)
+REDIS_URL = os.getenv('REDIS_URL')
+if REDIS_URL:
+    CACHES['shared'] = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': REDIS_URL,
+    }
+    # События из REST запросов и других процессов доходят до всех WebSocket соединений
+    CHANNEL_LAYERS['default'] = {
+        'BACKEND': 'channels_redis.core.RedisChannelLayer',
+        'CONFIG': {'hosts': [REDIS_URL]},
+    }
+
+# Кэш пользователей для аутентификации: 'local' - в памяти процесса, иначе имя кэша из CACHES.
+# При нескольких процессах нужен общий кэш, иначе деактивация доходит до других процессов через TTL
+AUTH_USER_CACHE_BACKEND = os.getenv('AUTH_USER_CACHE_BACKEND', 'shared' if REDIS_URL else 'local')
+
+# Кэш членства в беседах: 'local' - в памяти процесса, иначе имя кэша из CACHES.
+# Инвалидация local доходит только до процесса, изменившего состав беседы
+MEMBERSHIP_CACHE_BACKEND = os.getenv('MEMBERSHIP_CACHE_BACKEND', 'shared' if REDIS_URL else 'local')
+MEMBERSHIP_CACHE_SIZE = int(os.getenv('MEMBERSHIP_CACHE_SIZE', 10000))
+MEMBERSHIP_CACHE_TTL = int(os.getenv('MEMBERSHIP_CACHE_TTL', 300))  # секунды
+
+# Инкрементальная синхронизация (эндпоинт sync/)
+SYNC_BATCH_SIZE = int(os.getenv('SYNC_BATCH_SIZE', 500))
+SYNC_MAX_BATCH_SIZE = int(os.getenv('SYNC_MAX_BATCH_SIZE', 1000))
+SYNC_SAFETY_LAG = int(os.getenv('SYNC_SAFETY_LAG', 2))  # секунды
+# Сколько дней хранить журнал изменений; клиент со старым токеном получит full_resync
+SYNC_CHANGELOG_RETENTION_DAYS = int(os.getenv('SYNC_CHANGELOG_RETENTION_DAYS', 30))
+
+# Присутствие: как часто сбрасывать last_seen в БД, секунды
+PRESENCE_FLUSH_INTERVAL = int(os.getenv('PRESENCE_FLUSH_INTERVAL', 30))
+# Счетчики соединений: 'local' - в памяти процесса, иначе имя кэша из CACHES.
+# С local при нескольких процессах закрытие соединения в одном из них объявляет
+# пользователя вышедшим из сети, хотя он подключен к другому
+PRESENCE_BACKEND = os.getenv('PRESENCE_BACKEND', 'shared' if REDIS_URL else 'local')
+
+# Индикатор набора текста: время жизни (секунды) и лимит событий от одного соединения
+TYPING_TTL = int(os.getenv('TYPING_TTL', 5))
+TYPING_RATE = float(os.getenv('TYPING_RATE', 2))  # событий в секунду
+TYPING_BURST = int(os.getenv('TYPING_BURST', 5))
+
+# Метрики (эндпоинт metrics/): 'local' - только процесса, принявшего запрос,
+# иначе имя кэша из CACHES, куда каждый процесс раз в METRICS_PUBLISH_INTERVAL
+# секунд записывает свой снимок, а metrics/ суммирует снимки всех процессов
+METRICS_BACKEND = os.getenv('METRICS_BACKEND', 'shared' if REDIS_URL else 'local')
+METRICS_PUBLISH_INTERVAL = int(os.getenv('METRICS_PUBLISH_INTERVAL', 10))
+
+# Очередь исходящих событий WebSocket соединения и политика при переполнении:
+# drop_oldest, coalesce или disconnect
+WS_SEND_QUEUE_SIZE = int(os.getenv('WS_SEND_QUEUE_SIZE', 200))
+WS_SEND_QUEUE_POLICY = os.getenv('WS_SEND_QUEUE_POLICY', 'coalesce')
+
+# Heartbeat WebSocket: интервал ping и время без входящих кадров до отсечения, секунды
+WS_HEARTBEAT_INTERVAL = int(os.getenv('WS_HEARTBEAT_INTERVAL', 25))
+WS_HEARTBEAT_TIMEOUT = int(os.getenv('WS_HEARTBEAT_TIMEOUT', 60))
+
+# Выкатка: за сколько секунд закрыть все WebSocket соединения после SIGTERM
+# и максимальная случайная задержка переподключения клиента. Окно ограничивается
+# сроком ASGI_GRACEFUL_TIMEOUT за вычетом нескольких секунд на остановку
+WS_DRAIN_WINDOW = int(os.getenv('WS_DRAIN_WINDOW', 30))
+WS_DRAIN_JITTER = int(os.getenv('WS_DRAIN_JITTER', 10))
+
+# Production сервер (manage.py runasgi): процессы HTTP и WebSocket пулов,
+# лимит одновременных соединений на процесс и время на остановку
+ASGI_WORKERS = int(os.getenv('ASGI_WORKERS', 0))
+ASGI_WS_WORKERS = int(os.getenv('ASGI_WS_WORKERS', 0))
+ASGI_LIMIT_CONCURRENCY = int(os.getenv('ASGI_LIMIT_CONCURRENCY', 0)) or None
+ASGI_WS_LIMIT_CONCURRENCY = int(os.getenv('ASGI_WS_LIMIT_CONCURRENCY', 0)) or None
+ASGI_GRACEFUL_TIMEOUT = int(os.getenv('ASGI_GRACEFUL_TIMEOUT', 45))
+
+# Секционирование messages по месяцам (PostgreSQL, см. api/partitions.py):
+# на сколько месяцев вперед держать секции и когда переводить секции в архив
+MESSAGES_PARTITIONS_AHEAD = int(os.getenv('MESSAGES_PARTITIONS_AHEAD', 3))
+MESSAGES_ARCHIVE_AFTER_MONTHS = int(os.getenv('MESSAGES_ARCHIVE_AFTER_MONTHS', 12))
+# Табличное пространство для архивных секций (дешевый диск, сжатая ФС); пусто - не переносить
+MESSAGES_ARCHIVE_TABLESPACE = os.getenv('MESSAGES_ARCHIVE_TABLESPACE', '')
+
+# Срок хранения сообщений по типам бесед в днях, 0 - бессрочно. Для отдельной беседы
+# переопределяется полем Conversation.retention_days. Удаление: manage.py purge_expired_messages
+MESSAGES_RETENTION_DAYS = {
+    'private': int(os.getenv('MESSAGES_RETENTION_DAYS_PRIVATE', 0)),
+    'group': int(os.getenv('MESSAGES_RETENTION_DAYS_GROUP', 0)),
+}
+# Размер пачки удаления и пауза между пачками, секунды
+MESSAGES_PURGE_BATCH_SIZE = int(os.getenv('MESSAGES_PURGE_BATCH_SIZE', 500))
+MESSAGES_PURGE_PAUSE = float(os.getenv('MESSAGES_PURGE_PAUSE', 0.2))
+
+# Пакетные запросы (эндпоинт batch/)
+BATCH_MAX_REQUESTS = int(os.getenv('BATCH_MAX_REQUESTS', 20))
+BATCH_MAX_WORKERS = int(os.getenv('BATCH_MAX_WORKERS', 4))
+
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
         'rest_framework.authentication.RemoteUserAuthentication',
@@ -132,6 +241,76 @@ DATABASES = {
     }
 }
 
+# Пул соединений psycopg 3 в каждом процессе: запросы и consumers берут готовое
+# соединение вместо нового подключения к PostgreSQL. Суммарно процессы runasgi
+# держат до (ASGI_WORKERS + ASGI_WS_WORKERS) * DB_POOL_MAX_SIZE соединений.
+# DB_POOL=0 - постоянные соединения на поток с временем жизни DB_CONN_MAX_AGE.
+DB_POOL = os.getenv('DB_POOL', '1') == '1'
+DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', 2))
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', 10))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 10))  # ожидание свободного соединения, секунды
+DB_POOL_MAX_IDLE = float(os.getenv('DB_POOL_MAX_IDLE', 300))  # секунды
+DB_POOL_MAX_LIFETIME = float(os.getenv('DB_POOL_MAX_LIFETIME', 1800))  # секунды
+DB_CONN_MAX_AGE = int(os.getenv('DB_CONN_MAX_AGE', 60))  # секунды
+
+# Проверка соединения перед использованием. Без пула Django проверяет постоянное
+# соединение перед запросом. С пулом Django эту проверку пропускает, но при
+# CONN_HEALTH_CHECKS передает пулу check=ConnectionPool.check_connection, и пул
+# проверяет соединение при выдаче, заменяя разорванное новым. Без этой настройки
+# пул выдает разорванное соединение, и запрос падает. Задавать check в
+# OPTIONS['pool'] повторно нельзя: ConnectionPool получит аргумент дважды
+DATABASES['default']['CONN_HEALTH_CHECKS'] = True
+
+if DB_POOL:
+    DATABASES['default']['OPTIONS']['pool'] = {
+        'min_size': DB_POOL_MIN_SIZE,
+        'max_size': DB_POOL_MAX_SIZE,
+        'timeout': DB_POOL_TIMEOUT,
+        'max_idle': DB_POOL_MAX_IDLE,
+        'max_lifetime': DB_POOL_MAX_LIFETIME,
+    }
+else:
+    DATABASES['default']['CONN_MAX_AGE'] = DB_CONN_MAX_AGE
+
+# Реплики только для чтения (см. api/db_routers.py): DB_REPLICAS=host1:5432,host2:5432.
+# Остальные параметры подключения такие же, как у основной БД
+DB_REPLICAS = [replica.strip() for replica in os.getenv('DB_REPLICAS', '').split(',') if replica.strip()]
+for index, replica in enumerate(DB_REPLICAS, start=1):
+    replica_host, _, replica_port = replica.partition(':')
+    DATABASES[f'replica_{index}'] = {
+        **DATABASES['default'],
+        'OPTIONS': dict(DATABASES['default']['OPTIONS']),
+        'HOST': replica_host,
+        'PORT': replica_port or DB_PORT,
+        'TEST': {'MIRROR': 'default'},
+    }
+DATABASE_REPLICAS = [f'replica_{index}' for index in range(1, len(DB_REPLICAS) + 1)]
+DATABASE_ROUTERS = ['api.db_routers.PrimaryReplicaRouter']
+
+# Реплика с большим отставанием (секунды) не используется до следующей проверки
+DB_REPLICA_MAX_LAG = float(os.getenv('DB_REPLICA_MAX_LAG', 10))
+DB_REPLICA_LAG_CHECK_INTERVAL = float(os.getenv('DB_REPLICA_LAG_CHECK_INTERVAL', 5))
+# После записи чтения пользователя идут в основную БД столько секунд. Реплика,
+# прошедшая проверку, может отстать на DB_REPLICA_MAX_LAG и еще отставать до
+# следующей проверки, поэтому окно не может быть короче их суммы
+DB_MIN_READ_YOUR_WRITES_WINDOW = math.ceil(DB_REPLICA_MAX_LAG + DB_REPLICA_LAG_CHECK_INTERVAL)
+DB_READ_YOUR_WRITES_WINDOW = int(os.getenv('DB_READ_YOUR_WRITES_WINDOW', DB_MIN_READ_YOUR_WRITES_WINDOW))
+# Где хранить отметки read-your-writes: отметка должна быть видна всем процессам,
+# иначе чтение после записи, сделанной в другом процессе, уйдет на реплику
+DB_PIN_CACHE = os.getenv('DB_PIN_CACHE', 'shared' if REDIS_URL else 'default')
+
+if DB_REPLICAS:
+    if DB_READ_YOUR_WRITES_WINDOW < DB_MIN_READ_YOUR_WRITES_WINDOW:
+        raise ImproperlyConfigured(
+            f'DB_READ_YOUR_WRITES_WINDOW должен быть не меньше DB_REPLICA_MAX_LAG + '
+            f'DB_REPLICA_LAG_CHECK_INTERVAL ({DB_MIN_READ_YOUR_WRITES_WINDOW} с)'
+        )
+    if CACHES.get(DB_PIN_CACHE, {}).get('BACKEND') == 'django.core.cache.backends.locmem.LocMemCache':
+        raise ImproperlyConfigured(
+            'Реплики (DB_REPLICAS) требуют общего кэша для отметок read-your-writes: '
+            'задайте REDIS_URL или DB_PIN_CACHE'
+        )
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',